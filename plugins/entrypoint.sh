@@ -14,5 +14,9 @@ fi
 # делаем скрипты исполняемыми
 for f in "$DST"/*; do [ -f "$f" ] && chmod +x "$f" || true; done
 
+# резидентный nginx_monitor.py: ключи nginx.check[*] обслуживаются через Unix-сокет (nginx_check.sh),
+# при падении процесс перезапускается
+( while :; do python3 "$DST/nginx_monitor.py" serve; sleep 1; done ) &
+
 # запускаем агент
 exec /usr/sbin/zabbix_agent2 -f -c /etc/zabbix/zabbix_agent2.conf
@@ -0,0 +1,16 @@
+#!/usr/bin/env sh
+# Клиент резидентного nginx_monitor.py: передаёт аргументы через Unix-сокет
+# вместо запуска python3 на каждый опрос. Если процесс не запущен — вызывает скрипт напрямую.
+# nginx_check.sh <команда> <аргумент> [...]
+
+sock="${NGINX_MONITOR_SOCKET:-/tmp/nginx_monitor.sock}"
+
+if [ -S "$sock" ]; then
+  out=$(printf '%s\t%s\t%s\n' "${1:-}" "${2:-}" "${3:-}" | socat -t 30 - "UNIX-CONNECT:$sock" 2>/dev/null)
+  if [ -n "$out" ]; then
+    printf '%s\n' "$out"
+    exit 0
+  fi
+fi
+
+exec python3 "$(dirname "$0")/nginx_monitor.py" "$@"
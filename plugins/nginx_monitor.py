@@ -3,70 +3,820 @@
 Кастомный плагин: проверка доступности HTTP и расчёт размера логов (MB).
 Использование:
   http <url>
+  http_multi [url1,url2,...]       — без списка проверяются NGINX_MONITOR_HTTP_TARGETS
   log_size <path>
+  discovery_logs [root]            — LLD: каталоги логов в root (по умолчанию /var/log/remote)
+  discovery_http [url1,url2,...]   — LLD: HTTP-цели (по умолчанию NGINX_MONITOR_HTTP_TARGETS)
+  access_stats <access.log>        — KPI трафика nginx по строкам, дописанным с прошлого опроса
+  discovery_access [root]          — LLD: <root>/<host>/nginx/access.log (по умолчанию /var/log/web)
+  syslog_scan [root]               — число новых строк <root>/<host>/syslog.log по уровням (по умолчанию
+                                     /var/log/remote); уровни — NGINX_MONITOR_SYSLOG_PATTERNS
+  serve [socket]   — резидентный режим: те же команды через Unix-сокет (см. nginx_check.sh);
+                     с NGINX_MONITOR_INOTIFY=1 размеры логов ведутся по событиям inotify
 Выводит:
-  1/0 для http; число с плавающей точкой для log_size.
+  1/0 для http; JSON {"<url>": {"up": 1/0, "status": <код>, "dns": <с>, "connect": <с>, "ttfb": <с>,
+  "total": <с>, "size": <байт>}, ...} для http_multi (время — только если сервер ответил);
+  число с плавающей точкой для log_size;
+  JSON {"requests", "rps", "status": {"2xx": ...}, "bytes", "request_time": {"p50", "p90", "p99"},
+  "upstream_time": {...}} для access_stats (перцентили — только если в логе есть время; rps — только
+  если лог прочитан без отставания, иначе "truncated": 1);
+  JSON {"hosts": {"<host>": {"<уровень>": ..., "total": ...}}, "samples": {"<host>": [строки]}} для syslog_scan;
+  JSON-массив [{"{#HOST}": ..., "{#LOGDIR}": ...}] / [{"{#URL}": ..., "{#TARGET}": ...}] /
+  [{"{#HOST}": ..., "{#ACCESSLOG}": ...}] для discovery_*.
 """
 
+import abc
+import collections
+import concurrent.futures
+import ctypes
+import ctypes.util
+import errno
+import http.client
+import json
 import os
-import os.path as osp
+import re
+import socket
+import socketserver
+import ssl
+import stat
+import struct
 import sys
+import threading
+import time
+import urllib.parse
 
+SOCKET_PATH = os.getenv("NGINX_MONITOR_SOCKET", "/tmp/nginx_monitor.sock")  # сокет резидентного режима
+HTTP_TIMEOUT = 5  # таймаут одной HTTP-проверки, секунды
+HTTP_MULTI_WORKERS = 16  # сколько URL http_multi проверяет одновременно
+HTTP_POOL_SIZE = 4  # сколько простаивающих keep-alive соединений держать на один сервер (только serve)
+HTTP_TARGETS = os.getenv("NGINX_MONITOR_HTTP_TARGETS", "")  # URL через запятую: цели http_multi и discovery_http
+LOG_ROOT = os.getenv("NGINX_MONITOR_LOG_ROOT", "/var/log/remote")  # каталог с логами удалённых хостов
+ACCESS_ROOT = os.getenv("NGINX_MONITOR_ACCESS_ROOT", "/var/log/web")  # каталоги /var/log веб-серверов
+STATE_DIR = os.getenv("NGINX_MONITOR_STATE_DIR", "/tmp/nginx_monitor")  # смещения access_stats между опросами
+ACCESS_READ_MAX = 64 * 1024 * 1024  # сколько новых байт access-лога разбирать за один опрос, остальное — в следующий
+# уровни syslog_scan по убыванию важности: имя=регулярное выражение через ";"; строка засчитывается
+# в самый важный совпавший уровень
+SYSLOG_PATTERNS = os.getenv("NGINX_MONITOR_SYSLOG_PATTERNS", "critical=CRITICAL;error=ERROR;test=LAB-TEST")
+SYSLOG_READ_MAX = 16 * 1024 * 1024  # сколько новых байт syslog.log одного хоста разбирать за опрос
+SYSLOG_SAMPLES = 5  # сколько последних совпавших строк каждого хоста отдавать в ответе
+SYSLOG_SAMPLE_LEN = 300  # максимальная длина строки-примера, байт
+REQUEST_MAX = 4096  # максимальная длина запроса к резидентному процессу, байт
+RACY_NS = 2_000_000_000  # каталог, изменённый менее 2 с назад, не кэшируется (грубая метка mtime)
 
-def print_err() -> int:
-    """Выводит '0' и возвращает код ошибки 1."""
-    print("0")
-    return 1
+# path -> (mtime_ns, имена *.log, имена подкаталогов); живёт, пока работает резидентный процесс
+_DIR_CACHE = {}
+_DIR_CACHE_LOCK = threading.Lock()  # кэш общий для потоков serve()
 
+KEEPALIVE = False  # переиспользовать HTTP-соединения между опросами — включается в serve()
+_HTTP_POOL = {}  # (scheme, host, port) -> [HTTPConnection, ...]
+_HTTP_POOL_LOCK = threading.Lock()
 
-def http_check(url: str) -> int:
+INOTIFY = os.getenv("NGINX_MONITOR_INOTIFY", "0") == "1"  # вести размеры логов по событиям inotify (только serve)
+_WATCHERS = {}  # path -> LogWatcher
+_WATCHERS_LOCK = threading.Lock()
+
+
+def _http_status(url: str) -> int:
     """
-    Проверяет доступность URL адреса по HTTP.
+    Запрашивает URL и возвращает HTTP-код ответа (0 — нет ответа).
     """
+    import urllib.error
+    import urllib.request
     try:
-        import urllib.request
-        with urllib.request.urlopen(url, timeout=5) as r:
-            print("1" if r.status == 200 else "0")
-            return 0 if r.status == 200 else 1
+        with urllib.request.urlopen(url, timeout=HTTP_TIMEOUT) as r:
+            return r.status
+    except urllib.error.HTTPError as e:
+        return e.code
     except Exception:
-        return print_err()
+        return 0
+
+
+def http_check(url: str) -> tuple[str, int]:
+    """
+    Проверяет доступность URL адреса по HTTP.
+    """
+    return ("1", 0) if _http_status(url) == 200 else ("0", 1)
+
+
+class _PinnedHTTPConnection(http.client.HTTPConnection):
+    """Соединение с заранее разрешённым адресом addr: время DNS замеряется отдельно от соединения."""
+
+    addr = None
+
+    def connect(self):
+        if self.addr is None:
+            return super().connect()
+        self.sock = socket.create_connection(self.addr, self.timeout, self.source_address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class _PinnedHTTPSConnection(http.client.HTTPSConnection, _PinnedHTTPConnection):
+    """То же для https: TLS поверх соединения с addr, в том числе при переподключении (auto_open)."""
+
+
+def _http_connect(scheme: str, host: str, port: int, timing: dict) -> http.client.HTTPConnection:
+    """Открывает соединение, отдельно замеряя разрешение имени и установку TCP (и TLS) соединения."""
+    t = time.perf_counter()
+    addr = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0][4]
+    timing["dns"] = time.perf_counter() - t
+    if scheme == "https":
+        conn = _PinnedHTTPSConnection(host, port, timeout=HTTP_TIMEOUT, context=ssl.create_default_context())
+    else:
+        conn = _PinnedHTTPConnection(host, port, timeout=HTTP_TIMEOUT)
+    conn.addr = addr[:2]
+    t = time.perf_counter()
+    conn.connect()
+    timing["connect"] = time.perf_counter() - t
+    return conn
+
 
+def _http_pooled(key):
+    if not KEEPALIVE:
+        return None
+    with _HTTP_POOL_LOCK:
+        idle = _HTTP_POOL.get(key)
+        return idle.pop() if idle else None
 
-def log_size(path: str) -> int:
+
+def _http_release(key, conn, resp):
+    if KEEPALIVE and not resp.will_close:
+        with _HTTP_POOL_LOCK:
+            idle = _HTTP_POOL.setdefault(key, [])
+            if len(idle) < HTTP_POOL_SIZE:
+                idle.append(conn)
+                return
+    conn.close()
+
+
+def _http_probe(url: str) -> dict:
+    """
+    Запрашивает URL (без перехода по редиректам) и возвращает код ответа и время по фазам, секунды:
+    dns — разрешение имени, connect — TCP (и TLS) соединение, ttfb — от отправки запроса до первого
+    байта ответа, total — весь запрос вместе с чтением тела; size — размер тела, байт.
+    На переиспользованном keep-alive соединении dns и connect равны 0. Если ответа нет, времени
+    в результате нет: нулевые значения исказили бы среднее.
+    """
+    result = {"up": 0, "status": 0}
+    try:
+        u = urllib.parse.urlsplit(url)
+        scheme = u.scheme or "http"
+        key = (scheme, u.hostname, u.port or (443 if scheme == "https" else 80))
+        path = (u.path or "/") + (f"?{u.query}" if u.query else "")
+    except ValueError:
+        return result
+    for _ in range(2):
+        conn = _http_pooled(key)
+        reused = conn is not None
+        timing = {"dns": 0.0, "connect": 0.0}
+        start = time.perf_counter()
+        try:
+            if conn is None:
+                conn = _http_connect(*key, timing)
+            sent = time.perf_counter()
+            conn.request("GET", path, headers={"User-Agent": "nginx_monitor"})
+            resp = conn.getresponse()
+            ttfb = time.perf_counter() - sent
+            size = len(resp.read())
+            total = time.perf_counter() - start
+        except Exception:
+            if conn is not None:
+                conn.close()
+            if reused:
+                continue  # сервер закрыл простаивавшее соединение — повторяем на новом
+            return result
+        _http_release(key, conn, resp)
+        result.update(up=int(resp.status == 200), status=resp.status, ttfb=round(ttfb, 6),
+                      total=round(total, 6), size=size, **{k: round(v, 6) for k, v in timing.items()})
+        return result
+    return result
+
+
+def _targets(urls: str) -> list:
+    """Список URL через запятую без повторов; пустой список — настроенные NGINX_MONITOR_HTTP_TARGETS."""
+    return list(dict.fromkeys(u.strip() for u in (urls or HTTP_TARGETS).split(",") if u.strip()))
+
+
+def http_multi(urls: str) -> tuple[str, int]:
+    """
+    Проверяет список URL (через запятую) одновременно и возвращает один JSON-документ
+    с кодом ответа и временем по фазам для каждого URL (см. _http_probe):
+    время опроса — самый медленный URL, а не сумма.
+    """
+    targets = _targets(urls)
+    if not targets:
+        return "{}", 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(targets), HTTP_MULTI_WORKERS)) as pool:
+        result = dict(zip(targets, pool.map(_http_probe, targets)))
+    return json.dumps(result), 0 if all(r["up"] for r in result.values()) else 1
+
+
+def _drop_subtree(path: str, cache: dict):
+    """Удаляет из кэша каталог path и всё, что под ним. Вызывается под _DIR_CACHE_LOCK."""
+    prefix = os.path.join(path, "")
+    for key in [k for k in cache if k == path or k.startswith(prefix)]:
+        del cache[key]
+
+
+def _scan_dir(path: str, cache: dict) -> tuple[int, list]:
+    """
+    Возвращает (байт в *.log каталога, подкаталоги). Список файлов и подкаталогов берётся
+    из кэша, пока не изменился mtime каталога; размеры файлов читаются всегда —
+    дописывание в лог mtime каталога не меняет. Если mtime изменился, каталог читается заново,
+    а из кэша выбрасываются только исчезнувшие подкаталоги (вместе с их содержимым) — записи
+    остальных подкаталогов остаются, и они перечитываются, только если изменились сами.
+    """
+    st = os.stat(path)
+    with _DIR_CACHE_LOCK:
+        cached = cache.get(path)
+    if cached is not None and cached[0] == st.st_mtime_ns:
+        total = 0
+        for fn in cached[1]:
+            try:
+                total += os.stat(os.path.join(path, fn)).st_size
+            except OSError:
+                pass
+        return total, cached[2]
+
+    total, logs, subdirs = 0, [], []
+    with os.scandir(path) as it:
+        for e in it:
+            try:
+                if e.is_dir(follow_symlinks=False):
+                    subdirs.append(e.name)
+                elif e.name.endswith(".log") and e.is_file():
+                    total += e.stat().st_size
+                    logs.append(e.name)
+            except OSError:
+                pass
+    with _DIR_CACHE_LOCK:
+        if cached is not None:
+            for gone in set(cached[2]) - set(subdirs):
+                _drop_subtree(os.path.join(path, gone), cache)
+        # изменения в ту же секунду, что и прошлое сканирование, могут не сдвинуть mtime — такой каталог
+        # в следующий раз перечитываем (None не совпадёт с mtime), но список подкаталогов храним для сравнения
+        fresh = time.time_ns() - st.st_mtime_ns > RACY_NS
+        cache[path] = (st.st_mtime_ns if fresh else None, logs, subdirs)
+    return total, subdirs
+
+
+def log_size(path: str) -> tuple[str, int]:
     """
     Считает общий размер *.log в переданном каталоге (рекурсивно), МБ.
     """
     try:
         if not os.path.exists(path):
-            print("0")
-            return 1
-        total = 0
-        for root, _, files in os.walk(path):
-            for fn in files:
-                if fn.endswith(".log"):
-                    fp = os.path.join(root, fn)
-                    if os.path.isfile(fp):
-                        total += osp.getsize(fp)
+            return "0", 1
+        total = _watched_size(path) if INOTIFY and os.path.isdir(path) else None
+        if total is not None:
+            return f"{total / (1024 * 1024):.2f}", 0
+        total, stack = 0, [path]
+        while stack:
+            d = stack.pop()
+            try:
+                size, subdirs = _scan_dir(d, _DIR_CACHE)
+            except OSError:
+                with _DIR_CACHE_LOCK:
+                    _drop_subtree(d, _DIR_CACHE)  # каталог удалён или недоступен — как os.walk, пропускаем
+                continue
+            total += size
+            stack.extend(os.path.join(d, s) for s in subdirs)
         mb = total / (1024 * 1024)
-        print(f"{mb:.2f}")
-        return 0
+        return f"{mb:.2f}", 0
     except Exception:
-        return print_err()
+        return "0", 1
+
+
+# --- inotify (Linux) ---
+
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT = struct.Struct("iIII")  # wd, mask, cookie, len; за ним имя длиной len
+
+
+def _libc():
+    lib = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+    lib.inotify_init1.argtypes = [ctypes.c_int]
+    lib.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    lib.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return lib
+
+
+class LogWatcher:
+    """
+    Живой учёт размера *.log под каталогом: один полный обход при старте, дальше —
+    события inotify (create/modify/delete/move) обновляют размеры отдельных файлов, а запрос
+    total() отвечает за O(1). При переполнении очереди событий (IN_Q_OVERFLOW) —
+    полный пересчёт. Если каталог удалён или перемещён, watcher помечается dead.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.lib = _libc()
+        self.fd = self.lib.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self.lock = threading.Lock()
+        self.dirs = {}  # wd -> каталог
+        self.wds = {}  # каталог -> wd
+        self.sizes = {}  # файл *.log -> размер
+        self.total = 0
+        self.dead = False
+        self.rescans = 0
+        try:
+            self._rescan()
+        except OSError:
+            os.close(self.fd)
+            raise
+        threading.Thread(target=self._loop, name=f"inotify:{root}", daemon=True).start()
+
+    def size(self) -> int:
+        with self.lock:
+            return self.total
+
+    # --- учёт файлов (вызывается под self.lock) ---
+
+    def _set(self, path, size):
+        self.total += size - self.sizes.get(path, 0)
+        self.sizes[path] = size
+
+    def _drop(self, path):
+        self.total -= self.sizes.pop(path, 0)
+
+    def _watch(self, d):
+        wd = self.lib.inotify_add_watch(self.fd, os.fsencode(d), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:  # исчерпан fs.inotify.max_user_watches — дальше считать нельзя
+                raise OSError(err, "inotify_add_watch: лимит наблюдений", d)
+            return  # каталог успел исчезнуть
+        self.dirs[wd] = d
+        self.wds[d] = wd
+
+    def _add_tree(self, top):
+        """Ставит наблюдение на каталог и подкаталоги и учитывает их *.log (наблюдение — до чтения каталога)."""
+        stack = [top]
+        while stack:
+            d = stack.pop()
+            self._watch(d)
+            try:
+                with os.scandir(d) as it:
+                    for e in it:
+                        try:
+                            if e.is_dir(follow_symlinks=False):
+                                stack.append(e.path)
+                            elif e.name.endswith(".log") and e.is_file():
+                                self._set(e.path, e.stat().st_size)
+                        except OSError:
+                            pass
+            except OSError:
+                pass
+
+    def _drop_tree(self, top):
+        prefix = top + os.sep
+        for path in [p for p in self.sizes if p.startswith(prefix)]:
+            self._drop(path)
+        for d in [d for d in self.wds if d == top or d.startswith(prefix)]:
+            wd = self.wds.pop(d)
+            self.dirs.pop(wd, None)
+            self.lib.inotify_rm_watch(self.fd, wd)
+
+    def _rescan(self):
+        with self.lock:
+            self.sizes, self.total = {}, 0
+            self._add_tree(self.root)
+            self.rescans += 1
+
+    # --- обработка событий ---
+
+    def _loop(self):
+        try:
+            while not self.dead:
+                self._handle(os.read(self.fd, 1 << 16))
+        except Exception:
+            self.dead = True
+        finally:
+            os.close(self.fd)
+
+    def _handle(self, buf):
+        dirty, overflow = set(), False
+        with self.lock:
+            pos = 0
+            while pos < len(buf):
+                wd, mask, _, length = EVENT.unpack_from(buf, pos)
+                name = buf[pos + EVENT.size:pos + EVENT.size + length].rstrip(b"\0")
+                pos += EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                d = self.dirs.get(wd)
+                if d is None:
+                    continue
+                if mask & IN_IGNORED:
+                    self.dirs.pop(wd, None)
+                    if self.wds.get(d) == wd:
+                        del self.wds[d]
+                    continue
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    if d == self.root:
+                        self.dead = True  # наблюдаемый каталог удалён/перемещён — пусть создадут заново
+                    continue
+                path = os.path.join(d, os.fsdecode(name))
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self._add_tree(path)
+                    elif mask & (IN_DELETE | IN_MOVED_FROM):
+                        self._drop_tree(path)
+                elif path.endswith(".log"):
+                    if mask & (IN_DELETE | IN_MOVED_FROM):
+                        self._drop(path)
+                        dirty.discard(path)
+                    else:
+                        dirty.add(path)
+            # пачку событий об одном файле сводим к одному stat
+            for path in dirty:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    self._drop(path)
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    self._set(path, st.st_size)
+        if overflow:
+            self._rescan()
+
+
+def _watched_size(path: str):
+    """Размер *.log по inotify-наблюдению или None, если наблюдение недоступно."""
+    with _WATCHERS_LOCK:
+        w = _WATCHERS.get(path)
+        if w is None or w.dead:
+            try:
+                w = _WATCHERS[path] = LogWatcher(path)
+            except OSError:
+                _WATCHERS.pop(path, None)
+                return None
+    return w.size()
+
+
+# --- access-лог nginx ---
+
+# combined: $remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" "$http_user_agent"
+ACCESS_LINE = re.compile(rb'^\S+ \S+ \S+ \[[^\]]*\] "(?:[^"\\]|\\.)*" (\d{3}) (\d+|-)')
+# дополнение формата timed (web/access-log.conf): rt=$request_time urt="$upstream_response_time"
+ACCESS_TIMING = re.compile(rb' rt=([\d.]+)(?: urt="([^"]*)")?')
+_TAIL_LOCKS = {}  # path -> Lock: один опрос файла за раз, иначе смещение посчитается дважды
+_TAIL_LOCKS_LOCK = threading.Lock()
+
+
+def _percentiles(values: list) -> dict:
+    """p50/p90/p99 методом ближайшего ранга."""
+    values.sort()
+    n = len(values)
+    return {f"p{q}": values[min(n - 1, max(0, -(-q * n // 100) - 1))] for q in (50, 90, 99)}
+
+
+def _upstream_time(raw: bytes):
+    """Сумма времени всех upstream-попыток ("0.010, 0.020" или "0.010 : 0.020"); None, если upstream не было."""
+    total, seen = 0.0, False
+    for part in re.split(rb"[,:]", raw):
+        part = part.strip()
+        if part and part != b"-":
+            total += float(part)
+            seen = True
+    return total if seen else None
+
+
+def _state_path(path: str) -> str:
+    return os.path.join(STATE_DIR, re.sub(r"[^A-Za-z0-9._-]", "_", path.strip("/")) + ".json")
+
+
+def _load_state(path: str):
+    try:
+        with open(_state_path(path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_state(path: str, state: dict):
+    os.makedirs(STATE_DIR, exist_ok=True)
+    target = _state_path(path)
+    tmp = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, target)
+
+
+class _Lines(abc.ABC):
+    """Построчный разбор дописанной части файла; разбор одной строки — line() наследника."""
+
+    def feed(self, f, start: int, limit: int) -> int:
+        """
+        Разбирает полные строки файла f с позиции start, не больше limit байт.
+        Возвращает позицию после последней полной строки.
+        """
+        f.seek(start)
+        pos = start
+        while limit > 0:
+            size = min(1 << 20, limit)
+            chunk = f.read(size)
+            if not chunk:
+                break
+            end = chunk.rfind(b"\n")
+            if end < 0:
+                if len(chunk) < size:
+                    break  # недописанная строка — дочитаем в следующий раз
+                end = len(chunk) - 1  # строка длиннее буфера — пропускаем её
+            for line in chunk[:end + 1].splitlines():
+                self.line(line)
+            pos += end + 1
+            limit -= end + 1
+            f.seek(pos)
+        return pos
+
+    @abc.abstractmethod
+    def line(self, line: bytes):
+        """Разбирает одну строку (без перевода строки)."""
+
+
+def _tail(path: str, lines: _Lines, budget: int):
+    """
+    Передаёт lines строки path, дописанные после смещения, сохранённого прошлым опросом (STATE_DIR),
+    не больше budget байт. Ротация узнаётся по смене inode: хвост старого файла дочитывается из <path>.1,
+    если он там, и новый файл читается с начала; усечение (copytruncate) — по размеру меньше смещения.
+    Первый опрос только запоминает конец файла.
+    Возвращает (состояние прошлого опроса или None, время опроса, упёрлись ли в budget) или None,
+    если файла нет. Если упёрлись, непрочитанное останется следующему опросу: в состоянии это
+    отмечается как behind, и строки следующего опроса тоже относятся не только к его интервалу.
+    """
+    with _TAIL_LOCKS_LOCK:
+        lock = _TAIL_LOCKS.setdefault(path, threading.Lock())
+    with lock:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        now = time.time()
+        state = _load_state(path)
+        if state is None:
+            offset = st.st_size
+        else:
+            offset = state["offset"]
+            if state["inode"] != st.st_ino or state["dev"] != st.st_dev:
+                try:
+                    old = os.stat(path + ".1")
+                    if old.st_ino == state["inode"] and old.st_dev == state["dev"] and old.st_size > offset:
+                        with open(path + ".1", "rb") as f:
+                            budget -= lines.feed(f, offset, budget) - offset
+                except OSError:
+                    pass
+                offset = 0
+            elif st.st_size < offset:
+                offset = 0
+            if budget > 0:
+                with open(path, "rb") as f:
+                    start, offset = offset, lines.feed(f, offset, budget)
+                budget -= offset - start
+        truncated = budget <= 0
+        _save_state(path, {"inode": st.st_ino, "dev": st.st_dev, "offset": offset, "time": now,
+                           "behind": truncated})
+    return state, now, truncated
+
+
+class _AccessStats(_Lines):
+    """Счётчики по разобранным строкам access-лога."""
+
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+        self.status = {f"{c}xx": 0 for c in range(1, 6)}
+        self.request_time = []
+        self.upstream_time = []
+        self.invalid = 0
+
+    def line(self, line: bytes):
+        m = ACCESS_LINE.match(line)
+        if not m:
+            if line.strip():
+                self.invalid += 1
+            return
+        self.requests += 1
+        cls = f"{line[m.start(1)] - 48}xx"
+        if cls in self.status:
+            self.status[cls] += 1
+        if m.group(2) != b"-":
+            self.bytes += int(m.group(2))
+        t = ACCESS_TIMING.search(line, m.end())
+        if t:
+            self.request_time.append(float(t.group(1)))
+            if t.group(2):
+                up = _upstream_time(t.group(2))
+                if up is not None:
+                    self.upstream_time.append(up)
+
+
+def access_stats(path: str) -> tuple[str, int]:
+    """
+    KPI access-лога nginx за время с прошлого опроса: число и частота запросов, классы кодов ответа,
+    отданные байты и перцентили $request_time / $upstream_response_time.
+
+    Читаются только строки, дописанные с прошлого опроса (см. _tail), поэтому стоимость
+    опроса зависит от объёма новых записей, а не от размера файла.
+    """
+    stats = _AccessStats()
+    tail = _tail(path, stats, ACCESS_READ_MAX)
+    if tail is None:
+        return "{}", 1
+    state, now, truncated = tail
+    result = {
+        "requests": stats.requests,
+        "status": stats.status,
+        "bytes": stats.bytes,
+        "invalid": stats.invalid,
+    }
+    # частота — только если прочитаны ровно строки за время с прошлого опроса: при чтении с отставанием
+    # (упёрлись в ACCESS_READ_MAX сейчас или в прошлый раз) она занижалась бы, а потом давала всплеск
+    behind = truncated or bool(state and state.get("behind"))
+    if behind:
+        result["truncated"] = 1
+    elif state:
+        elapsed = now - state["time"]
+        result["rps"] = round(stats.requests / elapsed, 3) if elapsed > 0 else 0
+    if stats.request_time:
+        result["request_time"] = _percentiles(stats.request_time)
+    if stats.upstream_time:
+        result["upstream_time"] = _percentiles(stats.upstream_time)
+    return json.dumps(result), 0
+
+
+def discovery_access(root: str) -> tuple[str, int]:
+    """
+    LLD: access-логи nginx веб-серверов — <root>/<host>/nginx/access.log.
+    """
+    root = root or ACCESS_ROOT
+    try:
+        with os.scandir(root) as it:
+            names = sorted(e.name for e in it if e.is_dir())
+    except OSError:
+        return "[]", 1
+    logs = [(n, os.path.join(root, n, "nginx", "access.log")) for n in names]
+    return json.dumps([{"{#HOST}": n, "{#ACCESSLOG}": p} for n, p in logs if os.path.isfile(p)]), 0
+
+
+# --- syslog удалённых хостов ---
+
+def _syslog_levels(spec: str) -> list:
+    """[(уровень, скомпилированное выражение), ...] из строки вида "critical=CRITICAL;error=ERROR"."""
+    levels = []
+    for part in spec.split(";"):
+        name, sep, pattern = part.partition("=")
+        if sep and name.strip() and pattern:
+            levels.append((name.strip(), re.compile(pattern.encode())))
+    return levels
+
+
+SYSLOG_LEVELS = _syslog_levels(SYSLOG_PATTERNS)
+# все уровни одним выражением: строки без совпадений отсеиваются за один проход
+SYSLOG_ANY = re.compile(b"|".join(b"(?:" + rx.pattern + b")" for _, rx in SYSLOG_LEVELS) or b"(?!)")
+
+
+class _SyslogStats(_Lines):
+    """Счётчики строк syslog одного хоста по уровням и последние совпавшие строки."""
+
+    def __init__(self):
+        self.counts = {name: 0 for name, _ in SYSLOG_LEVELS}
+        self.total = 0
+        self.samples = collections.deque(maxlen=SYSLOG_SAMPLES)
+
+    def line(self, line: bytes):
+        if not SYSLOG_ANY.search(line):
+            return
+        for name, rx in SYSLOG_LEVELS:
+            if rx.search(line):
+                self.counts[name] += 1
+                break
+        self.total += 1
+        self.samples.append(line)
+
+
+def syslog_scan(root: str) -> tuple[str, int]:
+    """
+    Счётчики строк <root>/<host>/syslog.log по уровням SYSLOG_PATTERNS за время с прошлого опроса —
+    все хосты за один вызов. Как и access_stats, читает только дописанные строки (см. _tail).
+    """
+    root = root or LOG_ROOT
+    try:
+        with os.scandir(root) as it:
+            names = sorted(e.name for e in it if e.is_dir())
+    except OSError:
+        return "{}", 1
+    hosts, samples = {}, {}
+    for name in names:
+        stats = _SyslogStats()
+        if _tail(os.path.join(root, name, "syslog.log"), stats, SYSLOG_READ_MAX) is None:
+            continue
+        hosts[name] = {**stats.counts, "total": stats.total}
+        if stats.samples:
+            samples[name] = [line[:SYSLOG_SAMPLE_LEN].decode("utf-8", "replace") for line in stats.samples]
+    return json.dumps({"hosts": hosts, "samples": samples}), 0
+
+
+def discovery_logs(root: str) -> tuple[str, int]:
+    """
+    LLD: подкаталоги root (по одному на удалённый хост, который пишет логи на log-srv).
+    """
+    root = root or LOG_ROOT
+    try:
+        with os.scandir(root) as it:
+            names = sorted(e.name for e in it if e.is_dir())
+    except OSError:
+        return "[]", 1
+    return json.dumps([{"{#HOST}": n, "{#LOGDIR}": os.path.join(root, n)} for n in names]), 0
+
+
+def discovery_http(urls: str) -> tuple[str, int]:
+    """
+    LLD: HTTP-цели, которые проверяет http_multi.
+    """
+    return json.dumps([{"{#URL}": u, "{#TARGET}": urllib.parse.urlsplit(u).hostname or u}
+                       for u in _targets(urls)]), 0
+
+
+COMMANDS = {
+    "http": http_check,
+    "http_multi": http_multi,
+    "log_size": log_size,
+    "discovery_logs": discovery_logs,
+    "discovery_http": discovery_http,
+    "access_stats": access_stats,
+    "discovery_access": discovery_access,
+    "syslog_scan": syslog_scan,
+}
+
+
+def run(argv) -> tuple[str, int]:
+    """
+    Выполняет команду плагина и возвращает (вывод, код возврата).
+    """
+    if not argv or argv[0] not in COMMANDS:
+        return "0", 1
+    return COMMANDS[argv[0]](argv[1] if len(argv) > 1 else "")
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Один запрос на соединение: аргументы через табуляцию, в ответ — вывод команды."""
+
+    def handle(self):
+        line = self.rfile.readline(REQUEST_MAX).decode("utf-8", "replace").rstrip("\r\n")
+        out, _ = run(line.split("\t"))
+        self.wfile.write(out.encode() + b"\n")
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True  # медленная проверка одного URL не задерживает остальные
+
+
+def serve(path: str = SOCKET_PATH) -> int:
+    """
+    Резидентный режим: обслуживает команды через Unix-сокет, без запуска интерпретатора на каждый опрос.
+    """
+    global KEEPALIVE
+    import urllib.error  # noqa: F401
+    import urllib.request  # noqa: F401 — импортируем один раз при старте, а не в каждом запросе
+
+    KEEPALIVE = True
+    if os.path.exists(path):
+        os.unlink(path)  # сокет остался от прошлого запуска
+    with _Server(path, _Handler) as server:
+        os.chmod(path, 0o660)
+        server.serve_forever()
+    return 0
 
 
 def main(argv) -> int:
     """
     Основная функция запуска для проверки работы HTTP и количества логов.
     """
-    if len(argv) < 2:
-        return print_err()
-    cmd = argv[0]
-    arg = argv[1]
-    if cmd == "http":
-        return http_check(arg)
-    elif cmd == "log_size":
-        return log_size(arg)
-    return print_err()
+    if argv and argv[0] == "serve":
+        return serve(argv[1] if len(argv) > 1 and argv[1] else SOCKET_PATH)
+    out, code = run(argv)
+    print(out)
+    return code
 
 
 if __name__ == "__main__":
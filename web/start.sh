@@ -30,5 +30,12 @@ chown -R zabbix:zabbix /run/zabbix
 mkdir -p /var/spool/rsyslog /etc/rsyslog/certs
 rsyslogd
 
+# access-лог читает агент monitoring-plugins (том /var/log смонтирован к нему только на чтение).
+# Права новых файлов после ротации задаёт create в /etc/logrotate.d/nginx (см. Dockerfile); здесь —
+# каталог и файлы, оставшиеся в томе от прежних запусков с правами 0640
+mkdir -p /var/log/nginx
+touch /var/log/nginx/access.log
+chmod o+rx /var/log/nginx && chmod o+r /var/log/nginx/access.log*
+
 # Nginx в фоне
 exec nginx -g 'daemon off;'
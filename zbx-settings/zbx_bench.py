@@ -0,0 +1,525 @@
+"""
+Бенчмарк zbx_settings.py без настоящего Zabbix (Postgres + zabbix-server + zabbix-web).
+
+В процессе поднимается заглушка JSON-RPC API, которая хранит объекты в памяти и реализует методы,
+которые вызывает main(): get/create/update/delete для host/item/trigger/template/action/dashboard и
+остальных объектов, host.mass*, batch-запросы. Задержку ответа и доли отказов можно настраивать.
+
+Для каждого размера инвентаря (по умолчанию 4, 100 и 1000 синтетических веб-серверов) zbx_settings.py
+запускается дважды: на пустой «базе» (apply) и повторно (reapply, изменений быть не должно).
+Для каждого прогона печатаются время, число HTTP-запросов и вызовов API и объём трафика.
+
+С --check прогоны сравниваются с базовой линией (bench_baseline.json): если число вызовов
+или трафик выросли больше чем на --tolerance либо число trigger.get растёт с числом хостов
+(а не порций инвентаря), бенчмарк завершается с кодом 1.
+
+    python zbx_bench.py
+    python zbx_bench.py --hosts 4,100 --latency 0.005 --fail-rate 0.02
+    python zbx_bench.py --check bench_baseline.json
+    python zbx_bench.py --write-baseline bench_baseline.json
+"""
+import argparse
+import collections
+import copy
+import itertools
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "zbx_settings.py")
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+DEFAULT_SIZES = "4,100,1000"
+RUN_TIMEOUT = 1800  # предел на один прогон zbx_settings.py, секунды
+INVENTORY_CHUNK = int(os.getenv("ZBX_INVENTORY_CHUNK", "100"))  # размер порции инвентаря в zbx_settings.py
+SCALING_SLACK = 2  # допустимый разброс числа trigger.get между прогонами (гонки параллельных шагов)
+
+# Имя поля id и ключ ответа *.create/*.update для объектов, у которых они не выводятся из имени
+ID_FIELD = {"hostgroup": "groupid", "templategroup": "groupid", "usermacro": "hostmacroid",
+            "usergroup": "usrgrpid", "template": "templateid", "hostinterface": "interfaceid",
+            "discoveryrule": "itemid", "itemprototype": "itemid", "triggerprototype": "triggerid"}
+IDS_FIELD = {"hostgroup": "groupids", "templategroup": "groupids", "usermacro": "hostmacroids",
+             "usergroup": "usrgrpids", "discoveryrule": "itemids", "itemprototype": "itemids",
+             "triggerprototype": "triggerids"}
+
+
+def _str(v):
+    """Zabbix API возвращает скаляры строками — приводим к тому же виду."""
+    if isinstance(v, dict):
+        return {k: _str(x) for k, x in v.items()}
+    if isinstance(v, list):
+        return [_str(x) for x in v]
+    return str(v)
+
+
+def _as_set(v):
+    return {str(x) for x in (v if isinstance(v, list) else [v])}
+
+
+class MockZabbix:
+    """
+    Хранилище объектов заглушки и обработка JSON-RPC вызовов.
+    Поддерживает ровно то подмножество API, которое использует zbx_settings.py.
+    """
+
+    def __init__(self, latency=0.0, call_latency=0.0, fail_rate=0.0, seed=0):
+        self.latency = latency  # задержка каждого HTTP-запроса, секунды
+        self.call_latency = call_latency  # дополнительная задержка на каждый вызов (в т.ч. внутри batch)
+        self.fail_rate = fail_rate  # доля HTTP-запросов, на которые отвечаем 503
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.db = collections.defaultdict(dict)
+        self.audit = 0  # номер последней записи журнала аудита
+        self.ids = itertools.count(10001)
+        self.reset_stats()
+        self._seed_defaults()
+
+    def reset_stats(self):
+        self.http_requests = 0
+        self.failures = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.calls = collections.Counter()
+
+    def stats(self):
+        return {
+            "http_requests": self.http_requests,
+            "calls": sum(self.calls.values()),
+            "writes": sum(n for m, n in self.calls.items() if not m.endswith(".get") and m not in (
+                "user.login", "user.checkAuthentication", "apiinfo.version")),
+            "bytes_received": self.bytes_received,
+            "bytes_sent": self.bytes_sent,
+            "failures": self.failures,
+            "trigger_gets": self.calls["trigger.get"],
+        }
+
+    def _seed_defaults(self):
+        """Объекты, которые есть в чистой установке Zabbix."""
+        for name in ("Linux by Zabbix agent", "Zabbix server health", "Zabbix server"):
+            self._add("template", {"host": name})
+        self._add("host", {"host": "Zabbix server", "name": "Zabbix server", "interfaces": [], "groups": [],
+                           "parentTemplates": [], "monitored_by": "0", "proxyid": "0", "status": "0"})
+        self._add("user", {"username": "Admin", "lang": "en_US", "usrgrps": [{"usrgrpid": "7"}], "medias": []})
+        self.db["usergroup"]["7"] = {"usrgrpid": "7", "name": "Zabbix administrators", "rights": []}
+
+    def _add(self, kind, obj):
+        oid = str(next(self.ids))
+        obj = _str(obj)
+        obj[ID_FIELD.get(kind, kind + "id")] = oid
+        self.db[kind][oid] = obj
+        return oid
+
+    def _host_name(self, hostid):
+        for kind in ("host", "template"):
+            if hostid in self.db[kind]:
+                return self.db[kind][hostid]["host"]
+
+    def _host_id(self, name):
+        for kind in ("host", "template"):
+            for o in self.db[kind].values():
+                if o["host"] == name:
+                    return o.get("hostid") or o.get("templateid")
+
+    def _linked(self, templates):
+        return [{"templateid": str(t["templateid"]), "host": self._host_name(str(t["templateid"]))}
+                for t in templates]
+
+    # --- HTTP-уровень ---
+
+    def should_fail(self):
+        with self.lock:
+            fail = self.fail_rate > 0 and self.rng.random() < self.fail_rate
+            self.failures += fail
+            return fail
+
+    def account(self, received, sent):
+        with self.lock:
+            self.http_requests += 1
+            self.bytes_received += received
+            self.bytes_sent += sent
+
+    def handle(self, body):
+        """Обрабатывает тело JSON-RPC запроса (один вызов или batch) и возвращает ответ."""
+        def one(req):
+            if self.call_latency:
+                time.sleep(self.call_latency)
+            try:
+                return {"jsonrpc": "2.0", "result": self.call(req["method"], req.get("params")), "id": req["id"]}
+            except Exception as e:
+                return {"jsonrpc": "2.0", "error": {"code": -32602, "message": "Invalid params.", "data": repr(e)},
+                        "id": req["id"]}
+
+        if self.latency:
+            time.sleep(self.latency)
+        return [one(b) for b in body] if isinstance(body, list) else one(body)
+
+    # --- методы API ---
+
+    def call(self, method, params):
+        with self.lock:
+            self.calls[method] += 1
+        kind, _, op = method.partition(".")
+        if method == "apiinfo.version":
+            return "7.0.0"
+        if method == "user.login":
+            return "bench-session"
+        if method == "user.checkAuthentication":
+            if (params.get("sessionid") or params.get("token")) != "bench-session":
+                raise ValueError("Session terminated, re-login, please.")
+            return {"userid": "1", "username": "Admin", "sessionid": "bench-session"}
+        if method == "hanode.get":
+            return [{"name": "", "status": "3"}]
+        with self.lock:
+            if method == "auditlog.get":
+                return [{"auditid": str(self.audit), "clock": "0"}] if self.audit else []
+            if op == "get":
+                rows = self._get(kind, params)
+                return str(len(rows)) if params.get("countOutput") else rows
+            # любое изменение попадает в журнал аудита — по нему режим сверки замечает дрейф
+            self.audit += 1
+            if op in ("create", "update"):
+                objs = params if isinstance(params, list) else [params]
+                fn = self._create if op == "create" else self._update
+                return {IDS_FIELD.get(kind, kind + "ids"): [fn(kind, o) for o in objs]}
+            if op == "delete":
+                oids = [str(oid) for oid in params]
+                for oid in oids:
+                    obj = self.db[kind].pop(oid, None)
+                    if kind == "item" and obj is not None:
+                        # зависимые элементы и триггеры удаляются вместе с элементом данных, на который ссылаются
+                        oids += [i for i, it in self.db["item"].items() if str(it.get("master_itemid")) == oid]
+                        ref = f"/{self.db['host'][str(obj['hostid'])]['host']}/{obj['key_']}"
+                        for tid in [t for t, trig in self.db["trigger"].items() if ref in trig["expression"]]:
+                            del self.db["trigger"][tid]
+                return {IDS_FIELD.get(kind, kind + "ids"): params}
+            if method in ("host.massadd", "host.massupdate", "host.massremove"):
+                return self._mass(op, params)
+        raise ValueError(f"метод {method} не поддерживается заглушкой")
+
+    def _mass(self, op, params):
+        if op == "massremove":
+            clear = _as_set(params.get("templateids_clear", []))
+            for hostid in params["hostids"]:
+                h = self.db["host"][str(hostid)]
+                h["parentTemplates"] = [t for t in h["parentTemplates"] if t["templateid"] not in clear]
+            return {"hostids": params["hostids"]}
+        ids = [str(h["hostid"]) for h in params["hosts"]]
+        for hostid in ids:
+            h = self.db["host"][hostid]
+            for k, v in params.items():
+                if k == "hosts":
+                    continue
+                if op == "massadd" and k == "groups":
+                    h["groups"] += _str(v)
+                elif op == "massadd" and k == "templates":
+                    h["parentTemplates"] += self._linked(v)
+                elif k == "templates":
+                    h["parentTemplates"] = self._linked(v)
+                else:
+                    h[k] = _str(v)
+        return {"hostids": ids}
+
+    def _create(self, kind, o):
+        o = copy.deepcopy(o)
+        if kind == "host":
+            interfaces = o.pop("interfaces", [])
+            o.setdefault("monitored_by", 0)
+            o.setdefault("proxyid", 0)
+            o["parentTemplates"] = self._linked(o.pop("templates", []))
+            hostid = self._add("host", o)
+            for i in interfaces:
+                self._add("hostinterface", {**i, "hostid": hostid, "details": i.get("details", [])})
+            return hostid
+        if kind == "template":
+            o.pop("groups", None)
+        elif kind in ("item", "itemprototype", "discoveryrule"):
+            o.setdefault("templateid", "0")
+            o.setdefault("flags", "0")
+            o.setdefault("preprocessing", [])
+            o.setdefault("tags", [])
+            for k in ("history", "trends", "timeout", "units", "snmp_oid", "valuemapid", "interfaceid"):
+                o.setdefault(k, "")
+        elif kind in ("trigger", "triggerprototype"):
+            o.setdefault("templateid", "0")
+            o.setdefault("recovery_mode", "0")
+            o.setdefault("recovery_expression", "")
+            m = re.search(r"\((?:/)?/([^/]+)/", o["expression"])
+            o["hostid"] = self._host_id(m.group(1)) if m else None
+        elif kind == "graph":
+            o["hostid"] = self.db["item"][str(o["gitems"][0]["itemid"])]["hostid"]
+        elif kind == "dashboard":
+            o["pages"] = [{**pg, "widgets": [{"view_mode": "0", **w} for w in pg["widgets"]]} for pg in o["pages"]]
+        elif kind == "valuemap":
+            o["mappings"] = [{"type": "0", **m} for m in o["mappings"]]
+        elif kind == "action":
+            o["recoveryOperations"] = o.pop("recovery_operations", [])
+            o["filter"] = self._action_filter(o["filter"])
+        elif kind == "mediatype":
+            o.setdefault("message_templates", [])
+        return self._add(kind, o)
+
+    @staticmethod
+    def _action_filter(f):
+        return {**f, "formula": f.get("formula", ""),
+                "conditions": [{"formulaid": "A", "value2": "", **c} for c in f["conditions"]]}
+
+    def _update(self, kind, o):
+        o = copy.deepcopy(o)
+        id_field = ID_FIELD.get(kind, kind + "id")
+        cur = self.db[kind][str(o.pop(id_field))]
+        if kind == "host":
+            if "templates" in o:
+                cur["parentTemplates"] = self._linked(o.pop("templates"))
+            o.pop("templates_clear", None)
+        elif kind == "user" and "medias" in o:
+            cur["medias"] = [{**m, "mediaid": m.get("mediaid", str(next(self.ids)))} for m in _str(o.pop("medias"))]
+        elif kind == "action":
+            if "recovery_operations" in o:
+                o["recoveryOperations"] = o.pop("recovery_operations")
+            if "filter" in o:
+                o["filter"] = self._action_filter(o["filter"])
+        elif kind == "valuemap" and "mappings" in o:
+            o["mappings"] = [{"type": "0", **m} for m in o["mappings"]]
+        cur.update(_str(o))
+        return cur[id_field]
+
+    def _get(self, kind, p):
+        id_field = ID_FIELD.get(kind, kind + "id")
+        rows = self.db[kind].values()
+        if p.get("hostids") is not None:
+            hostids = _as_set(p["hostids"])
+            rows = [r for r in rows if str(r.get("hostid", r.get(id_field))) in hostids]
+        if p.get("groupids") is not None and kind in ("host", "item", "trigger"):
+            groupids = _as_set(p["groupids"])
+            members = {h["hostid"] for h in self.db["host"].values()
+                       if groupids & {g["groupid"] for g in h["groups"]}}
+            rows = [r for r in rows if r.get("hostid") in members]
+        for key in ("userids", "usrgrpids", "itemids", "triggerids", "graphids", "templateids"):
+            if key in p:
+                wanted = _as_set(p[key])
+                rows = [r for r in rows if r.get(key[:-1]) in wanted]
+        for k, vals in (p.get("filter") or {}).items():
+            wanted = _as_set(vals)
+            if kind == "trigger" and k == "host":
+                rows = [r for r in rows if self._host_name(r["hostid"]) in wanted]
+            else:
+                rows = [r for r in rows if str(r.get(k)) in wanted]
+        out = []
+        for r in rows:
+            r = copy.deepcopy(r)
+            if kind == "host":
+                r["interfaces"] = [copy.deepcopy(i) for i in self.db["hostinterface"].values()
+                                   if i["hostid"] == r["hostid"]]
+                r["groups"] = [{"groupid": g["groupid"],
+                                "name": self.db["hostgroup"].get(g["groupid"], {}).get("name", "")}
+                               for g in r["groups"]]
+            elif kind == "action":
+                r["recovery_operations"] = r.pop("recoveryOperations", [])
+            elif kind == "trigger" and "selectHosts" in p:
+                r["hosts"] = [{"hostid": r["hostid"]}]
+            out.append(r)
+        if p.get("limit"):
+            out = out[:int(p["limit"])]
+        return out
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Заголовки и тело ответа уходят одним пакетом, иначе Nagle + delayed ACK добавляют ~40 мс на запрос
+        disable_nagle_algorithm = True
+        wbufsize = 1 << 16
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            raw = self.rfile.read(int(self.headers["Content-Length"]))
+            if api.should_fail():
+                data = b""
+                self.send_response(503)
+            else:
+                data = json.dumps(api.handle(json.loads(raw))).encode()
+                self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            api.account(len(raw), len(data))
+
+    return Handler
+
+
+def serve(api):
+    """Запускает заглушку на свободном порту localhost в фоновом потоке."""
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(api))
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+
+def write_inventory(path, count):
+    """Синтетический инвентарь веб-серверов в формате JSON lines."""
+    with open(path, "w", encoding="utf-8") as f:
+        for n in range(1, count + 1):
+            host = f"bench-web-{n:04d}"
+            f.write(json.dumps({"host": host, "dns": f"{host}.bench.local"}) + "\n")
+
+
+def run_provisioning(url, inventory, workdir, concurrency=None):
+    """Запускает zbx_settings.py против заглушки и возвращает время прогона, секунды."""
+    env = {
+        **os.environ,
+        "ZBX_API_URL": url, "ZBX_USER": "Admin", "ZBX_PASS": "bench", "ZBX_LANG": "ru_RU",
+        "SNMP_AUTH_PASS": "bench-auth", "SNMP_PRIV_PASS": "bench-priv",
+        "TELEGRAM_BOT_TOKEN": "bench", "TELEGRAM_CHAT_ID": "1",
+        "ZBX_INVENTORY": inventory, "ZBX_METRICS_DIR": workdir,
+        "ZBX_SESSION_FILE": os.path.join(workdir, "session.json"),
+        "WAIT_INTERVAL": "0.5", "ZBX_API_RETRY_DELAY": "0.05",
+    }
+    if concurrency:
+        env["ZBX_CONCURRENCY"] = str(concurrency)
+    t0 = time.monotonic()
+    proc = subprocess.run([sys.executable, "-u", SCRIPT], env=env, cwd=workdir, capture_output=True, text=True,
+                          timeout=RUN_TIMEOUT)
+    seconds = time.monotonic() - t0
+    if proc.returncode != 0:
+        tail = "\n".join((proc.stdout + proc.stderr).strip().splitlines()[-20:])
+        raise RuntimeError(f"zbx_settings.py завершился с кодом {proc.returncode}:\n{tail}")
+    return seconds
+
+
+def bench_size(count, args):
+    """Два прогона (apply и reapply) на свежей заглушке для инвентаря из count веб-серверов."""
+    api = MockZabbix(latency=args.latency, call_latency=args.call_latency, fail_rate=args.fail_rate, seed=count)
+    srv = serve(api)
+    results = []
+    try:
+        url = f"http://127.0.0.1:{srv.server_port}/api_jsonrpc.php"
+        with tempfile.TemporaryDirectory(prefix="zbx-bench-") as workdir:
+            inventory = os.path.join(workdir, "inventory.jsonl")
+            write_inventory(inventory, count)
+            for run in ("apply", "reapply"):
+                api.reset_stats()
+                seconds = run_provisioning(url, inventory, workdir, args.concurrency)
+                results.append({"hosts": count, "run": run, "seconds": round(seconds, 3), **api.stats()})
+    finally:
+        srv.shutdown()
+        srv.server_close()
+    return results
+
+
+def print_results(results):
+    print(f"{'hosts':>6} {'run':<8} {'seconds':>8} {'http':>7} {'calls':>7} {'writes':>7} "
+          f"{'KiB out':>9} {'KiB in':>9} {'calls/host':>10}")
+    for r in results:
+        print(f"{r['hosts']:>6} {r['run']:<8} {r['seconds']:>8.2f} {r['http_requests']:>7} {r['calls']:>7} "
+              f"{r['writes']:>7} {r['bytes_received'] / 1024:>9.1f} {r['bytes_sent'] / 1024:>9.1f} "
+              f"{r['calls'] / r['hosts']:>10.2f}")
+
+
+def _key(r):
+    return f"{r['run']}/{r['hosts']}"
+
+
+def check_baseline(results, path, tolerance):
+    """
+    Сравнивает число вызовов API и трафик с базовой линией.
+    Время не сравнивается: оно зависит от машины, а вызовы и байты — нет.
+    """
+    with open(path, encoding="utf-8") as f:
+        baseline = json.load(f)["runs"]
+    problems = []
+    for r in results:
+        base = baseline.get(_key(r))
+        if base is None:
+            print(f"ℹ️  {_key(r)}: нет в базовой линии, пропускаю")
+            continue
+        for metric in ("calls", "http_requests", "bytes_received", "bytes_sent"):
+            limit = base[metric] * (1 + tolerance)
+            if r[metric] > limit:
+                problems.append(f"{_key(r)}: {metric} {r[metric]} > {base[metric]} (+{tolerance:.0%})")
+    return problems
+
+
+def check_scaling(results):
+    """
+    Число trigger.get не должно расти с числом хостов: сверх того, что нужно самому маленькому
+    инвентарю, допускается не больше одного запроса на порцию инвентаря (INVENTORY_CHUNK хостов)
+    и SCALING_SLACK запросов на параллельные шаги, одновременно дочитывающие один и тот же хост.
+    """
+    problems = []
+    for run in sorted({r["run"] for r in results}):
+        runs = sorted((r for r in results if r["run"] == run), key=lambda r: r["hosts"])
+        extra = [r["trigger_gets"] - -(-r["hosts"] // INVENTORY_CHUNK) for r in runs]
+        for r, n in zip(runs[1:], extra[1:]):
+            if n > extra[0] + SCALING_SLACK:
+                problems.append(f"{_key(r)}: trigger.get {r['trigger_gets']} — растёт с числом хостов "
+                                f"(у {_key(runs[0])}: {runs[0]['trigger_gets']})")
+    return problems
+
+
+def write_baseline(results, path):
+    runs = {_key(r): {k: r[k] for k in ("calls", "http_requests", "bytes_received", "bytes_sent", "writes")}
+            for r in results}
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"runs": runs}, f, indent=2, sort_keys=True)
+        f.write("\n")
+    os.replace(path + ".tmp", path)
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Бенчмарк zbx_settings.py на заглушке Zabbix API.")
+    p.add_argument("--hosts", default=DEFAULT_SIZES,
+                   help=f"размеры синтетического инвентаря через запятую (по умолчанию {DEFAULT_SIZES})")
+    p.add_argument("--latency", type=float, default=0.0, help="задержка каждого HTTP-запроса, секунды")
+    p.add_argument("--call-latency", type=float, default=0.0,
+                   help="задержка каждого вызова API (в том числе внутри batch), секунды")
+    p.add_argument("--fail-rate", type=float, default=0.0, help="доля HTTP-запросов, на которые отвечать 503")
+    p.add_argument("--concurrency", type=int, help="ZBX_CONCURRENCY для zbx_settings.py")
+    p.add_argument("--json", help="записать результаты в JSON-файл")
+    p.add_argument("--check", nargs="?", const=BASELINE_FILE,
+                   help="сравнить с базовой линией (по умолчанию bench_baseline.json)")
+    p.add_argument("--tolerance", type=float, default=0.10, help="допустимый рост относительно базовой линии")
+    p.add_argument("--write-baseline", nargs="?", const=BASELINE_FILE, help="записать результаты как базовую линию")
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = []
+    for count in (int(x) for x in args.hosts.split(",") if x.strip()):
+        print(f"⏳  {count} веб-серверов...")
+        results.extend(bench_size(count, args))
+    print()
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.write_baseline:
+        write_baseline(results, args.write_baseline)
+        print(f"\n📝  Базовая линия записана в {args.write_baseline}")
+    if args.check:
+        if args.fail_rate:
+            print("\n⚠️  С --fail-rate число запросов зависит от отказов, сравнение с базовой линией пропущено")
+            return 0
+        problems = check_baseline(results, args.check, args.tolerance) + check_scaling(results)
+        if problems:
+            print("\n❌  Стоимость настройки выросла:")
+            for line in problems:
+                print(f"  {line}")
+            return 1
+        print(f"\n✅  В пределах базовой линии (+{args.tolerance:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
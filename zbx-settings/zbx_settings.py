@@ -1,17 +1,45 @@
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import gzip
+import http.client
+import itertools
 import json
 import os
+import random
+import re
+import signal
 import socket
+import threading
 import time
 import urllib.error
-import urllib.request
+import urllib.parse
 
 API_URL = os.getenv("ZBX_API_URL", "http://zbx-web:8080/api_jsonrpc.php")  # путь к API Zabbix Web
 
 HTTP_TIMEOUT = 15
 HTTP_TIMEOUT_LONG = 60
 API_RETRIES = 8
-API_RETRY_DELAY = 3
+API_RETRY_DELAY = float(os.getenv("ZBX_API_RETRY_DELAY", "3"))  # первая пауза перед повтором вызова API
 API_RETRY_BACKOFF = 1.6
+API_BUDGET = float(os.getenv("ZBX_API_BUDGET", "1800"))  # общий бюджет времени на прогон, секунды (0 — без ограничения)
+BREAKER_THRESHOLD = int(os.getenv("ZBX_BREAKER_THRESHOLD", "5"))  # сколько сбоев транспорта подряд размыкают цепь
+BREAKER_COOLDOWN = float(os.getenv("ZBX_BREAKER_COOLDOWN", "30"))  # сколько секунд вызовы отклоняются сразу
+HEDGE_AFTER = float(os.getenv("ZBX_HEDGE_AFTER", "2"))  # через сколько секунд дублировать медленное чтение (0 — нет)
+API_POOL_SIZE = int(os.getenv("ZBX_API_POOL_SIZE", "4"))  # сколько keep-alive соединений держим открытыми
+API_BATCH_SIZE = int(os.getenv("ZBX_API_BATCH_SIZE", "100"))  # максимум вызовов в одном JSON-RPC batch
+API_PAGE_IDS = int(os.getenv("ZBX_API_PAGE_IDS", "200"))  # сколько hostids/itemids в одном постраничном *.get
+API_PAGE_LIMIT = int(os.getenv("ZBX_API_PAGE_LIMIT", "10000"))  # максимум объектов в одном ответе *.get
+MASS_CHUNK = int(os.getenv("ZBX_MASS_CHUNK", "500"))  # максимум объектов в одном массовом *.create/*.update
+CONCURRENCY = int(os.getenv("ZBX_CONCURRENCY", "4"))  # сколько шагов настройки выполняется параллельно
+RECONCILE_INTERVAL = float(os.getenv("ZBX_RECONCILE_INTERVAL", "0"))  # период проверки дрейфа, секунды; 0 — один проход
+RECONCILE_FULL_EVERY = int(os.getenv("ZBX_RECONCILE_FULL_EVERY", "12"))  # полная сверка раз в N проверок (0 — только по дрейфу)
+METRICS_DIR = os.getenv("ZBX_METRICS_DIR", ".")  # куда писать отчёт о вызовах API (JSON и Prometheus textfile)
+RECORD_FILE = os.getenv("ZBX_RECORD", "")  # записывать запросы и ответы API в файл (.jsonl или .jsonl.gz)
+REPLAY_FILE = os.getenv("ZBX_REPLAY", "")  # отвечать на запросы из записанного файла вместо Zabbix
+REPLAY_LATENCY = float(os.getenv("ZBX_REPLAY_LATENCY", "0"))  # множитель записанных задержек: 0 — без пауз, 1 — как было
 socket.setdefaulttimeout(HTTP_TIMEOUT)
 
 ITEM_TYPE_SNMP_AGENT = 20
@@ -26,14 +54,19 @@ LONG_METHODS = {
 
 ZBX_USER = os.getenv("ZBX_USER")
 ZBX_PASS = os.getenv("ZBX_PASS")
+ZBX_API_TOKEN = os.getenv("ZBX_API_TOKEN", "")  # заранее выпущенный API-токен Zabbix: вход по логину не нужен
+# файл с кэшем сессии user.login между запусками (пусто — не кэшировать)
+SESSION_FILE = os.path.expanduser(os.getenv("ZBX_SESSION_FILE", "~/.cache/zbx_settings/session.json"))
 ZBX_LANG = os.getenv("ZBX_LANG")
 
 SNMPV3_USER = "zabbix"
 SNMP_AUTH_PASS = os.getenv("SNMP_AUTH_PASS", "")
 SNMP_PRIV_PASS = os.getenv("SNMP_PRIV_PASS", "")
 
-WAIT_TIMEOUT = int(os.getenv("WAIT_TIMEOUT", "600"))
-WAIT_INTERVAL = int(os.getenv("WAIT_INTERVAL", "5"))
+WAIT_TIMEOUT = int(os.getenv("WAIT_TIMEOUT", "600"))  # общий срок ожидания готовности Zabbix
+WAIT_INTERVAL = float(os.getenv("WAIT_INTERVAL", "5"))  # максимальная пауза между пробами
+WAIT_INITIAL_INTERVAL = float(os.getenv("WAIT_INITIAL_INTERVAL", "0.2"))  # первая пауза между пробами
+PROBE_TIMEOUT = float(os.getenv("ZBX_PROBE_TIMEOUT", "3"))  # таймаут одной пробы (без повторов)
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
@@ -43,153 +76,1785 @@ PREPROC_CHANGE_PER_SECOND = 10
 GROUP_NAME = "Linux servers"
 TEMPLATE_LINUX_AGENT = "Linux by Zabbix agent"
 TEMPLATE_SERVER_HEALTH = "Zabbix server health"
+TEMPLATE_SNMP = "New SNMP"
+SNMP_HOST = "webserver1"  # хост, к которому привязывается SNMP-шаблон
+# Каталоги логов и HTTP-цели monitoring-plugins находит сам (LLD); список URL задаётся на агенте
+# (NGINX_MONITOR_HTTP_TARGETS) и проверяется одним опросом nginx.check[http_multi]
+PLUGIN_LOG_ROOT = "/var/log/remote"
+PLUGIN_ACCESS_ROOT = "/var/log/web"  # тома /var/log веб-серверов на monitoring-plugins: <host>/nginx/access.log
+PLUGIN_DISCOVERY_DELAY = "10m"  # как часто агент ищет новые каталоги логов и HTTP-цели
+HTTP_SLOW = float(os.getenv("ZBX_HTTP_SLOW", "1"))  # порог среднего времени ответа веб-сервера за 5 минут, секунды
 
 PROXY_NAME = os.getenv("ZBX_PROXY_NAME", "zbx-proxy-1")
 
-HOSTS = [
+# Файл инвентаря веб-серверов (CSV или JSON lines); без него используется встроенный список WEBSERVERS
+INVENTORY_FILE = os.getenv("ZBX_INVENTORY")
+INVENTORY_CHUNK = int(os.getenv("ZBX_INVENTORY_CHUNK", "100"))  # сколько хостов инвентаря обрабатываем за раз
+
+WEBSERVERS = [
     {"host": "webserver1", "dns": "webserver1", "port": "10050", "templates": [TEMPLATE_LINUX_AGENT]},
     {"host": "webserver2", "dns": "webserver2", "port": "10050", "templates": [TEMPLATE_LINUX_AGENT]},
     {"host": "webserver3", "dns": "webserver3", "port": "10050", "templates": [TEMPLATE_LINUX_AGENT]},
     {"host": "webserver4", "dns": "webserver4", "port": "10050", "templates": [TEMPLATE_LINUX_AGENT]},
+]
+
+INFRA_HOSTS = [
     {"host": "log-srv", "dns": "log-srv", "port": "10050", "templates": []},
     {"host": "monitoring-plugins", "dns": "monitoring-plugins", "port": "10050", "templates": []},
 ]
 
-# На хосте log-srv создаем элементы данных и триггеры для webserver1/2
-LOG_ITEMS = [
-    {
-        "name": 'Log webserver1',
-        "key_": 'logrt["/var/log/remote/webserver1/syslog.log","LAB-TEST|ERROR|CRITICAL",,,skip]',
-        "delay": "1m",
-        "trigger_name": "Trigger for webserver1 logs",
-        "trigger_expr": 'count(/log-srv/logrt["/var/log/remote/webserver1/syslog.log","LAB-TEST|ERROR|CRITICAL",,,skip],1m)>0'
-    },
-    {
-        "name": 'Log webserver2',
-        "key_": 'logrt["/var/log/remote/webserver2/syslog.log","LAB-TEST|ERROR|CRITICAL",,,skip]',
-        "delay": "1m",
-        "trigger_name": "Trigger for webserver2 logs",
-        "trigger_expr": 'count(/log-srv/logrt["/var/log/remote/webserver2/syslog.log","LAB-TEST|ERROR|CRITICAL",,,skip],1m)>0'
-    },
-    {
-        "name": 'Log webserver3',
-        "key_": 'logrt["/var/log/remote/webserver3/syslog.log","LAB-TEST|ERROR|CRITICAL",,,skip]',
-        "delay": "1m",
-        "trigger_name": "Trigger for webserver3 logs",
-        "trigger_expr": 'count(/log-srv/logrt["/var/log/remote/webserver3/syslog.log","LAB-TEST|ERROR|CRITICAL",,,skip],1m)>0'
-    },
-    {
-        "name": 'Log webserver4',
-        "key_": 'logrt["/var/log/remote/webserver4/syslog.log","LAB-TEST|ERROR|CRITICAL",,,skip]',
+HOSTS = WEBSERVERS + INFRA_HOSTS
+
+LOG_PATTERN = "LAB-TEST|ERROR|CRITICAL"
+LOGRT_KEY_PREFIX = 'logrt["/var/log/remote/'  # начало ключей logrt на log-srv, дальше — <host>/syslog.log
+# logrt — совпавшие строки пересылает на сервер активный агент log-srv (элемент logrt на каждый веб-сервер);
+# scanner — monitoring-plugins сам читает /var/log/remote одним опросом nginx.check[syslog_scan]
+# и отдаёт только счётчики строк по уровням и несколько последних строк
+LOG_MODE = os.getenv("ZBX_LOG_MODE", "logrt")  # по умолчанию для --log-mode; окончательно задаёт set_log_mode()
+LOG_MODES = ("logrt", "scanner")
+LOG_HOST = None  # хост элементов данных и триггеров логов; задаёт set_log_mode() в main()
+LOG_LEVELS = ("critical", "error", "test")  # уровни syslog_scan (NGINX_MONITOR_SYSLOG_PATTERNS на агенте)
+SYSLOG_SCAN_KEY = f"nginx.check[syslog_scan,{PLUGIN_LOG_ROOT}]"
+
+
+def set_log_mode(mode):
+    """Выбирает режим логов и хост их элементов данных и триггеров (log-srv или monitoring-plugins)."""
+    global LOG_MODE, LOG_HOST
+    if mode not in LOG_MODES:
+        raise ValueError(f"ZBX_LOG_MODE={mode!r}: ожидается одно из {', '.join(LOG_MODES)}")
+    LOG_MODE = mode
+    LOG_HOST = "monitoring-plugins" if mode == "scanner" else "log-srv"
+
+
+def log_item_for(host):
+    """Элемент данных и триггер на log-srv для логов веб-сервера host."""
+    key_ = f'{LOGRT_KEY_PREFIX}{host}/syslog.log","{LOG_PATTERN}",,,skip]'
+    return {
+        "name": f"Log {host}",
+        "key_": key_,
         "delay": "1m",
-        "trigger_name": "Trigger for webserver4 logs",
-        "trigger_expr": 'count(/log-srv/logrt["/var/log/remote/webserver4/syslog.log","LAB-TEST|ERROR|CRITICAL",,,skip],1m)>0'
-    },
-]
+        "trigger_name": f"Trigger for {host} logs",
+        "trigger_expr": f"count(/log-srv/{key_},1m)>0",
+    }
+
+
+# На хосте log-srv создаем элементы данных и триггеры для webserver1..4
+LOG_ITEMS = [log_item_for(h["host"]) for h in WEBSERVERS]
 
 LOG_TRIGGER_ACTION_NAME = "Send webserver1..4 LOG problems to Telegram"
-LOG_TRIGGER_NAMES = [
-    "Trigger for webserver1 logs",
-    "Trigger for webserver2 logs",
-    "Trigger for webserver3 logs",
-    "Trigger for webserver4 logs",
-]
+LOG_TRIGGER_NAMES = [it["trigger_name"] for it in LOG_ITEMS]
+
+
+def _inventory_row(row):
+    """Приводит строку инвентаря к виду элементов WEBSERVERS (templates в CSV — через «;»)."""
+    host = (row.get("host") or "").strip()
+    if not host:
+        raise ValueError(f"В строке инвентаря нет host: {row}")
+    templates = row.get("templates")
+    if templates is None or templates == "":
+        templates = [TEMPLATE_LINUX_AGENT]
+    elif isinstance(templates, str):
+        templates = [t.strip() for t in templates.split(";") if t.strip()]
+    return {
+        "host": host,
+        "dns": (row.get("dns") or host).strip(),
+        "port": str(row.get("port") or "10050").strip(),
+        "templates": list(templates),
+    }
+
+
+def read_inventory(path):
+    """
+    Построчно читает инвентарь веб-серверов из CSV (с заголовком host,dns,port,templates)
+    или JSON lines (по объекту на строку). Файл не загружается в память целиком.
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.lower().endswith(".csv"):
+            for row in csv.DictReader(f):
+                yield _inventory_row(row)
+        else:
+            for n, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError as e:
+                    raise ValueError(f"{path}:{n}: некорректный JSON: {e}") from None
+                yield _inventory_row(row)
+
+
+def iter_webservers():
+    """Веб-серверы из ZBX_INVENTORY или встроенного списка WEBSERVERS."""
+    if INVENTORY_FILE:
+        yield from read_inventory(INVENTORY_FILE)
+    else:
+        yield from WEBSERVERS
+
+
+def chunked(iterable, size):
+    """Разбивает поток на списки не длиннее size."""
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, max(1, size)))
+        if not chunk:
+            return
+        yield chunk
 
 # Номера типов в Zabbix API
 ITEM_TYPE_ZABBIX_AGENT_ACTIVE = 7
 VALUE_TYPE_LOG = 2
 
 ITEM_TYPE_ZABBIX_AGENT = 0
+ITEM_TYPE_DEPENDENT = 18
 VALUE_TYPE_FLOAT = 0
 VALUE_TYPE_UINT = 3
+VALUE_TYPE_TEXT = 4
+PREPROC_JSONPATH = 12
+ERRH_DISCARD = 1
+ERRH_SET_VALUE = 2
+
+# время ответа по фазам из опроса http_multi: (поле JSON, название, тип значения, единицы)
+PLUGIN_HTTP_TIMINGS = (
+    ("dns", "DNS lookup time", VALUE_TYPE_FLOAT, "s"),
+    ("connect", "TCP connect time", VALUE_TYPE_FLOAT, "s"),
+    ("ttfb", "Time to first byte", VALUE_TYPE_FLOAT, "s"),
+    ("total", "Total response time", VALUE_TYPE_FLOAT, "s"),
+    ("size", "Response size", VALUE_TYPE_UINT, "B"),
+)
+
+# KPI трафика из опроса access_stats: (JSONPath, ключ, название, тип значения, единицы)
+PLUGIN_ACCESS_KPIS = (
+    ("$.rps", "rps", "Requests per second", VALUE_TYPE_FLOAT, "rps"),
+    ("$.status['2xx']", "2xx", "Responses 2xx", VALUE_TYPE_UINT, ""),
+    ("$.status['3xx']", "3xx", "Responses 3xx", VALUE_TYPE_UINT, ""),
+    ("$.status['4xx']", "4xx", "Responses 4xx", VALUE_TYPE_UINT, ""),
+    ("$.status['5xx']", "5xx", "Responses 5xx", VALUE_TYPE_UINT, ""),
+    ("$.bytes", "bytes", "Bytes sent", VALUE_TYPE_UINT, "B"),
+    ("$.request_time.p50", "request_time.p50", "Request time p50", VALUE_TYPE_FLOAT, "s"),
+    ("$.request_time.p90", "request_time.p90", "Request time p90", VALUE_TYPE_FLOAT, "s"),
+    ("$.request_time.p99", "request_time.p99", "Request time p99", VALUE_TYPE_FLOAT, "s"),
+    ("$.upstream_time.p50", "upstream_time.p50", "Upstream time p50", VALUE_TYPE_FLOAT, "s"),
+    ("$.upstream_time.p90", "upstream_time.p90", "Upstream time p90", VALUE_TYPE_FLOAT, "s"),
+    ("$.upstream_time.p99", "upstream_time.p99", "Upstream time p99", VALUE_TYPE_FLOAT, "s"),
+)
+
+# Границы корзин гистограммы длительности вызовов API, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class ApiMetrics:
+    """
+    Статистика вызовов Zabbix API за прогон: число запросов, ошибки, длительности,
+    объём переданных данных, повторы и время ожидания между ними — по этапам настройки
+    и методам. Этап задаётся для текущего потока через stage().
+    """
 
-req_id = 0
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._local = threading.local()
+        self.started = time.monotonic()
+        self.methods = {}  # (stage, method) -> счётчики
+        self.stages = {}  # stage -> суммарное время шагов, секунды
+
+    def _entry(self, method):
+        key = (self.current_stage(), method)
+        e = self.methods.get(key)
+        if e is None:
+            e = self.methods[key] = {"requests": 0, "errors": 0, "latencies": [], "bytes_sent": 0,
+                                     "bytes_received": 0, "retries": 0, "backoff_seconds": 0.0, "batched_calls": 0,
+                                     "hedges": 0}
+        return e
+
+    def current_stage(self):
+        return getattr(self._local, "stage", "main")
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Относит вызовы API текущего потока к этапу name и учитывает его длительность."""
+        prev = self.current_stage()
+        self._local.stage = name
+        t0 = time.monotonic()
+        try:
+            yield
+        finally:
+            self._local.stage = prev
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0.0) + time.monotonic() - t0
+
+    def request(self, method, seconds, sent, received, ok=True):
+        """Учитывает один HTTP-запрос к API."""
+        with self.lock:
+            e = self._entry(method)
+            e["requests"] += 1
+            e["errors"] += 0 if ok else 1
+            e["latencies"].append(seconds)
+            e["bytes_sent"] += sent
+            e["bytes_received"] += received
+
+    def batched(self, methods):
+        """Учитывает вызовы, отправленные внутри JSON-RPC batch."""
+        with self.lock:
+            for m in methods:
+                self._entry(m)["batched_calls"] += 1
+
+    def retry(self, method, sleep):
+        """Учитывает повтор вызова и паузу перед ним."""
+        with self.lock:
+            e = self._entry(method)
+            e["retries"] += 1
+            e["backoff_seconds"] += sleep
+
+    def hedge(self, method):
+        """Учитывает дублирующий (hedged) запрос чтения."""
+        with self.lock:
+            self._entry(method)["hedges"] += 1
+
+    @staticmethod
+    def _percentile(values, q):
+        """Перцентиль по ближайшему рангу."""
+        if not values:
+            return 0.0
+        values = sorted(values)
+        return values[min(len(values) - 1, max(0, int(round(q * len(values) + 0.5)) - 1))]
+
+    def report(self):
+        """Сводка в виде словаря (для JSON-отчёта)."""
+        with self.lock:
+            stages = {}
+            for (stage, method), e in sorted(self.methods.items()):
+                lat = e["latencies"]
+                st = stages.setdefault(stage, {"seconds": round(self.stages.get(stage, 0.0), 3), "methods": {}})
+                st["methods"][method] = {
+                    "requests": e["requests"], "errors": e["errors"], "batched_calls": e["batched_calls"],
+                    "latency_p50": round(self._percentile(lat, 0.5), 4),
+                    "latency_p95": round(self._percentile(lat, 0.95), 4),
+                    "latency_max": round(max(lat, default=0.0), 4),
+                    "latency_sum": round(sum(lat), 4),
+                    "bytes_sent": e["bytes_sent"], "bytes_received": e["bytes_received"],
+                    "retries": e["retries"], "backoff_seconds": round(e["backoff_seconds"], 3),
+                    "hedges": e["hedges"],
+                }
+            for stage, seconds in self.stages.items():
+                stages.setdefault(stage, {"seconds": round(seconds, 3), "methods": {}})
+            return {"run_seconds": round(time.monotonic() - self.started, 3),
+                    "requests": sum(e["requests"] for e in self.methods.values()),
+                    "stages": stages}
+
+    def prometheus(self):
+        """Метрики в текстовом формате Prometheus (для node_exporter textfile collector)."""
+        def esc(v):
+            return str(v).replace("\\", "\\\\").replace('"', '\\"')
+
+        lines = []
+
+        def metric(name, kind, help_, samples):
+            lines.append(f"# HELP {name} {help_}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lab = ",".join(f'{k}="{esc(v)}"' for k, v in labels.items())
+                lines.append(f"{name}{{{lab}}} {value}" if lab else f"{name} {value}")
+
+        with self.lock:
+            items = sorted(self.methods.items())
+            by = [({"stage": st, "method": m}, e) for (st, m), e in items]
+            metric("zbx_settings_api_requests_total", "counter", "HTTP requests to Zabbix API.",
+                   [(l, e["requests"]) for l, e in by])
+            metric("zbx_settings_api_errors_total", "counter", "Failed HTTP requests to Zabbix API.",
+                   [(l, e["errors"]) for l, e in by])
+            metric("zbx_settings_api_batched_calls_total", "counter", "API calls sent inside JSON-RPC batches.",
+                   [(l, e["batched_calls"]) for l, e in by])
+            hist = []
+            for l, e in by:
+                for le in LATENCY_BUCKETS:
+                    hist.append(({**l, "le": le}, sum(1 for x in e["latencies"] if x <= le)))
+                hist.append(({**l, "le": "+Inf"}, len(e["latencies"])))
+            lines.append("# HELP zbx_settings_api_request_duration_seconds Zabbix API request latency.")
+            lines.append("# TYPE zbx_settings_api_request_duration_seconds histogram")
+            for labels, value in hist:
+                lab = ",".join(f'{k}="{esc(v)}"' for k, v in labels.items())
+                lines.append(f"zbx_settings_api_request_duration_seconds_bucket{{{lab}}} {value}")
+            for l, e in by:
+                lab = ",".join(f'{k}="{esc(v)}"' for k, v in l.items())
+                lines.append(f"zbx_settings_api_request_duration_seconds_sum{{{lab}}} {sum(e['latencies']):.6f}")
+                lines.append(f"zbx_settings_api_request_duration_seconds_count{{{lab}}} {len(e['latencies'])}")
+            metric("zbx_settings_api_bytes_sent_total", "counter", "Request bytes sent to Zabbix API.",
+                   [(l, e["bytes_sent"]) for l, e in by])
+            metric("zbx_settings_api_bytes_received_total", "counter", "Response bytes received from Zabbix API.",
+                   [(l, e["bytes_received"]) for l, e in by])
+            metric("zbx_settings_api_retries_total", "counter", "Retried Zabbix API requests.",
+                   [(l, e["retries"]) for l, e in by])
+            metric("zbx_settings_api_backoff_seconds_total", "counter", "Time spent waiting between retries.",
+                   [(l, f"{e['backoff_seconds']:.3f}") for l, e in by])
+            metric("zbx_settings_api_hedges_total", "counter", "Duplicate requests sent for slow reads.",
+                   [(l, e["hedges"]) for l, e in by])
+            metric("zbx_settings_stage_duration_seconds", "gauge", "Wall time of provisioning stages.",
+                   [({"stage": st}, f"{sec:.3f}") for st, sec in sorted(self.stages.items())])
+            metric("zbx_settings_run_duration_seconds", "gauge", "Wall time of the provisioning run.",
+                   [({}, f"{time.monotonic() - self.started:.3f}")])
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory=METRICS_DIR):
+        """Пишет zbx_settings_metrics.json и zbx_settings.prom (атомарно, через временный файл)."""
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for name, data in (("zbx_settings_metrics.json", json.dumps(self.report(), ensure_ascii=False, indent=2)),
+                           ("zbx_settings.prom", self.prometheus())):
+            path = os.path.join(directory, name)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+            paths.append(path)
+        return paths
+
+    def print_summary(self, top=10):
+        """Печатает самые затратные по суммарному времени методы."""
+        rows = []
+        for stage, st in self.report()["stages"].items():
+            for method, m in st["methods"].items():
+                rows.append((m["latency_sum"], stage, method, m))
+        rows.sort(reverse=True)
+        print(f"\n⏱️  Вызовы API: топ-{top} по суммарному времени")
+        for total, stage, method, m in rows[:top]:
+            print(f"  {stage:<24} {method:<22} n={m['requests']:<5} sum={total:.2f}s p50={m['latency_p50']:.3f}s "
+                  f"p95={m['latency_p95']:.3f}s max={m['latency_max']:.3f}s retries={m['retries']}")
+
+
+METRICS = ApiMetrics()
+
+
+class ZabbixClient:
+    """
+    HTTP/1.1 клиент Zabbix API с пулом keep-alive соединений.
 
+    Соединения переиспользуются между вызовами, поэтому TCP/TLS-рукопожатие выполняется
+    один раз на соединение, а не на каждый метод API. Поддерживает gzip-ответы и
+    прозрачно переподключается, если сервер закрыл простаивающий сокет: сам повторяет запрос,
+    только если тот не был отправлен или это чтение. Остальное решает _post_with_retries
+    (запись могла выполниться на сервере).
+    """
 
-def wait_for_api(timeout=600, interval=5):
-    """Ждёт, пока фронтенд Zabbix начнёт отвечать на apiinfo.version."""
-    print(f"⌛  Жду ответа от Zabbix API по адресу: {API_URL}")
-    deadline = time.time() + timeout
+    hedging = True  # медленные чтения можно дублировать на другом соединении пула
+
+    def __init__(self, url=API_URL, pool_size=API_POOL_SIZE):
+        u = urllib.parse.urlsplit(url)
+        self.url = url
+        self.https = u.scheme == "https"
+        self.host = u.hostname
+        self.port = u.port or (443 if self.https else 80)
+        self.path = (u.path or "/") + (f"?{u.query}" if u.query else "")
+        self.pool_size = max(1, pool_size)
+        self._idle = []
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def next_id(self):
+        """Возвращает следующий id JSON-RPC запроса."""
+        with self._lock:
+            return next(self._ids)
+
+    def _acquire(self, timeout):
+        """Берёт свободное соединение из пула или открывает новое. Возвращает (conn, reused)."""
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            return cls(self.host, self.port, timeout=timeout), False
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, True
+
+    def _release(self, conn):
+        """Возвращает соединение в пул (лишние закрываются)."""
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Закрывает все простаивающие соединения пула."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def post(self, payload, timeout=HTTP_TIMEOUT, token=None):
+        """Отправляет JSON-RPC тело (token — в заголовке Authorization: Bearer) и возвращает JSON-ответ."""
+        data = json.dumps(payload).encode()
+        label = "batch" if isinstance(payload, list) else payload.get("method", "?")
+        t0 = time.monotonic()
+        headers = {
+            "Content-Type": "application/json-rpc",
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip",
+            "Connection": "keep-alive",
+        }
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        while True:
+            conn, reused = self._acquire(timeout)
+            sent = False
+            try:
+                conn.request("POST", self.path, body=data, headers=headers)
+                sent = True
+                r = conn.getresponse()
+                raw = r.read()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                conn.close()
+                if reused and (not sent or _is_read_only(payload)):
+                    # сервер закрыл простаивающий keep-alive сокет — повторяем на новом соединении
+                    continue
+                METRICS.request(label, time.monotonic() - t0, len(data), 0, ok=False)
+                raise
+            except Exception:
+                conn.close()
+                METRICS.request(label, time.monotonic() - t0, len(data), 0, ok=False)
+                raise
+            break
+
+        if r.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+
+        METRICS.request(label, time.monotonic() - t0, len(data), len(raw), ok=r.status < 400)
+        if r.status >= 400:
+            raise urllib.error.HTTPError(self.url, r.status, r.reason, r.headers, None)
+        if (r.getheader("Content-Encoding") or "").lower() == "gzip":
+            raw = gzip.decompress(raw)
+        return json.loads(raw.decode())
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Возвращает общий для процесса транспорт API (по умолчанию ZabbixClient, создаётся при первом вызове)."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = ZabbixClient(API_URL)
+        return _client
+
+
+def set_client(client):
+    """Подменяет общий транспорт API (нужны методы post(payload, timeout, token), next_id() и close())."""
+    global _client
+    with _client_lock:
+        _client = client
+
+
+def _open_calls_file(path, mode):
+    """Открывает файл записи вызовов; .gz — со сжатием."""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def _redact(payload):
+    """Копия запроса без id и секретов (пароль, сессия, токен) — то, что пишется в файл и по чему ищется ответ."""
+    if isinstance(payload, list):
+        return [_redact(p) for p in payload]
+    params = payload.get("params")
+    if isinstance(params, dict):
+        params = {k: "***" if k in ("password", "sessionid", "token") else v for k, v in params.items()}
+    return {"method": payload.get("method"), "params": params}
+
+
+def _call_key(payload):
+    return json.dumps(_redact(payload), sort_keys=True, ensure_ascii=False)
+
+
+def _ids(payload):
+    return [p.get("id") for p in payload] if isinstance(payload, list) else [payload.get("id")]
+
+
+class RecordingTransport:
+    """
+    Обёртка над транспортом, которая записывает каждую пару запрос/ответ (JSON lines) с временем
+    от начала записи и длительностью. Ошибки транспорта тоже записываются, чтобы воспроизвести повторы.
+    """
+
+    hedging = True
+
+    def __init__(self, inner, path):
+        self.inner = inner
+        self.path = path
+        self._lock = threading.Lock()
+        self._t0 = time.monotonic()
+        self._f = _open_calls_file(path, "w")
+        self._write({"version": 1, "url": getattr(inner, "url", "")})
+
+    def _write(self, entry):
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            self._f.write(line + "\n")
+
+    def next_id(self):
+        return self.inner.next_id()
+
+    def post(self, payload, timeout=HTTP_TIMEOUT, token=None):
+        t = time.monotonic()
+        entry = {"t": round(t - self._t0, 4), "req": _redact(payload), "ids": _ids(payload)}
+        try:
+            resp = self.inner.post(payload, timeout=timeout, token=token)
+        except (urllib.error.HTTPError, urllib.error.URLError, http.client.HTTPException, OSError) as e:
+            entry["dt"] = round(time.monotonic() - t, 4)
+            entry["err"] = {"status": getattr(e, "code", None), "message": str(e)}
+            self._write(entry)
+            raise
+        entry["dt"] = round(time.monotonic() - t, 4)
+        entry["resp"] = resp
+        self._write(entry)
+        return resp
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+        self.inner.close()
+        print(f"📼  Вызовы API записаны в {self.path}")
+
+
+class ReplayTransport:
+    """
+    Транспорт, который отвечает из файла RecordingTransport, не обращаясь к Zabbix.
+
+    Ответ ищется по методу и параметрам (без id и auth), одинаковые запросы получают записанные ответы
+    по порядку — поэтому параллельные шаги могут идти в другом порядке, чем при записи. Запрос, которого
+    нет в записи, — ошибка (новый лишний вызов); неиспользованные записи показываются в summary().
+    latency — множитель записанных задержек (0 — отвечать сразу, 1 — как при записи).
+    """
+
+    def __init__(self, path, latency=REPLAY_LATENCY):
+        self.path = path
+        self.url = f"replay:{path}"
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._entries = collections.defaultdict(collections.deque)
+        self.served = 0
+        self.missed = []
+        with _open_calls_file(path, "r") as f:
+            for line in f:
+                entry = json.loads(line)
+                if "req" in entry:
+                    self._entries[_call_key(entry["req"])].append(entry)
+
+    def next_id(self):
+        with self._lock:
+            return next(self._ids)
+
+    def post(self, payload, timeout=HTTP_TIMEOUT, token=None):
+        key = _call_key(payload)
+        label = "batch" if isinstance(payload, list) else payload.get("method", "?")
+        with self._lock:
+            queue = self._entries.get(key)
+            entry = queue.popleft() if queue else None
+            if entry is None:
+                self.missed.append(label)
+            else:
+                self.served += 1
+        if entry is None:
+            raise RuntimeError(f"В записи {self.path} нет ответа на {label}: {key[:300]}")
+        if self.latency:
+            time.sleep(entry.get("dt", 0) * self.latency)
+        sent = len(json.dumps(payload))
+        if "err" in entry:
+            METRICS.request(label, entry.get("dt", 0), sent, 0, ok=False)
+            err = entry["err"]
+            if err.get("status"):
+                raise urllib.error.HTTPError(self.url, err["status"], err["message"], None, None)
+            raise ConnectionError(err["message"])
+        resp = entry["resp"]
+        METRICS.request(label, entry.get("dt", 0), sent, len(json.dumps(resp)), ok=True)
+        # id ответов — как у текущих запросов, а не как при записи
+        new_ids = dict(zip(entry["ids"], _ids(payload)))
+        if isinstance(resp, list):
+            return [{**r, "id": new_ids.get(r.get("id"), r.get("id"))} for r in resp]
+        return {**resp, "id": new_ids.get(resp.get("id"), resp.get("id"))}
+
+    def summary(self):
+        """Печатает, сколько ответов выдано, и вызовы, которых не было в записи или которые не понадобились."""
+        unused = collections.Counter()
+        for queue in self._entries.values():
+            for entry in queue:
+                req = entry["req"]
+                unused["batch" if isinstance(req, list) else req["method"]] += 1
+        print(f"📼  Воспроизведение {self.path}: выдано ответов {self.served}, "
+              f"нет в записи {len(self.missed)}, не понадобилось {sum(unused.values())}")
+        for method, n in collections.Counter(self.missed).most_common():
+            print(f"  + {method}: {n}")
+        for method, n in unused.most_common():
+            print(f"  - {method}: {n}")
+
+    def close(self):
+        self.summary()
+
+
+def wait_until(what, probe, deadline, interval=WAIT_INTERVAL, initial=WAIT_INITIAL_INTERVAL):
+    """
+    Повторяет probe() до первого успеха или до deadline (time.monotonic()).
+
+    Пауза между пробами растёт экспоненциально от initial до interval со случайным
+    разбросом (full jitter), поэтому готовность замечается почти сразу, а во время
+    долгого старта сервис не засыпается запросами. Возвращает результат probe().
+    """
+    delay = initial
     last_err = None
-    while time.time() < deadline:
+    while True:
         try:
-            v = call_api("apiinfo.version", {})
-            print(f"✅  Успешное подключение к Zabbix API! Версия: {v}\n")
-            return
+            return probe()
         except Exception as e:
             last_err = e
-            time.sleep(interval)
-    raise RuntimeError(f"Zabbix API не поднялся за {timeout}с: {last_err}")
+        left = deadline - time.monotonic()
+        if left <= 0:
+            raise RuntimeError(f"{what}: не дождались готовности: {last_err}")
+        time.sleep(min(random.uniform(0, delay), left))
+        delay = min(delay * 2, interval)
+
+
+def probe_api(method, params, token=None):
+    """Одна проба API: короткий таймаут и без повторов внутри call_api."""
+    return call_api(method, params, token, retries=1, timeout=PROBE_TIMEOUT, guarded=False)
 
 
-def wait_for_login(user, password, timeout=600, interval=5):
+def wait_for_api(deadline, interval=WAIT_INTERVAL):
+    """Ждёт, пока фронтенд Zabbix начнёт отвечать на apiinfo.version."""
+    print(f"⌛  Жду ответа от Zabbix API по адресу: {API_URL}")
+    v = wait_until("apiinfo.version", lambda: probe_api("apiinfo.version", {}), deadline, interval)
+    print(f"✅  Успешное подключение к Zabbix API! Версия: {v}\n")
+
+
+def wait_for_login(user, password, deadline, interval=WAIT_INTERVAL):
     """Ждет, пока авторизация Zabbix API начнет отвечать (user.login)"""
     print("⌛  Жду ответа от сервиса авторизации Zabbix API...")
-    deadline = time.time() + timeout
-    last_err = None
-    while time.time() < deadline:
+    token = wait_until("user.login", lambda: probe_api("user.login", {"username": user, "password": password}),
+                       deadline, interval)
+    print("✅  Авторизация Zabbix API готова.\n")
+    return token
+
+
+def _read_session(user):
+    """Сессия из SESSION_FILE, если она выпущена для того же API и пользователя."""
+    if not SESSION_FILE:
+        return None
+    try:
+        with open(SESSION_FILE, encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get("url") != API_URL or cached.get("user") != user:
+        return None
+    return cached.get("sessionid")
+
+
+def _save_session(user, sessionid):
+    """Сохраняет сессию в SESSION_FILE (права 0600, запись через временный файл)."""
+    if not SESSION_FILE:
+        return
+    try:
+        os.makedirs(os.path.dirname(SESSION_FILE) or ".", mode=0o700, exist_ok=True)
+        tmp = SESSION_FILE + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"url": API_URL, "user": user, "sessionid": sessionid}, f)
+        os.replace(tmp, SESSION_FILE)
+    except OSError as e:
+        print(f"⚠️  Не удалось сохранить сессию в {SESSION_FILE}: {e}")
+
+
+def obtain_token(user, password, deadline, interval=WAIT_INTERVAL):
+    """
+    Возвращает (токен, имя пользователя) для вызовов API.
+
+    ZBX_API_TOKEN используется как есть (после проверки user.checkAuthentication). Иначе сначала
+    пробуется сессия из SESSION_FILE — её проверка дешевле входа и не создаёт новую сессию на сервере;
+    если она недействительна, выполняется user.login, а новая сессия сохраняется в файл.
+    """
+    if ZBX_API_TOKEN:
+        print("⌛  Проверяю API-токен Zabbix...")
+        info = wait_until("API token", lambda: probe_api("user.checkAuthentication", {"token": ZBX_API_TOKEN}),
+                          deadline, interval)
+        print(f"✅  API-токен действителен (пользователь {info.get('username')}).\n")
+        return ZBX_API_TOKEN, info.get("username") or user
+
+    sessionid = _read_session(user)
+    if sessionid:
         try:
-            token = login(user, password)
-            print("✅  Авторизация Zabbix API готова.\n")
-            return token
-        except Exception as e:
-            last_err = e
-            time.sleep(interval)
-    raise RuntimeError(f"user.login так и не ответил за {timeout}с: {last_err}")
+            probe_api("user.checkAuthentication", {"sessionid": sessionid})
+            print(f"✅  Использую сохранённую сессию Zabbix API ({SESSION_FILE}).\n")
+            return sessionid, user
+        except RuntimeError as e:
+            print(f"ℹ️  Сохранённая сессия не подошла ({e}), выполняю вход.")
 
+    token = wait_for_login(user, password, deadline, interval)
+    _save_session(user, token)
+    return token, user
 
-def wait_for_write_ready(token, timeout=900, interval=5):
+
+def check_write_ready(token):
+    """
+    Проверяет готовность Zabbix к записям без изменения конфигурации.
+    Нужны доступная БД (чтение host groups) и активная нода zabbix-server (hanode.get).
+    """
+    probe_api("hostgroup.get", {"output": ["groupid"], "limit": 1}, token)
+    nodes = probe_api("hanode.get", {"output": ["name", "status"]}, token)
+    if nodes and not any(str(n["status"]) == "3" for n in nodes):  # 3 = active
+        raise RuntimeError(f"нет активной ноды zabbix-server: {nodes}")
+
+
+def wait_for_write_ready(token, deadline, interval=WAIT_INTERVAL):
     """Ждет готовность Zabbix к записям"""
     print("⌛  Проверяю готовность Zabbix к записям...")
-    deadline = time.time() + timeout
-    last_err = None
-    while time.time() < deadline:
-        probe = f"__probe_{int(time.time())}"
-        try:
-            res = call_api("hostgroup.create", {"name": probe}, token)
-            gid = res["groupids"][0]
-            # сразу же удаляем
-            call_api("hostgroup.delete", [gid], token)
-            print("✅  API готов к операциям записи.\n")
-            return
-        except Exception as e:
-            last_err = e
-            time.sleep(interval)
-    raise RuntimeError(f"Проверка на запись не прошла за {timeout}с: {last_err}")
+    wait_until("write readiness", lambda: check_write_ready(token), deadline, interval)
+    print("✅  API готов к операциям записи.\n")
 
 
-def call_api(method, params, token=None):
-    """Вызов метода Zabbix API."""
-    global req_id
-    last_err = None
-    timeout = HTTP_TIMEOUT_LONG if method in LONG_METHODS else HTTP_TIMEOUT
+class RunBudget:
+    """
+    Общий срок для всех вызовов API за прогон: таймаут каждой попытки и пауза перед повтором
+    не выходят за него, а после его окончания вызовы сразу завершаются ошибкой.
+    """
 
-    for attempt in range(1, API_RETRIES + 1):
-        req_id += 1
-        body = {"jsonrpc": "2.0", "method": method, "params": params or {}, "id": req_id}
-        if token:
-            body["auth"] = token
-        data = json.dumps(body).encode()
-        headers = {
-            "Content-Type": "application/json-rpc",
-            "Accept": "application/json",
-            "Connection": "close",
-        }
-        req = urllib.request.Request(API_URL, data=data, headers=headers)
+    def __init__(self):
+        self.deadline = None
+        self.seconds = 0
+
+    def start(self, seconds=API_BUDGET):
+        self.seconds = seconds
+        self.deadline = time.monotonic() + seconds if seconds > 0 else None
+
+    def remaining(self):
+        return float("inf") if self.deadline is None else self.deadline - time.monotonic()
+
+    def clip(self, seconds, label):
+        """Урезает таймаут/паузу до остатка бюджета; если бюджет исчерпан — RuntimeError."""
+        left = self.remaining()
+        if left <= 0:
+            raise RuntimeError(f"API метод '{label}': исчерпан бюджет времени прогона ({self.seconds:.0f}s, "
+                               f"ZBX_API_BUDGET)")
+        return min(seconds, left)
+
+
+class CircuitBreaker:
+    """
+    Предохранитель: после threshold сбоев транспорта подряд вызовы API в течение cooldown секунд
+    отклоняются сразу, без сетевых попыток и пауз. Затем пропускается проба: успех замыкает цепь,
+    сбой снова размыкает её.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def check(self, label):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            left = self.opened_at + self.cooldown - time.monotonic()
+        if left > 0:
+            raise RuntimeError(f"API метод '{label}' не выполнен: Zabbix API недоступен "
+                               f"({self.failures} сбоев подряд), повторная проба через {left:.0f}s")
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    print(f"🔌  Zabbix API: {self.failures} сбоев подряд, вызовы приостановлены на "
+                          f"{self.cooldown:.0f}s")
+                self.opened_at = time.monotonic()
+
+
+BUDGET = RunBudget()
+BREAKER = CircuitBreaker()
+
+TRANSPORT_ERRORS = (urllib.error.HTTPError, urllib.error.URLError, http.client.HTTPException, OSError)
+
+_hedge_pool = None
+_hedge_pool_lock = threading.Lock()
+
+
+def _methods(body):
+    return [b.get("method", "") for b in body] if isinstance(body, list) else [body.get("method", "")]
+
+
+def _is_read_only(body):
+    """Только чтения — запрос можно повторять и дублировать без последствий."""
+    return all(m.endswith(".get") or m == "apiinfo.version" for m in _methods(body))
+
+
+def _is_unsafe(body):
+    """*.create и *.delete нельзя слепо повторять: первая попытка могла выполниться на сервере."""
+    return any(m.endswith((".create", ".delete")) for m in _methods(body))
+
+
+def _not_sent(e):
+    """Ошибка, при которой запрос точно не был обработан сервером."""
+    if isinstance(e, urllib.error.HTTPError):
+        return e.code == 503
+    if isinstance(e, urllib.error.URLError):
+        e = e.reason
+    return isinstance(e, (ConnectionRefusedError, socket.gaierror))
+
+
+def _hedged_post(client, body, timeout, label, token=None):
+    """
+    Чтение с дублированием: если ответа нет за HEDGE_AFTER секунд, тот же запрос отправляется
+    ещё раз по другому соединению пула и берётся первый успешный ответ.
+    """
+    global _hedge_pool
+    if HEDGE_AFTER <= 0 or HEDGE_AFTER >= timeout or not getattr(client, "hedging", False):
+        return client.post(body, timeout=timeout, token=token)
+    with _hedge_pool_lock:
+        if _hedge_pool is None:
+            _hedge_pool = concurrent.futures.ThreadPoolExecutor(max_workers=API_POOL_SIZE * 2,
+                                                                thread_name_prefix="zbx-hedge")
+    first = _hedge_pool.submit(client.post, body, timeout, token)
+    try:
+        return first.result(timeout=HEDGE_AFTER)
+    except concurrent.futures.TimeoutError:
+        pass
+    METRICS.hedge(label)
+    pending = {first, _hedge_pool.submit(client.post, body, timeout, token)}
+    err = None
+    while pending:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for f in done:
+            if f.exception() is None:
+                return f.result()
+            err = err or f.exception()
+    raise err
+
+
+def _post_with_retries(client, body, timeout, label, retries=API_RETRIES, before_retry=None, guarded=True,
+                       token=None):
+    """
+    Отправляет тело запроса с повторами при сетевых ошибках и возвращает JSON-ответ.
+
+    guarded: попытки и паузы ограничены общим бюджетом BUDGET, а при серии сбоев предохранитель
+    BREAKER отклоняет вызов сразу (пробы готовности идут без этих ограничений).
+    Чтения при медленном ответе дублируются (_hedged_post). *.create/*.delete повторяются, только
+    если запрос точно не дошёл до сервера или before_retry(body) проверил, что уже выполнено:
+    он возвращает (новое тело, None) или (тело, готовый ответ).
+    """
+    read_only = _is_read_only(body)
+    unsafe = _is_unsafe(body)
+    last_err = None
+    for attempt in range(1, retries + 1):
+        if attempt > 1 and before_retry:
+            body, done = before_retry(body)
+            if done is not None:
+                return done
+        attempt_timeout = timeout
+        if guarded:
+            BREAKER.check(label)
+            attempt_timeout = BUDGET.clip(timeout, label)
         try:
-            with urllib.request.urlopen(req, timeout=timeout) as r:
-                resp = json.loads(r.read().decode())
-            if "error" in resp:
-                raise RuntimeError(f"API {method} error: {resp['error']}")
-            return resp["result"]
-        except (urllib.error.HTTPError, urllib.error.URLError, TimeoutError, ConnectionError) as e:
+            if read_only and guarded:
+                resp = _hedged_post(client, body, attempt_timeout, label, token)
+            else:
+                resp = client.post(body, timeout=attempt_timeout, token=token)
+        except TRANSPORT_ERRORS as e:
             last_err = e
+            if guarded:
+                BREAKER.failure()
+                BREAKER.check(label)  # цепь разомкнулась — не ждём паузу перед повтором
+            if attempt == retries:
+                break
+            if unsafe and not before_retry and not _not_sent(e):
+                raise RuntimeError(f"API метод '{label}' не повторяется: запрос мог выполниться на сервере: {e}")
             sleep = min(API_RETRY_DELAY * (API_RETRY_BACKOFF ** (attempt - 1)), 30)
+            if guarded:
+                sleep = BUDGET.clip(sleep, label)
+            METRICS.retry(label, sleep)
             print(
-                f"⚠️  API метод '{method}' попытка {attempt}/{API_RETRIES} не удалась: {e}. Повтор через {sleep:.1f}s")
+                f"⚠️  API метод '{label}' попытка {attempt}/{retries} не удалась: {e}. Повтор через {sleep:.1f}s")
             time.sleep(sleep)
+            continue
+        if guarded:
+            BREAKER.success()
+        return resp
+
+    raise RuntimeError(f"API метод '{label}' провалился после {retries} попыток: {last_err}")
+
+
+# Как найти объект, созданный *.create, по естественному ключу: поле id и поля ключа
+CREATE_KEYS = {
+    "hostgroup": ("groupid", ("name",)),
+    "templategroup": ("groupid", ("name",)),
+    "proxy": ("proxyid", ("name",)),
+    "host": ("hostid", ("host",)),
+    "template": ("templateid", ("host",)),
+    "item": ("itemid", ("hostid", "key_")),
+    "trigger": ("triggerid", ("description", "expression")),
+    "usermacro": ("hostmacroid", ("hostid", "macro")),
+    "valuemap": ("valuemapid", ("hostid", "name")),
+    "mediatype": ("mediatypeid", ("name",)),
+    "action": ("actionid", ("name",)),
+    "dashboard": ("dashboardid", ("name",)),
+}
+
+
+class CreateRecovery:
+    """
+    Безопасный повтор *.create после сбоя транспорта: перед повтором объекты ищутся по естественному
+    ключу (CREATE_KEYS), уже созданные не отправляются повторно, а их id подставляются в ответ.
+    """
+
+    def __init__(self, method, params, token):
+        self.kind = method.split(".")[0]
+        self.id_field, self.keys = CREATE_KEYS[self.kind]
+        self.single = not isinstance(params, list)
+        self.objs = [params] if self.single else list(params)
+        self.ids = [None] * len(self.objs)
+        self.token = token
+
+    def _pending(self):
+        return [i for i, oid in enumerate(self.ids) if oid is None]
+
+    def _lookup(self, obj):
+        params = {"output": [self.id_field], "filter": {}}
+        for k in self.keys:
+            if k == "hostid":
+                params["hostids"] = [obj["hostid"]]
+            elif k == "expression":
+                m = re.search(r"\(/([^/]+)/", obj["expression"])
+                if m:
+                    params["filter"]["host"] = m.group(1)
+            else:
+                params["filter"][k] = obj[k]
+        return params
+
+    def before_retry(self, body):
+        pending = self._pending()
+        with ApiBatch(self.token) as batch:
+            queries = [(i, batch.add(f"{self.kind}.get", self._lookup(self.objs[i]))) for i in pending]
+        for i, q in queries:
+            found = q.result()
+            if len(found) == 1:
+                self.ids[i] = found[0][self.id_field]
+        left = self._pending()
+        if len(left) < len(pending):
+            print(f"ℹ️  {self.kind}.create: {len(pending) - len(left)} из {len(pending)} объектов уже созданы "
+                  f"предыдущей попыткой")
+        if not left:
+            return body, {"jsonrpc": "2.0", "result": {self.id_field + "s": []}, "id": body.get("id")}
+        params = self.objs[left[0]] if self.single else [self.objs[i] for i in left]
+        return {**body, "params": params}, None
+
+    def merge(self, resp):
+        """Собирает id в исходном порядке объектов: найденные перед повтором + созданные последней попыткой."""
+        if "error" in resp:
+            return resp
+        created = iter(resp["result"].get(self.id_field + "s", []))
+        for i in self._pending():
+            self.ids[i] = str(next(created))
+        return {**resp, "result": {**resp["result"], self.id_field + "s": list(self.ids)}}
+
+
+def call_api(method, params, token=None, client=None, retries=API_RETRIES, timeout=None, guarded=True):
+    """
+    Вызов метода Zabbix API (по умолчанию через общий keep-alive клиент).
+    retries/timeout позволяют сделать быстрый вызов без повторов (например, для проб готовности),
+    guarded=False — без общего бюджета времени и предохранителя.
+    """
+    client = client or get_client()
+    if timeout is None:
+        timeout = HTTP_TIMEOUT_LONG if method in LONG_METHODS else HTTP_TIMEOUT
+    body = {"jsonrpc": "2.0", "method": method, "params": params or {}, "id": client.next_id()}
+    kind, _, op = method.partition(".")
+    recovery = CreateRecovery(method, params, token) if op == "create" and kind in CREATE_KEYS and params else None
+    resp = _post_with_retries(client, body, timeout, method, retries,
+                              before_retry=recovery.before_retry if recovery else None, guarded=guarded,
+                              token=token)
+    if recovery:
+        resp = recovery.merge(resp)
+    if "error" in resp:
+        raise RuntimeError(f"API {method} error: {resp['error']}")
+    return resp["result"]
+
+
+class ApiCall:
+    """Вызов, поставленный в пакет ApiBatch. Результат доступен после отправки пакета."""
+
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self.id = None
+        self.done = False
+        self.error = None
+        self._result = None
+
+    def result(self):
+        """Возвращает результат вызова или поднимает ошибку именно этого вызова."""
+        if not self.done:
+            raise RuntimeError(f"API {self.method}: пакет ещё не отправлен")
+        if self.error is not None:
+            raise self.error
+        return self._result
+
+
+def call_api_batch(calls, token=None, client=None):
+    """
+    Отправляет список ApiCall одним JSON-RPC 2.0 batch-запросом.
+
+    Ответы сопоставляются с вызовами по id, ошибки сохраняются в каждом вызове отдельно.
+    Если сервер не принял пакет, вызовы выполняются по одному.
+    """
+    calls = [c for c in calls if not c.done]
+    if not calls:
+        return calls
+    client = client or get_client()
+    if len(calls) == 1:
+        _run_single(calls[0], token, client)
+        return calls
+
+    bodies = []
+    for c in calls:
+        c.id = client.next_id()
+        bodies.append({"jsonrpc": "2.0", "method": c.method, "params": c.params or {}, "id": c.id})
+    timeout = HTTP_TIMEOUT_LONG if any(c.method in LONG_METHODS for c in calls) else HTTP_TIMEOUT
+    METRICS.batched(c.method for c in calls)
+    resp = _post_with_retries(client, bodies, timeout, "batch", token=token)
+
+    if not isinstance(resp, list):
+        # пакетный режим не поддержан — выполняем вызовы последовательно
+        for c in calls:
+            _run_single(c, token, client)
+        return calls
+
+    by_id = {r.get("id"): r for r in resp if isinstance(r, dict)}
+    for c in calls:
+        r = by_id.get(c.id)
+        c.done = True
+        if r is None:
+            c.error = RuntimeError(f"API {c.method} error: нет ответа в пакете для id={c.id}")
+        elif "error" in r:
+            c.error = RuntimeError(f"API {c.method} error: {r['error']}")
+        else:
+            c._result = r.get("result")
+    return calls
+
+
+def _run_single(c, token, client):
+    """Выполняет ApiCall обычным вызовом call_api, сохраняя результат или ошибку."""
+    try:
+        c._result = call_api(c.method, c.params, token, client)
+    except RuntimeError as e:
+        c.error = e
+    c.done = True
+
+
+class ApiBatch:
+    """
+    Накопитель вызовов Zabbix API для отправки за один round trip.
+
+        with ApiBatch(token) as batch:
+            q = batch.add("item.get", {...})
+        items = q.result()
+    """
+
+    def __init__(self, token=None, client=None, max_size=API_BATCH_SIZE):
+        self.token = token
+        self.client = client
+        self.max_size = max(1, max_size)
+        self.calls = []
+
+    def add(self, method, params):
+        """Ставит вызов в очередь и возвращает ApiCall."""
+        c = ApiCall(method, params)
+        self.calls.append(c)
+        return c
+
+    def send(self):
+        """Отправляет накопленные вызовы (порциями по max_size) и очищает очередь."""
+        calls, self.calls = self.calls, []
+        for i in range(0, len(calls), self.max_size):
+            call_api_batch(calls[i:i + self.max_size], self.token, self.client)
+        return calls
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.send()
+        return False
+
+
+def _id_order(v):
+    return len(str(v)), str(v)
+
+
+def iter_api(method, params, token, ids_key, ids, page=API_PAGE_IDS, limit=API_PAGE_LIMIT):
+    """
+    Постраничное чтение *.get как генератор объектов.
+
+    Zabbix API не умеет offset, поэтому курсором служит позиция в отсортированном списке ids
+    (например hostids): запрос за запросом берутся следующие page идентификаторов. Каждый ответ
+    ограничен limit объектами; если страница упёрлась в limit, она делится пополам и читается заново,
+    так что размер ответа остаётся ограниченным (кроме одного id с более чем limit объектами).
+    В params должны быть только нужные поля output/select*.
+    """
+    ids = sorted({str(i) for i in ids}, key=_id_order)
+    pages = [ids[n:n + max(1, page)] for n in range(0, len(ids), max(1, page))]
+    pages.reverse()
+    while pages:
+        chunk = pages.pop()
+        p = {**params, ids_key: chunk}
+        if limit and len(chunk) > 1:
+            p["limit"] = limit
+        rows = call_api(method, p, token)
+        if limit and len(chunk) > 1 and len(rows) >= limit:
+            half = len(chunk) // 2
+            pages += [chunk[half:], chunk[:half]]
+            continue
+        yield from rows
+
+
+def paged(method, params, token, ids_key, ids, batch):
+    """
+    Ставит в batch первую «страницу» *.get (с limit) и возвращает функцию, которая отдаёт все объекты:
+    если ответ упёрся в limit, он дочитывается через iter_api. В обычном случае это один вызов в пакете.
+    """
+    ids = list(ids)
+    q = batch.add(method, {**params, ids_key: ids, "limit": API_PAGE_LIMIT})
+
+    def rows():
+        r = q.result()
+        if len(r) < API_PAGE_LIMIT:
+            return r
+        return list(iter_api(method, params, token, ids_key, ids))
+
+    return rows
+
+
+HOST_OUTPUT = ["hostid", "host", "name", "monitored_by", "proxyid", "status"]
+INTERFACE_OUTPUT = ["interfaceid", "hostid", "type", "main", "useip", "ip", "dns", "port", "details"]
+ITEM_OUTPUT = ["itemid", "hostid", "key_", "name", "type", "value_type", "delay", "history", "trends",
+               "timeout", "interfaceid", "templateid", "units", "snmp_oid", "valuemapid", "master_itemid"]
+TRIGGER_OUTPUT = ["triggerid", "description", "expression", "priority", "manual_close", "recovery_mode",
+                  "recovery_expression", "templateid"]
+MACRO_OUTPUT = ["hostmacroid", "hostid", "macro", "value"]
+DISCOVERY_RULE_OUTPUT = ["itemid", "key_", "name", "type", "delay", "timeout", "interfaceid", "lifetime"]
+ACTION_GET = {"output": ["actionid", "name", "eventsource", "status"], "selectFilter": "extend",
+              "selectOperations": "extend", "selectRecoveryOperations": "extend"}
+
+
+def _item_get_params(**extra):
+    """Параметры item.get с проекцией полей, нужных индексу (включая препроцессинг и теги)."""
+    return {
+        "output": ITEM_OUTPUT,
+        "selectPreprocessing": ["type", "params", "error_handler", "error_handler_params"],
+        "selectTags": ["tag", "value"],
+        **extra,
+    }
+
+
+def _trigger_get_params(**extra):
+    """Параметры trigger.get с проекцией полей и hostid владельца (selectHosts)."""
+    return {
+        "output": TRIGGER_OUTPUT,
+        "selectHosts": ["hostid"],
+        "expandExpression": True,
+        **extra,
+    }
+
+
+def _host_get_params(**extra):
+    """Параметры host.get с проекцией полей, нужных индексу."""
+    return {
+        "output": HOST_OUTPUT,
+        "selectInterfaces": INTERFACE_OUTPUT,
+        "selectGroups": ["groupid", "name"],
+        "selectParentTemplates": ["templateid", "host"],
+        **extra,
+    }
+
+
+class StateIndex:
+    """
+    Снимок конфигурации Zabbix в памяти.
+
+    load() забирает хосты (с интерфейсами, группами и шаблонами), шаблоны, элементы данных,
+    триггеры, макросы и действия несколькими массовыми *.get и индексирует их по
+    имени / key_ / description. ensure_*-функции ищут объекты здесь и обновляют индекс
+    после записи; то, что в снимок не попало, добирается из API и тоже кэшируется.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        """Очищает индекс."""
+        with self.lock:
+            self.hosts = {}  # host -> объект хоста или None (проверено: хоста нет)
+            self.hosts_by_id = {}
+            self.templates = {}  # host шаблона -> templateid или None
+            self.items = {}  # (hostid, key_) -> item или None
+            self.item_hosts = set()  # hostid, элементы данных которых загружены целиком
+            self.triggers = {}  # (hostid, description) -> [trigger, ...], собственные раньше унаследованных
+            self.trigger_hosts = set()  # hostid, триггеры которых загружены целиком
+            self.macros = {}  # (hostid, macro) -> usermacro или None
+            self.macro_hosts = set()
+            self.actions = None  # name -> action; None — ещё не загружены
+
+    def load(self, token, host_names, template_names):
+        """Загружает снимок для заданных хостов и шаблонов двумя пакетными запросами."""
+        with ApiBatch(token) as batch:
+            hosts_q = batch.add("host.get", _host_get_params(filter={"host": list(host_names)}))
+            tpls_q = batch.add("template.get", {"output": ["templateid", "host"],
+                                                "filter": {"host": list(template_names)}})
+            actions_q = batch.add("action.get", ACTION_GET)
+        hosts, templates = hosts_q.result(), tpls_q.result()
+
+        ids = [h["hostid"] for h in hosts] + [t["templateid"] for t in templates]
+        items, triggers, macros = [], [], []
+        if ids:
+            with ApiBatch(token) as batch:
+                items_q = paged("item.get", _item_get_params(), token, "hostids", ids, batch)
+                trigs_q = paged("trigger.get", _trigger_get_params(), token, "hostids", ids, batch)
+                macros_q = paged("usermacro.get", {"output": MACRO_OUTPUT}, token, "hostids", ids, batch)
+            items, triggers, macros = items_q(), trigs_q(), macros_q()
+
+        with self.lock:
+            self.reset()
+            for n in host_names:
+                self.hosts[n] = None
+            for h in hosts:
+                self.put_host(h)
+            for n in template_names:
+                self.templates[n] = None
+            for t in templates:
+                self.templates[t["host"]] = t["templateid"]
+            self.item_hosts.update(ids)
+            for it in items:
+                self.items[(it["hostid"], it["key_"])] = it
+            self.trigger_hosts.update(ids)
+            for t in triggers:
+                self.put_trigger(t)
+            self.macro_hosts.update(ids)
+            for m in macros:
+                self.macros[(m["hostid"], m["macro"])] = m
+            self.actions = {a["name"]: a for a in actions_q.result()}
+
+        print(f"✅  Снимок конфигурации загружен: хостов {len(hosts)}, шаблонов {len(templates)}, "
+              f"элементов данных {len(items)}, триггеров {len(triggers)}, макросов {len(macros)}.\n")
+
+    # --- хосты и интерфейсы ---
+
+    def put_host(self, host):
+        """Добавляет/заменяет хост в индексе. interfaces=None означает «не известны»."""
+        with self.lock:
+            host.setdefault("interfaces", None)
+            host.setdefault("groups", [])
+            host.setdefault("parentTemplates", [])
+            self.hosts[host["host"]] = host
+            self.hosts_by_id[host["hostid"]] = host
+
+    def find_hosts(self, token, names):
+        """Возвращает {host: объект или None}; недостающее добирает одним host.get."""
+        with self.lock:
+            missing = [n for n in names if n not in self.hosts]
+        if missing:
+            r = call_api("host.get", _host_get_params(filter={"host": missing}), token)
+            with self.lock:
+                for n in missing:
+                    self.hosts[n] = None
+                for h in r:
+                    self.put_host(h)
+        with self.lock:
+            return {n: self.hosts.get(n) for n in names}
+
+    def host_by_id(self, token, hostid):
+        """Возвращает хост по hostid (из индекса или API)."""
+        with self.lock:
+            host = self.hosts_by_id.get(str(hostid))
+        if host is None and not is_planned(hostid):
+            r = call_api("host.get", _host_get_params(hostids=[hostid]), token)
+            if not r:
+                return None
+            self.put_host(r[0])
+            host = r[0]
+        return host
+
+    def interfaces(self, token, hostid):
+        """Возвращает интерфейсы хоста; если они неизвестны — запрашивает hostinterface.get."""
+        host = self.host_by_id(token, hostid)
+        with self.lock:
+            if host is not None and host["interfaces"] is not None:
+                return host["interfaces"]
+        if is_planned(hostid):
+            return []
+        ifs = call_api("hostinterface.get", {"hostids": hostid, "output": INTERFACE_OUTPUT}, token)
+        with self.lock:
+            if host is not None:
+                host["interfaces"] = ifs
+        return ifs
+
+    def load_interfaces(self, token, hostids):
+        """Догружает неизвестные интерфейсы сразу для многих хостов постраничным hostinterface.get."""
+        with self.lock:
+            hosts = [self.hosts_by_id.get(str(h)) for h in hostids]
+            wanted = {h["hostid"]: h for h in hosts
+                      if h is not None and h["interfaces"] is None and not is_planned(h["hostid"])}
+        if not wanted:
+            return
+        found = {hostid: [] for hostid in wanted}
+        for i in iter_api("hostinterface.get", {"output": INTERFACE_OUTPUT}, token, "hostids", wanted):
+            found.setdefault(i["hostid"], []).append(i)
+        with self.lock:
+            for hostid, host in wanted.items():
+                host["interfaces"] = found[hostid]
+
+    def forget_interfaces(self, hostid):
+        """Помечает интерфейсы хоста как неизвестные (после создания нового)."""
+        with self.lock:
+            host = self.hosts_by_id.get(str(hostid))
+            if host is not None:
+                host["interfaces"] = None
+
+    def set_host_templates(self, hostid, templateids):
+        """Запоминает новый набор шаблонов хоста и сбрасывает его элементы данных (меняется наследование)."""
+        with self.lock:
+            host = self.hosts_by_id.get(str(hostid))
+            if host is not None:
+                host["parentTemplates"] = [{"templateid": tid} for tid in templateids]
+            self.invalidate_items(hostid)
+
+    # --- шаблоны ---
+
+    def find_templates(self, token, names):
+        """Возвращает {host шаблона: templateid или None}."""
+        with self.lock:
+            missing = [n for n in names if n not in self.templates]
+        if missing:
+            r = call_api("template.get", {"output": ["templateid", "host"], "filter": {"host": missing}}, token)
+            with self.lock:
+                for n in missing:
+                    self.templates[n] = None
+                for t in r:
+                    self.templates[t["host"]] = t["templateid"]
+        with self.lock:
+            return {n: self.templates.get(n) for n in names}
+
+    def put_template(self, name, templateid):
+        with self.lock:
+            self.templates[name] = templateid
+            self.item_hosts.add(templateid)
+            self.macro_hosts.add(templateid)
+
+    # --- элементы данных ---
+
+    def find_items(self, token, pairs):
+        """
+        Возвращает {(hostid, key_): [item] или []} — в формате результата item.get.
+        Неизвестные пары добираются одним пакетом item.get (по запросу на каждый набор ключей).
+        """
+        pairs = [(str(h), k) for h, k in pairs]
+        with self.lock:
+            missing = {}
+            for h, k in pairs:
+                if (h, k) not in self.items and h not in self.item_hosts and not is_planned(h):
+                    missing.setdefault(h, []).append(k)
+        if missing:
+            # хосты с одинаковым набором ключей запрашиваем одним item.get
+            by_keys = {}
+            for h, keys in missing.items():
+                by_keys.setdefault(tuple(sorted(set(keys))), []).append(h)
+            with ApiBatch(token) as batch:
+                queries = [(hosts, keys, paged("item.get", _item_get_params(filter={"key_": list(keys)}), token,
+                                               "hostids", hosts, batch))
+                           for keys, hosts in by_keys.items()]
+            results = [(hosts, keys, rows()) for hosts, keys, rows in queries]
+            with self.lock:
+                for hosts, keys, rows in results:
+                    for h in hosts:
+                        for k in keys:
+                            self.items[(h, k)] = None
+                    for it in rows:
+                        self.items[(it["hostid"], it["key_"])] = it
+        with self.lock:
+            return {(h, k): [self.items[(h, k)]] if self.items.get((h, k)) else [] for h, k in pairs}
+
+    def put_item(self, hostid, key_, item):
+        """Записывает элемент данных в индекс (после create/update)."""
+        with self.lock:
+            cur = self.items.get((str(hostid), key_)) or {}
+            self.items[(str(hostid), key_)] = {**cur, **item, "hostid": str(hostid), "key_": key_}
+
+    def host_items(self, token, hostid):
+        """Возвращает все элементы данных хоста; если они не загружены целиком — добирает одним item.get."""
+        hostid = str(hostid)
+        with self.lock:
+            loaded = hostid in self.item_hosts or is_planned(hostid)
+        if not loaded:
+            rows = call_api("item.get", _item_get_params(hostids=[hostid]), token)
+            with self.lock:
+                self.item_hosts.add(hostid)
+                for it in rows:
+                    self.items[(it["hostid"], it["key_"])] = it
+        with self.lock:
+            return [it for (h, _), it in self.items.items() if h == hostid and it]
+
+    def invalidate_items(self, hostid):
+        """Сбрасывает закэшированные элементы данных хоста."""
+        with self.lock:
+            hostid = str(hostid)
+            self.item_hosts.discard(hostid)
+            for key in [k for k in self.items if k[0] == hostid]:
+                del self.items[key]
+
+    # --- триггеры ---
+
+    def put_trigger(self, trigger, hostid=None):
+        """
+        Добавляет/обновляет триггер в индексе (собственные триггеры идут раньше унаследованных).
+        hostid берётся из selectHosts результата trigger.get, если не передан явно.
+        """
+        hostid = str(hostid if hostid is not None else trigger.pop("hosts")[0]["hostid"])
+        trigger.pop("hosts", None)
+        with self.lock:
+            lst = self.triggers.setdefault((hostid, trigger["description"]), [])
+            cur = next((t for t in lst if t["triggerid"] == trigger["triggerid"]), None)
+            if cur is not None:
+                cur.update(trigger)
+            else:
+                lst.append(trigger)
+            lst.sort(key=lambda t: (str(t.get("templateid", "0")) != "0", is_planned(t["triggerid"]),
+                                    len(str(t["triggerid"])), str(t["triggerid"])))
+
+    def find_triggers(self, token, pairs):
+        """
+        Возвращает {(hostid, description): [trigger, ...]} — в формате результата trigger.get.
+        Хосты с неизвестными парами загружаются целиком пакетом trigger.get по hostids
+        (по запросу на каждые MASS_CHUNK хостов): описания триггеров часто содержат имя хоста,
+        и запрос на каждый набор описаний означал бы запрос на каждый хост.
+        """
+        pairs = [(str(h), d) for h, d in pairs]
+        with self.lock:
+            missing = sorted({h for h, d in pairs
+                              if (h, d) not in self.triggers and h not in self.trigger_hosts and not is_planned(h)})
+        if missing:
+            with ApiBatch(token) as batch:
+                queries = [(hosts, paged("trigger.get", _trigger_get_params(), token, "hostids", hosts, batch))
+                           for hosts in chunked(missing, MASS_CHUNK)]
+            results = [(hosts, rows()) for hosts, rows in queries]
+            with self.lock:
+                for hosts, rows in results:
+                    self.trigger_hosts.update(hosts)
+                    for t in rows:
+                        self.put_trigger(t)
+        with self.lock:
+            return {(h, d): list(self.triggers.get((h, d), [])) for h, d in pairs}
+
+    # --- макросы ---
+
+    def find_macro(self, token, hostid, macro):
+        """Возвращает usermacro хоста/шаблона или None."""
+        hostid = str(hostid)
+        with self.lock:
+            if (hostid, macro) in self.macros or hostid in self.macro_hosts or is_planned(hostid):
+                return self.macros.get((hostid, macro))
+        r = call_api("usermacro.get", {"hostids": [hostid], "filter": {"macro": [macro]},
+                                       "output": MACRO_OUTPUT}, token)
+        with self.lock:
+            self.macros[(hostid, macro)] = r[0] if r else None
+            return self.macros[(hostid, macro)]
+
+    def put_macro(self, hostid, macro, obj):
+        with self.lock:
+            self.macros[(str(hostid), macro)] = {**obj, "hostid": str(hostid), "macro": macro}
+
+    # --- действия ---
+
+    def find_action(self, token, name):
+        """Возвращает действие по имени или None (все действия загружаются одним action.get)."""
+        with self.lock:
+            loaded = self.actions is not None
+        if not loaded:
+            r = call_api("action.get", ACTION_GET, token)
+            with self.lock:
+                self.actions = {a["name"]: a for a in r}
+        with self.lock:
+            return self.actions.get(name)
+
+    def put_action(self, name, action):
+        with self.lock:
+            if self.actions is None:
+                self.actions = {}
+            self.actions[name] = {**action, "name": name}
+
+
+STATE = StateIndex()
+
+
+PLANNED_ID_PREFIX = "new:"
+
+# ключ со списком id в ответе <object>.create/update, если он не равен "<object>ids"
+IDS_KEYS = {"hostgroup": "groupids", "templategroup": "groupids", "usermacro": "hostmacroids",
+            "usergroup": "usrgrpids", "discoveryrule": "itemids", "itemprototype": "itemids",
+            "triggerprototype": "triggerids"}
+
+
+def is_planned(objectid):
+    """True, если id выдан планом в dry-run режиме (объекта в Zabbix ещё нет)."""
+    return str(objectid).startswith(PLANNED_ID_PREFIX)
+
+
+def _norm(v):
+    """Приводит значение к виду, в котором его возвращает Zabbix API (все скаляры — строки)."""
+    if isinstance(v, dict):
+        return {k: _norm(x) for k, x in v.items()}
+    if isinstance(v, (list, tuple)):
+        return [_norm(x) for x in v]
+    if isinstance(v, bool):
+        return str(int(v))
+    return "" if v is None else str(v)
+
+
+def _same(live, desired):
+    """
+    Сравнивает желаемое значение с текущим.
+    Для словарей учитываются только поля desired, списки сравниваются без учёта порядка.
+    """
+    if isinstance(desired, dict):
+        return isinstance(live, dict) and all(k in live and _same(live[k], v) for k, v in desired.items())
+    if isinstance(desired, (list, tuple)):
+        if not isinstance(live, list) or len(live) != len(desired):
+            return False
+        rest = list(live)
+        for d in desired:
+            i = next((n for n, x in enumerate(rest) if _same(x, d)), None)
+            if i is None:
+                return False
+            rest.pop(i)
+        return True
+    return _norm(live) == _norm(desired)
+
+
+def diff_fields(live, desired):
+    """Возвращает поля desired, значения которых отличаются от live (поля, которых нет в live, тоже)."""
+    live = live or {}
+    return {k: v for k, v in desired.items() if k not in live or not _same(live[k], v)}
+
+
+class Plan:
+    """
+    План изменений конфигурации Zabbix.
+
+    Все записи ensure_*-функций проходят через apply(): изменение регистрируется в плане и,
+    если это не dry-run, выполняется. В dry-run режиме (--plan) API на запись не вызывается,
+    а create возвращает фиктивные id вида "new:N", чтобы остальные шаги могли построить план целиком.
+    """
 
-    raise RuntimeError(f"API метод '{method}' провалился после {API_RETRIES} попыток: {last_err}")
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.changes = []
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def apply(self, token, method, params, what, fields=None):
+        """
+        Регистрирует изменение и выполняет его (кроме dry-run).
+        what — человекочитаемое имя объекта (или список имён для массовых host.massadd/massupdate/massremove),
+        fields — изменившиеся поля (для update).
+        """
+        obj, _, op = method.partition(".")
+        with self.lock:
+            for w in (what if isinstance(what, list) else [what]):
+                self.changes.append({"op": op, "method": method, "what": w, "fields": sorted(fields or [])})
+        if not self.dry_run:
+            return call_api(method, params, token)
+
+        ids_key = IDS_KEYS.get(obj, f"{obj}ids")
+        if op == "create":
+            n = len(params) if isinstance(params, list) else 1
+            with self.lock:
+                return {ids_key: [f"{PLANNED_ID_PREFIX}{next(self._ids)}" for _ in range(n)]}
+        return {ids_key: []}
+
+    def apply_many(self, token, method, objects, whats, fields=None, chunk=MASS_CHUNK):
+        """
+        Выполняет <object>.create/update для массива объектов порциями по chunk объектов.
+        whats[i]/fields[i] описывают objects[i]. Возвращает id всех объектов по порядку.
+        """
+        obj, _, op = method.partition(".")
+        ids_key = IDS_KEYS.get(obj, f"{obj}ids")
+        fields = fields or [None] * len(objects)
+        ids = []
+        for i in range(0, len(objects), max(1, chunk)):
+            part = objects[i:i + chunk]
+            with self.lock:
+                for w, f in zip(whats[i:i + chunk], fields[i:i + chunk]):
+                    self.changes.append({"op": op, "method": method, "what": w, "fields": sorted(f or [])})
+            if not self.dry_run:
+                ids += call_api(method, part, token)[ids_key]
+            elif op == "create":
+                with self.lock:
+                    ids += [f"{PLANNED_ID_PREFIX}{next(self._ids)}" for _ in part]
+        return ids
+
+    def reset(self):
+        """Очищает список изменений перед новым проходом (режим сверки)."""
+        with self.lock:
+            self.changes = []
+
+    def summary(self):
+        """Возвращает количество изменений по типам операций."""
+        counts = {}
+        for c in self.changes:
+            counts[c["op"]] = counts.get(c["op"], 0) + 1
+        return counts
+
+    def print(self):
+        """Печатает план (или список выполненных изменений)."""
+        marks = {"create": "+", "delete": "-"}
+        title = "План изменений" if self.dry_run else "Выполненные изменения"
+        counts = ", ".join(f"{op}: {n}" for op, n in sorted(self.summary().items())) or "нет"
+        print(f"\n📋  {title} ({counts})")
+        for c in self.changes:
+            fields = f"  [{', '.join(c['fields'])}]" if c["fields"] else ""
+            print(f"  {marks.get(c['op'], '~')} {c['method']:<22} {c['what']}{fields}")
+
+
+PLAN = Plan()
+
+
+class StepGraph:
+    """
+    Шаги настройки с явными зависимостями (DAG).
+
+    run() выполняет шаги на пуле из workers потоков: шаг запускается, как только завершились
+    все его зависимости, поэтому общее время определяется критическим путём, а не числом шагов.
+    Результат шага доступен зависимым шагам через results[name]. После первой ошибки новые
+    шаги не запускаются, уже запущенные дорабатывают, и ошибка поднимается наружу.
+    restrict() оставляет только выбранные шаги и то, от чего они зависят.
+    """
+
+    def __init__(self):
+        self.steps = {}  # name -> (fn, deps)
+        self.after = {}  # name -> шаги, после которых выполнять, если они тоже выбраны (без подтягивания)
+        self.hosts = {}  # name -> хосты, к которым относится шаг (пусто — шаг не привязан к хостам)
+        self.results = {}
+
+    def add(self, name, fn, deps=(), after=(), hosts=()):
+        """
+        Добавляет шаг name: fn() выполнится после всех шагов из deps и тех шагов из after,
+        которые есть в графе. hosts — хосты, которые настраивает шаг (для restrict).
+        """
+        if name in self.steps:
+            raise ValueError(f"Шаг {name} уже добавлен")
+        self.steps[name] = (fn, tuple(deps))
+        self.after[name] = tuple(after)
+        self.hosts[name] = frozenset(hosts)
+        return name
+
+    @staticmethod
+    def matches(name, stage):
+        """Шаг name относится к этапу stage: совпадает с ним или начинается с «stage_»/«stage:»."""
+        return name == stage or name.startswith((stage + "_", stage + ":"))
+
+    def restrict(self, stages=None, hosts=None):
+        """
+        Оставляет шаги выбранных этапов (все, если stages пусто), а из привязанных к хостам — только
+        шаги хостов из hosts; затем добавляет всё, от чего они зависят (deps), независимо от фильтров.
+        """
+        roots = []
+        for stage in stages or ():
+            found = [n for n in self.steps if self.matches(n, stage)]
+            if not found:
+                raise ValueError(f"Нет этапа {stage}. Доступные шаги: {', '.join(self.steps)}")
+            roots += found
+        if not stages:
+            roots = list(self.steps)
+        if hosts is not None:
+            roots = [n for n in roots if not self.hosts[n] or self.hosts[n] & hosts]
+        keep, stack = set(), list(roots)
+        while stack:
+            n = stack.pop()
+            if n not in keep:
+                keep.add(n)
+                stack.extend(self.steps[n][1])
+        for n in [n for n in self.steps if n not in keep]:
+            del self.steps[n], self.after[n], self.hosts[n]
+        return self
+
+    def _check(self):
+        """Проверяет, что все зависимости объявлены и граф не содержит циклов."""
+        for name, (_, deps) in self.steps.items():
+            unknown = [d for d in deps if d not in self.steps]
+            if unknown:
+                raise ValueError(f"Шаг {name} зависит от неизвестных шагов: {unknown}")
+        state = {}
+
+        def visit(n, path):
+            if state.get(n) == "done":
+                return
+            if state.get(n) == "visiting":
+                raise ValueError(f"Цикл зависимостей: {' -> '.join(path + [n])}")
+            state[n] = "visiting"
+            for d in self.steps[n][1] + tuple(a for a in self.after[n] if a in self.steps):
+                visit(d, path + [n])
+            state[n] = "done"
+
+        for n in self.steps:
+            visit(n, [])
+
+    def _run_step(self, name):
+        """Выполняет шаг; вызовы API внутри относятся к этапу с именем шага (без номера порции)."""
+        with METRICS.stage(name.partition(":")[0]):
+            return self.steps[name][0]()
+
+    def run(self, workers=CONCURRENCY):
+        """Выполняет все шаги и возвращает results."""
+        self._check()
+        waiting = {n: set(deps) | {a for a in self.after[n] if a in self.steps} for n, (_, deps) in self.steps.items()}
+        dependents = {n: [] for n in self.steps}
+        for n, deps in waiting.items():
+            for d in deps:
+                dependents[d].append(n)
+
+        running, failed = {}, None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            def start_ready():
+                for n in [n for n, deps in waiting.items() if not deps]:
+                    del waiting[n]
+                    running[pool.submit(self._run_step, n)] = n
+
+            start_ready()
+            while running:
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for f in done:
+                    n = running.pop(f)
+                    try:
+                        self.results[n] = f.result()
+                    except Exception as e:
+                        failed = failed or (n, e)
+                        continue
+                    for d in dependents[n]:
+                        if d in waiting:
+                            waiting[d].discard(n)
+                if failed is None:
+                    start_ready()
+
+        if failed is not None:
+            name, err = failed
+            raise RuntimeError(f"Шаг настройки {name} завершился с ошибкой: {err}") from err
+        return self.results
 
 
 def login(user, password):
@@ -206,10 +1871,10 @@ def ensure_proxy(token, name, mode=0):
     if r:
         return r[0]["proxyid"]
 
-    res = call_api("proxy.create", {
+    res = PLAN.apply(token, "proxy.create", {
         "name": name,
         "operating_mode": mode  # 0=active, 1=passive
-    }, token)
+    }, f"proxy {name}")
     return res["proxyids"][0]
 
 
@@ -217,104 +1882,201 @@ def ensure_group(token, name):
     """Создает группу для хостов, если её нет и возвращает её ID."""
     r = call_api("hostgroup.get", {"filter": {"name": [name]}}, token)
     if r: return r[0]["groupid"]
-    return call_api("hostgroup.create", {"name": name}, token)["groupids"][0]
+    return PLAN.apply(token, "hostgroup.create", {"name": name}, f"hostgroup {name}")["groupids"][0]
 
 
 def get_template_ids(token, names):
     """Возвращает ID шаблонов по их именам, падает, если какие-то не найдены."""
     if not names: return []
-    r = call_api("template.get", {"filter": {"host": names}}, token)
-    found = {t["host"]: t["templateid"] for t in r}
-    missing = [n for n in names if n not in found]
+    found = STATE.find_templates(token, names)
+    missing = [n for n in names if not found[n]]
     if missing:
         raise RuntimeError(f"Шаблоны не найдены: {missing}")
     return [found[n] for n in names]
 
 
 def get_host_by_name(token, host):
-    """Возвращает объект хоста по имени или None."""
-    r = call_api("host.get", {
-        "filter": {"host": [host]},
-        "selectInterfaces": "extend",
-        "selectGroups": "extend",
-        "selectParentTemplates": "extend"
-    }, token)
-    return r[0] if r else None
-
-
-def ensure_interface(token, hostid, desired):
-    """Создаёт или обновляет информацию о хосте."""
-    r = call_api("hostinterface.get", {"hostids": hostid}, token)
-    agent_if = next((i for i in r if int(i["type"]) == 1), None)
-    if agent_if:
-        need_update = any([
-            agent_if.get("dns") != desired["dns"],
-            agent_if.get("port") != desired["port"],
-            int(agent_if.get("useip", 0)) != desired["useip"],
-            int(agent_if.get("main", 1)) != desired["main"]
-        ])
-        if need_update:
-            call_api("hostinterface.update", {"interfaceid": agent_if["interfaceid"], **desired}, token)
-    else:
-        call_api("hostinterface.create", {"hostid": hostid, **desired}, token)
+    """Возвращает объект хоста по имени или None (из снимка STATE, при промахе — из API)."""
+    return STATE.find_hosts(token, [host])[host]
 
 
 def set_templates_exact(token, hostid, templateids_wanted):
     """Устанавливает шаблоны для хоста."""
-    cur = call_api("host.get", {"hostids": hostid, "selectParentTemplates": "extend"}, token)[0]
+    cur = STATE.host_by_id(token, hostid)
     current = {t["templateid"] for t in cur.get("parentTemplates", [])}
     wanted = set(templateids_wanted)
-    call_api("host.update", {
+    if current == wanted:
+        return
+    PLAN.apply(token, "host.update", {
         "hostid": hostid,
         "templates": [{"templateid": tid} for tid in wanted],
         "templates_clear": [{"templateid": tid} for tid in (current - wanted)]
-    }, token)
+    }, f"host {cur['host']}", ["templates"])
+    STATE.set_host_templates(hostid, wanted)
 
 
 def ensure_host(token, groupid, host, dns, port, template_names, proxy_hostid=None):
     """Создаёт хост при его отсутствии и заполняет нужными данными."""
-    templateids = get_template_ids(token, template_names)
-    desired_if = {"type": 1, "main": 1, "useip": 0, "ip": "", "dns": dns, "port": port}
-    existing = get_host_by_name(token, host)
-    if not existing:
-        params = {
-            "host": host, "name": host,
-            "groups": [{"groupid": groupid}],
-            "interfaces": [desired_if],
-        }
+    row = {"host": host, "dns": dns, "port": port, "templates": template_names}
+    return ensure_hosts(token, groupid, [row], proxy_hostid)[host]
 
-        if proxy_hostid:
-            params["monitored_by"] = 1  # 1 = Proxy
-            params["proxyid"] = proxy_hostid
 
-        if templateids:
-            params["templates"] = [{"templateid": tid} for tid in templateids]
-        res = call_api("host.create", params, token)
-        return res["hostids"][0]
-    else:
-        hostid = existing["hostid"]
-        cur_groups = {g["groupid"] for g in existing.get("groups", [])}
+def _agent_interface(dns, port):
+    """Желаемый агентский интерфейс хоста (type=1, по DNS)."""
+    return {"type": 1, "main": 1, "useip": 0, "ip": "", "dns": dns, "port": port}
 
-        if proxy_hostid:
-            call_api("host.update", {
-                "hostid": hostid,
-                "monitored_by": 1,
-                "proxyid": proxy_hostid
-            }, token)
 
-        if groupid not in cur_groups:
-            call_api("host.update", {"hostid": hostid,
-                                     "groups": [{"groupid": gid} for gid in sorted(cur_groups | {groupid})]}, token)
+def ensure_hosts(token, groupid, rows, proxy_hostid=None):
+    """
+    Приводит группу хостов (строки вида WEBSERVERS) к желаемому состоянию массовыми вызовами.
 
-        ensure_interface(token, hostid, desired_if)
-        set_templates_exact(token, hostid, templateids)
-        return hostid
+    Новые хосты создаются массивом host.create, а одинаковые изменения существующих хостов
+    объединяются: прокси — в один host.massupdate, группа — в один host.massadd, шаблоны —
+    в host.massadd/host.massremove на каждый одинаковый набор, интерфейсы — в один
+    hostinterface.update. Возвращает {host: hostid}.
+    """
+    tpl_names = sorted({t for h in rows for t in h["templates"]})
+    tpl_ids = dict(zip(tpl_names, get_template_ids(token, tpl_names)))
+    found = STATE.find_hosts(token, [h["host"] for h in rows])
+    proxy = {"monitored_by": 1, "proxyid": proxy_hostid} if proxy_hostid else {}  # 1 = Proxy
+
+    hostids, creates = {}, []
+    proxy_hosts, group_hosts, link, unlink, retemplated = [], [], {}, {}, []
+    if_updates, if_creates = [], []
+    for h in rows:
+        desired_if = _agent_interface(h["dns"], h["port"])
+        wanted = {tpl_ids[t] for t in h["templates"]}
+        cur = found[h["host"]]
+        if cur is None:
+            params = {"host": h["host"], "name": h["host"], "groups": [{"groupid": groupid}],
+                      "interfaces": [desired_if], **proxy}
+            if wanted:
+                params["templates"] = [{"templateid": tid} for tid in sorted(wanted)]
+            creates.append(params)
+            continue
 
+        hostid = hostids[h["host"]] = cur["hostid"]
+        if proxy and diff_fields(cur, proxy):
+            proxy_hosts.append(cur)
+        if groupid not in {g["groupid"] for g in cur.get("groups", [])}:
+            group_hosts.append(cur)
+        current = {t["templateid"] for t in cur.get("parentTemplates", [])}
+        if wanted - current:
+            link.setdefault(frozenset(wanted - current), []).append(cur)
+        if current - wanted:
+            unlink.setdefault(frozenset(current - wanted), []).append(cur)
+        if current != wanted:
+            retemplated.append((cur, wanted))
+
+        agent_if = next((i for i in STATE.interfaces(token, hostid) if int(i["type"]) == 1), None)
+        if agent_if is None:
+            if_creates.append((cur, {"hostid": hostid, **desired_if}))
+        else:
+            changed = diff_fields(agent_if, desired_if)
+            if changed:
+                if_updates.append((cur, agent_if, changed))
+
+    if creates:
+        ids = PLAN.apply_many(token, "host.create", creates, [f"host {c['host']}" for c in creates])
+        for c, hostid in zip(creates, ids):
+            hostids[c["host"]] = hostid
+            # в dry-run интерфейс существует только в плане — запоминаем его, чтобы шаги с items могли на него сослаться
+            interfaces = [{"interfaceid": hostid, **_norm(c["interfaces"][0])}] if is_planned(hostid) else None
+            STATE.put_host({"hostid": hostid, "host": c["host"], "name": c["host"], "interfaces": interfaces,
+                            "groups": c["groups"], "parentTemplates": c.get("templates", []), **_norm(proxy)})
+
+    def mass(method, hosts, params, fields):
+        for i in range(0, len(hosts), MASS_CHUNK):
+            part = hosts[i:i + MASS_CHUNK]
+            PLAN.apply(token, method, {"hosts": [{"hostid": x["hostid"]} for x in part], **params},
+                       [f"host {x['host']}" for x in part], fields)
+
+    if proxy_hosts:
+        mass("host.massupdate", proxy_hosts, proxy, list(proxy))
+        for cur in proxy_hosts:
+            cur.update(_norm(proxy))
+    if group_hosts:
+        mass("host.massadd", group_hosts, {"groups": [{"groupid": groupid}]}, ["groups"])
+        for cur in group_hosts:
+            cur["groups"] = cur.get("groups", []) + [{"groupid": str(groupid)}]
+    for tids, hosts in link.items():
+        mass("host.massadd", hosts, {"templates": [{"templateid": t} for t in sorted(tids)]}, ["templates"])
+    for tids, hosts in unlink.items():
+        for i in range(0, len(hosts), MASS_CHUNK):
+            part = hosts[i:i + MASS_CHUNK]
+            PLAN.apply(token, "host.massremove", {"hostids": [x["hostid"] for x in part],
+                                                  "templateids_clear": sorted(tids)},
+                       [f"host {x['host']}" for x in part], ["templates"])
+    for cur, wanted in retemplated:
+        STATE.set_host_templates(cur["hostid"], wanted)
+
+    if if_updates:
+        PLAN.apply_many(token, "hostinterface.update",
+                        [{"interfaceid": agent_if["interfaceid"], **changed} for _, agent_if, changed in if_updates],
+                        [f"agent interface of {cur['host']}" for cur, _, _ in if_updates],
+                        [changed for _, _, changed in if_updates])
+        for _, agent_if, changed in if_updates:
+            agent_if.update(_norm(changed))
+    if if_creates:
+        PLAN.apply_many(token, "hostinterface.create", [obj for _, obj in if_creates],
+                        [f"agent interface of {cur['host']}" for cur, _ in if_creates])
+        for cur, _ in if_creates:
+            STATE.forget_interfaces(cur["hostid"])
+    return hostids
+
+
+def _host_label(hostid):
+    """Имя хоста/шаблона для плана изменений (или hostid, если его нет в индексе)."""
+    with STATE.lock:
+        host = STATE.hosts_by_id.get(str(hostid))
+    return host["host"] if host else str(hostid)
+
+
+def ensure_items(token, items, update_fields=None, skip_inherited=False):
+    """
+    Приводит набор элементов данных (словари item.create с hostid и key_) к желаемому состоянию.
 
-def ensure_log_item(token, hostid, name, key_, delay="1m"):
-    """Создаёт или обновляет элемент данных для логов на хосте."""
-    r = call_api("item.get", {"hostids": hostid, "filter": {"key_": key_}}, token)
-    params = {
+    Существующие элементы сравниваются поле за полем (только update_fields, если заданы), изменения
+    отправляются одним массивом item.update, новые элементы — массивом item.create (порциями по
+    MASS_CHUNK). skip_inherited=True не трогает элементы, унаследованные от шаблона.
+    Возвращает {(hostid, key_): itemid}.
+    """
+    found = STATE.find_items(token, [(it["hostid"], it["key_"]) for it in items])
+    ids, creates, updates = {}, [], []
+    for it in items:
+        key = (str(it["hostid"]), it["key_"])
+        r = found[key]
+        if not r:
+            creates.append(it)
+            continue
+        live = r[0]
+        ids[key] = live["itemid"]
+        if skip_inherited and str(live.get("templateid", "0")) != "0":
+            continue
+        desired = {k: v for k, v in it.items() if k != "hostid" and (update_fields is None or k in update_fields)}
+        changed = diff_fields(live, desired)
+        if changed:
+            updates.append((key, live["itemid"], changed))
+
+    if updates:
+        PLAN.apply_many(token, "item.update", [{"itemid": iid, **changed} for _, iid, changed in updates],
+                        [f"item {k} on {_host_label(h)}" for (h, k), _, _ in updates],
+                        [changed for _, _, changed in updates])
+        for (h, k), _, changed in updates:
+            STATE.put_item(h, k, _norm(changed))
+    if creates:
+        new_ids = PLAN.apply_many(token, "item.create", creates,
+                                  [f"item {it['key_']} on {_host_label(it['hostid'])}" for it in creates])
+        for it, iid in zip(creates, new_ids):
+            ids[(str(it["hostid"]), it["key_"])] = iid
+            STATE.put_item(it["hostid"], it["key_"], {"itemid": iid, "templateid": "0", **_norm(it)})
+    return ids
+
+
+def _log_item(hostid, name, key_, delay="1m"):
+    """Параметры item.create для элемента данных логов (logrt, активный агент)."""
+    return {
+        "hostid": hostid,
         "name": name,
         "key_": key_,
         "type": ITEM_TYPE_ZABBIX_AGENT_ACTIVE,
@@ -323,23 +2085,15 @@ def ensure_log_item(token, hostid, name, key_, delay="1m"):
         "history": "7d",
         "trends": "0"
     }
-    if r:
-        itemid = r[0]["itemid"]
-        call_api("item.update", {"itemid": itemid, **params}, token)
-        return itemid
-    else:
-        res = call_api("item.create", {"hostid": hostid, **params}, token)
-        return res["itemids"][0]
 
 
-def ensure_trigger(token, description, expression, priority=3, manual_close=1, recovery_mode=None,
-                   recovery_expression=None):
-    """
-    Создаёт или обновляет триггер.
-    - priority=4 -> High
-    - manual_close=1 -> Разрешить ручное закрытие
-    """
-    r = call_api("trigger.get", {"filter": {"description": [description]}}, token)
+def ensure_log_item(token, hostid, name, key_, delay="1m"):
+    """Создаёт или обновляет элемент данных для логов на хосте."""
+    return ensure_items(token, [_log_item(hostid, name, key_, delay)])[(str(hostid), key_)]
+
+
+def _trigger(description, expression, priority=3, manual_close=1, recovery_mode=None, recovery_expression=None):
+    """Объект trigger.create/update из параметров ensure_trigger."""
     obj = {
         "description": description,
         "expression": expression,
@@ -351,46 +2105,111 @@ def ensure_trigger(token, description, expression, priority=3, manual_close=1, r
         obj["recovery_mode"] = recovery_mode
         if recovery_mode in (1, 2) and recovery_expression:
             obj["recovery_expression"] = recovery_expression
+    return obj
 
-    if r:
-        tid = r[0]["triggerid"]
-        try:
-            call_api("trigger.update", {"triggerid": tid, **obj}, token)
-            return tid
-        except Exception:
-            # удаляем и пересоздаем — на случай «битых» старых выражений
-            call_api("trigger.delete", [tid], token)
 
-    res = call_api("trigger.create", obj, token)
-    return res["triggerids"][0]
+def ensure_triggers(token, triggers):
+    """
+    Приводит набор триггеров к желаемому состоянию. triggers — пары (hostid, объект из _trigger),
+    где hostid — хост или шаблон, которому принадлежит триггер. Изменения уходят одним массивом
+    trigger.update (триггер обновляется на месте, история событий сохраняется), новые триггеры —
+    массивом trigger.create. Возвращает {(hostid, description): triggerid}.
+    """
+    triggers = [(str(h), t) for h, t in triggers]
+    found = STATE.find_triggers(token, [(h, t["description"]) for h, t in triggers])
+    ids, creates, updates = {}, [], []
+    for h, t in triggers:
+        key = (h, t["description"])
+        r = found[key]
+        if not r:
+            creates.append((key, t))
+            continue
+        ids[key] = r[0]["triggerid"]
+        changed = diff_fields(r[0], t)
+        if changed:
+            updates.append((key, r[0]["triggerid"], changed))
+
+    if updates:
+        PLAN.apply_many(token, "trigger.update", [{"triggerid": tid, **changed} for _, tid, changed in updates],
+                        [f"trigger {d} on {_host_label(h)}" for (h, d), _, _ in updates],
+                        [changed for _, _, changed in updates])
+        for (h, _), tid, changed in updates:
+            STATE.put_trigger({"triggerid": tid, **_norm(changed)}, h)
+    if creates:
+        new_ids = PLAN.apply_many(token, "trigger.create", [t for _, t in creates],
+                                  [f"trigger {d} on {_host_label(h)}" for (h, d), _ in creates])
+        for ((h, d), t), tid in zip(creates, new_ids):
+            ids[(h, d)] = tid
+            STATE.put_trigger({"triggerid": tid, "templateid": "0", **_norm(t)}, h)
+    return ids
+
+
+def _expression_host(token, expression):
+    """Возвращает hostid хоста или шаблона, на который ссылается первая функция выражения (/host/key)."""
+    m = re.search(r"\(/([^/]+)/", expression)
+    if not m:
+        raise RuntimeError(f"Не удалось определить хост в выражении триггера: {expression}")
+    name = m.group(1)
+    host = get_host_by_name(token, name)
+    if host:
+        return host["hostid"]
+    tid = STATE.find_templates(token, [name])[name]
+    if not tid:
+        raise RuntimeError(f'Хост или шаблон "{name}" из выражения триггера не найден')
+    return tid
 
 
-def get_trigger_ids_by_descriptions(token, descriptions):
+def ensure_trigger(token, description, expression, priority=3, manual_close=1, recovery_mode=None,
+                   recovery_expression=None, hostid=None):
     """
-    Возвращает id триггера.
+    Создаёт или обновляет триггер.
+    - priority=4 -> High
+    - manual_close=1 -> Разрешить ручное закрытие
+    - hostid -> хост/шаблон триггера (по умолчанию — первый хост из expression)
     """
-    r = call_api("trigger.get", {
-        "filter": {"description": descriptions},
-        "output": ["triggerid", "description"]
-    }, token)
-    found = {t["description"]: t["triggerid"] for t in r}
+    hostid = hostid if hostid is not None else _expression_host(token, expression)
+    obj = _trigger(description, expression, priority, manual_close, recovery_mode, recovery_expression)
+    return ensure_triggers(token, [(hostid, obj)])[(str(hostid), description)]
+
+
+def get_trigger_ids_by_descriptions(token, hostid, descriptions):
+    """
+    Возвращает {description: triggerid} для триггеров хоста hostid.
+    """
+    r = STATE.find_triggers(token, [(hostid, d) for d in descriptions])
+    found = {d: ts[0]["triggerid"] for (_, d), ts in r.items() if ts}
     missing = [d for d in descriptions if d not in found]
     if missing:
         raise RuntimeError(f"Не найдены триггеры по описанию: {missing}")
     return found
 
 
-def ensure_trigger_action_for_log_triggers(token, name, mediatypeid, userid, trigger_names):
+def ensure_trigger_action_for_log_triggers(token, name, mediatypeid, userid, triggerids, keep_existing=False):
     """
     Создаёт/обновляет Action, которое реагирует только на заданные триггеры логов.
+    keep_existing — оставить и триггеры из текущих условий действия (настраивалась только часть инвентаря),
+    но только триггеры хоста логов LOG_HOST: условия прежнего режима логов заменяются, а не дополняются.
     """
-    ids = get_trigger_ids_by_descriptions(token, trigger_names)
+    ids = [str(tid) for tid in triggerids]
+    cur = STATE.find_action(token, name) if keep_existing else None
+    old = [c["value"] for c in (cur or {}).get("filter", {}).get("conditions", [])
+           if int(c["conditiontype"]) == 2 and c["value"] not in ids]
+    if old:
+        log_host = get_host_by_name(token, LOG_HOST)
+        live = []
+        if log_host and not is_planned(log_host["hostid"]):
+            live = call_api("trigger.get", {"output": ["triggerid"], "triggerids": old,
+                                            "hostids": [log_host["hostid"]]}, token)
+        live = {t["triggerid"] for t in live}
+        ids += [tid for tid in old if tid in live]
+    if not ids:
+        raise RuntimeError("Нет триггеров логов для действия: сначала настройте веб-серверы")
 
     conditions = [{
         "conditiontype": 2,  # 2 = Trigger
         "operator": 0,
-        "value": str(tid)
-    } for tid in ids.values()]
+        "value": tid
+    } for tid in ids]
 
     action_obj = {
         "name": name,
@@ -412,45 +2231,64 @@ def ensure_trigger_action_for_log_triggers(token, name, mediatypeid, userid, tri
         }]
     }
 
-    cur = call_api("action.get", {"filter": {"name": [name]}}, token)
-    if cur:
-        action_obj["actionid"] = cur[0]["actionid"]
-        call_api("action.update", action_obj, token)
-        return action_obj["actionid"]
-    else:
-        res = call_api("action.create", action_obj, token)
-        return res["actionids"][0]
+    return _apply_action(token, action_obj)
 
 
-def provision_logs_and_triggers(token):
-    """Устанавливает элементы данных и триггеры на хосте log-srv."""
+def _apply_action(token, action):
+    """Создаёт действие или обновляет изменившиеся поля; возвращает actionid."""
+    name = action["name"]
+    cur = STATE.find_action(token, name)
+    if cur:
+        changed = diff_fields(cur, action)
+        if changed:
+            PLAN.apply(token, "action.update", {"actionid": cur["actionid"], **changed}, f"action {name}", changed)
+            STATE.put_action(name, {**cur, **_norm(action)})
+        return cur["actionid"]
+    res = PLAN.apply(token, "action.create", action, f"action {name}")
+    STATE.put_action(name, {"actionid": res["actionids"][0], **_norm(action)})
+    return res["actionids"][0]
+
+
+def drop_items(token, hostid, keys):
+    """Удаляет элементы данных хоста с ключами keys, если они есть; триггеры на них Zabbix удаляет сам."""
+    if is_planned(hostid):
+        return
+    items = [its[0] for its in STATE.find_items(token, [(hostid, k) for k in keys]).values() if its]
+    if items:
+        PLAN.apply(token, "item.delete", [it["itemid"] for it in items],
+                   [f"item {it['key_']} on {_host_label(hostid)}" for it in items])
+        STATE.invalidate_items(hostid)
+
+
+def provision_logs_and_triggers(token, log_items=LOG_ITEMS):
+    """
+    Устанавливает элементы данных и триггеры на хосте log-srv (по умолчанию — для всех LOG_ITEMS).
+    Возвращает ID триггеров.
+    """
     logsrv = get_host_by_name(token, "log-srv")
     if not logsrv:
         raise RuntimeError('Хост "log-srv" не найден; сначала создайте его.')
     logsrv_id = logsrv["hostid"]
 
-    for it in LOG_ITEMS:
-        itemid = ensure_log_item(token, logsrv_id, it["name"], it["key_"], it["delay"])
-
-        trig_id = ensure_trigger(
-            token,
-            it["trigger_name"],
-            it["trigger_expr"],
-            priority=4,
-            manual_close=1  # Разрешаем ручное закрытие
-        )
+    itemids = ensure_items(token, [_log_item(logsrv_id, it["name"], it["key_"], it["delay"]) for it in log_items])
+    trigids = ensure_triggers(token, [(logsrv_id, _trigger(it["trigger_name"], it["trigger_expr"], priority=4,
+                                                           manual_close=1))  # Разрешаем ручное закрытие
+                                      for it in log_items])
+    for it in log_items:
         print(
-            f"✅  Элемент данных для логов создан/обновлён: {it['name']} (id={itemid})\n✅  Триггер для логов создан/обновлён: {it['trigger_name']} (id={trig_id})"
+            f"✅  Элемент данных для логов создан/обновлён: {it['name']} (id={itemids[(str(logsrv_id), it['key_'])]})\n✅  Триггер для логов создан/обновлён: {it['trigger_name']} (id={trigids[(str(logsrv_id), it['trigger_name'])]})"
         )
+    return [trigids[(str(logsrv_id), it["trigger_name"])] for it in log_items]
 
 
 def set_user_language(token, username, lang="ru_RU"):
     """Устанавливает язык интерфейса пользователя в Zabbix."""
-    users = call_api("user.get", {"filter": {"username": [username]}}, token)
+    users = call_api("user.get", {"output": ["userid", "lang"], "filter": {"username": [username]}}, token)
     if not users:
         raise RuntimeError(f'Пользователь "{username}" не найден')
     uid = users[0]["userid"]
-    call_api("user.update", {"userid": uid, "lang": lang}, token)
+    if users[0].get("lang") != lang:
+        PLAN.apply(token, "user.update", {"userid": uid, "lang": lang}, f"user {username}", ["lang"])
 
 
 def ensure_zabbix_server_health_only(token):
@@ -466,19 +2304,17 @@ def ensure_zabbix_server_health_only(token):
 
 def get_agent_interface_id(token, hostid):
     """Возвращает interfaceid агентского интерфейса хоста (type=1)."""
-    ifs = call_api("hostinterface.get", {"hostids": hostid}, token)
+    ifs = STATE.interfaces(token, hostid)
     agent_if = next((i for i in ifs if int(i.get("type", 1)) == 1), None)
     if not agent_if:
         raise RuntimeError(f"No Zabbix agent interface on host {hostid}")
     return agent_if["interfaceid"]
 
 
-def ensure_numeric_item(token, hostid, name, key_, value_type=VALUE_TYPE_UINT, delay="1m", timeout="10s"):
-    """Создаёт/обновляет числовой элемент данных (type=Zabbix agent) и возвращает itemid."""
-    iface_id = get_agent_interface_id(token, hostid)
-
-    r = call_api("item.get", {"hostids": hostid, "filter": {"key_": key_}}, token)
-    common = {
+def _numeric_item(hostid, name, key_, value_type, delay, timeout, iface_id):
+    """Параметры item.create для числового элемента данных (type=Zabbix agent)."""
+    return {
+        "hostid": hostid,
         "name": name,
         "key_": key_,
         "type": ITEM_TYPE_ZABBIX_AGENT,
@@ -490,62 +2326,86 @@ def ensure_numeric_item(token, hostid, name, key_, value_type=VALUE_TYPE_UINT, d
         "interfaceid": iface_id,
     }
 
-    if r:
-        iid = r[0]["itemid"]
-        call_api("item.update", {"itemid": iid, **common}, token)
-        return iid
-    else:
-        res = call_api("item.create", {"hostid": hostid, **common}, token)
-        return res["itemids"][0]
-
 
-def ensure_numeric_item_on_host(token, host_name, name, key_, value_type=VALUE_TYPE_FLOAT, delay="1m", timeout="10s"):
-    """Создаёт/обновляет числовой элемент данных на конкретном хосте."""
-    host = get_host_by_name(token, host_name)
-    if not host:
-        raise RuntimeError(f'Хост "{host_name}" не найден')
-    hostid = host["hostid"]
+def _dependent_item(hostid, name, key_, value_type, master_itemid, jsonpath, units="", on_missing="0"):
+    """
+    Параметры item.create для зависимого элемента данных: значение по JSONPath из мастер-элемента.
+    on_missing — значение, если поля нет в ответе (None — отбросить значение).
+    """
+    return {
+        "hostid": hostid,
+        "name": name,
+        "key_": key_,
+        "type": ITEM_TYPE_DEPENDENT,
+        "value_type": value_type,
+        "master_itemid": master_itemid,
+        "delay": "0",
+        "history": "31d",
+        "trends": "90d",
+        "units": units,
+        "preprocessing": [{
+            "type": PREPROC_JSONPATH, "params": jsonpath,
+            "error_handler": ERRH_DISCARD if on_missing is None else ERRH_SET_VALUE,
+            "error_handler_params": "" if on_missing is None else on_missing,
+        }],
+    }
 
-    r = call_api("item.get", {"hostids": hostid, "filter": {"key_": key_}, "output": "extend"}, token)
-    if r:
-        it = r[0]
-        if it.get("templateid"):
-            return it["itemid"]
 
-        upd = {
-            "itemid": it["itemid"],
-            "name": name,
-            "delay": delay,
-            "timeout": timeout,
-        }
-        call_api("item.update", upd, token)
-        return it["itemid"]
-
-    iface_id = get_agent_interface_id(token, hostid)
-    create = {
+def _discovery_rule(hostid, name, key_, iface_id, delay=PLUGIN_DISCOVERY_DELAY, timeout="10s"):
+    """Параметры discoveryrule.create для правила обнаружения (type=Zabbix agent)."""
+    return {
         "hostid": hostid,
         "name": name,
         "key_": key_,
         "type": ITEM_TYPE_ZABBIX_AGENT,
-        "value_type": value_type,
         "delay": delay,
         "timeout": timeout,
-        "history": "31d",
-        "trends": "90d",
         "interfaceid": iface_id,
+        "lifetime": "7d",  # обнаруженные элементы исчезнувшего хоста удаляются через неделю
     }
-    res = call_api("item.create", create, token)
-    return res["itemids"][0]
 
 
-def ensure_required_items_for_hosts(token, hosts=("webserver1", "webserver2", "webserver3", "webserver4")):
+def ensure_numeric_item(token, hostid, name, key_, value_type=VALUE_TYPE_UINT, delay="1m", timeout="10s",
+                        iface_id=None):
     """
-    Создаёт элементы данных для CPU и свободного места на /.
+    Создаёт/обновляет числовой элемент данных (type=Zabbix agent) и возвращает itemid.
+    iface_id — заранее полученный interfaceid агента.
     """
+    iface_id = iface_id or get_agent_interface_id(token, hostid)
+    item = _numeric_item(hostid, name, key_, value_type, delay, timeout, iface_id)
+    return ensure_items(token, [item])[(str(hostid), key_)]
+
+
+def ensure_numeric_item_on_host(token, host_name, name, key_, value_type=VALUE_TYPE_FLOAT, delay="1m", timeout="10s"):
+    """
+    Создаёт числовой элемент данных на конкретном хосте; у существующего собственного элемента
+    обновляет name/delay/timeout, унаследованный от шаблона не трогает.
+    """
+    ids = ensure_required_items_for_hosts(token, [host_name], [(name, key_)], value_type, delay, timeout)
+    return ids[(host_name, key_)]
+
+
+def ensure_required_items_for_hosts(token, hosts=None, items=None, value_type=VALUE_TYPE_FLOAT, delay="1m",
+                                    timeout="10s"):
+    """
+    Создаёт элементы данных для CPU и свободного места на / (по умолчанию — на WEBSERVERS)
+    массовыми вызовами на все хосты сразу. Возвращает {(host, key_): itemid}.
+    """
+    hosts = hosts or [h["host"] for h in WEBSERVERS]
+    items = items or [("CPU utilization, %", "system.cpu.util"), ("Free space on /, %", "vfs.fs.size[/,pfree]")]
+    found = STATE.find_hosts(token, list(hosts))
+    missing = [h for h in hosts if not found[h]]
+    if missing:
+        raise RuntimeError(f'Хост "{missing[0]}" не найден')
+    hostids = {h: found[h]["hostid"] for h in hosts}
+    STATE.load_interfaces(token, hostids.values())
+
+    wanted = []
     for h in hosts:
-        ensure_numeric_item_on_host(token, h, "CPU utilization, %", "system.cpu.util", VALUE_TYPE_FLOAT, "1m", "10s")
-        ensure_numeric_item_on_host(token, h, "Free space on /, %", "vfs.fs.size[/,pfree]", VALUE_TYPE_FLOAT, "1m",
-                                    "10s")
+        iface_id = get_agent_interface_id(token, hostids[h])
+        wanted += [_numeric_item(hostids[h], name, key_, value_type, delay, timeout, iface_id) for name, key_ in items]
+    ids = ensure_items(token, wanted, update_fields=("name", "delay", "timeout"), skip_inherited=True)
+    return {(h, key_): ids[(str(hostids[h]), key_)] for h in hosts for _, key_ in items}
 
 
 def ensure_telegram_mediatype(token, name="Telegram (Webhook)"):
@@ -569,7 +2429,10 @@ def ensure_telegram_mediatype(token, name="Telegram (Webhook)"):
         - script: JS-код с GET на `https://api.telegram.org/bot{token}/sendMessage`.
         - message_templates: шаблоны для обычного события и восстановления.
     """
-    mt = call_api("mediatype.get", {"filter": {"name": [name]}}, token)
+    mt = call_api("mediatype.get", {"output": ["mediatypeid", "name", "type", "status", "parameters", "script",
+                                               "timeout"],
+                                    "selectMessageTemplates": ["eventsource", "recovery", "subject", "message"],
+                                    "filter": {"name": [name]}}, token)
 
     script = r'''
     try {
@@ -692,11 +2555,14 @@ def ensure_telegram_mediatype(token, name="Telegram (Webhook)"):
            "message_templates": msg_templates, "timeout": "30s"}
 
     if mt:
-        obj["mediatypeid"] = mt[0]["mediatypeid"]
-        call_api("mediatype.update", obj, token)
-        return obj["mediatypeid"]
+        mtid = mt[0]["mediatypeid"]
+        changed = diff_fields(mt[0], obj)
+        if changed:
+            PLAN.apply(token, "mediatype.update", {"mediatypeid": mtid, **changed}, f"mediatype {name}",
+                       changed)
+        return mtid
     else:
-        res = call_api("mediatype.create", obj, token)
+        res = PLAN.apply(token, "mediatype.create", obj, f"mediatype {name}")
         return res["mediatypeids"][0]
 
 
@@ -714,7 +2580,9 @@ def ensure_user_media_telegram(token, userid, mediatypeid, chat_id):
         chat_id (str): Целевой Telegram chat_id (куда слать уведомления).
     """
 
-    usr = call_api("user.get", {"userids": [userid], "selectMedias": "extend"}, token)[0]
+    usr = call_api("user.get", {"output": ["userid"], "userids": [userid],
+                                "selectMedias": ["mediaid", "mediatypeid", "sendto", "active", "severity", "period"]},
+                   token)[0]
     medias = usr.get("medias", [])
     existing = next((m for m in medias if m["mediatypeid"] == str(mediatypeid)), None)
     media_obj = {
@@ -725,11 +2593,14 @@ def ensure_user_media_telegram(token, userid, mediatypeid, chat_id):
         "period": "1-7,00:00-24:00"
     }
     if existing:
-        call_api("user.update", {"userid": userid, "medias": [{
+        if _same(existing, media_obj):
+            return
+        PLAN.apply(token, "user.update", {"userid": userid, "medias": [{
             "mediaid": existing["mediaid"], **media_obj
-        }]}, token)
+        }]}, f"user {userid} media", ["medias"])
     else:
-        call_api("user.update", {"userid": userid, "medias": [media_obj]}, token)
+        PLAN.apply(token, "user.update", {"userid": userid, "medias": [media_obj]}, f"user {userid} media",
+                   ["medias"])
 
 
 def ensure_trigger_action_telegram(token, name, mediatypeid, userid, groupid):
@@ -744,19 +2615,18 @@ def ensure_trigger_action_telegram(token, name, mediatypeid, userid, groupid):
         name (str): Имя действия (Action) в Zabbix.
         mediatypeid (str|int): Идентификатор медиа-типа (Telegram Webhook).
         userid (str|int): Пользователь, которому отправлять уведомления.
-        groupid (str|int): Идентификатор группы хостов, по которой фильтровать события.
-        кроме хоста log-srv
+        groupid (str|int): Идентификатор группы хостов, по которой фильтровать события,
+        кроме хоста логов LOG_HOST (log-srv или, в режиме scanner, monitoring-plugins): его триггеры
+        отправляет отдельное действие LOG_TRIGGER_ACTION_NAME
 
     Возвращает:
         str: Идентификатор действия (actionid).
     """
-    log_host = get_host_by_name(token, "log-srv")
+    log_host = get_host_by_name(token, LOG_HOST)
     if not log_host:
-        raise RuntimeError('Хост "log-srv" не найден для исключения из общего действия.')
+        raise RuntimeError(f'Хост "{LOG_HOST}" не найден для исключения из общего действия.')
     log_hostid = log_host["hostid"]
 
-    cur = call_api("action.get", {"filter": {"name": [name]}}, token)
-
     action = {
         "name": name,
         "eventsource": 0,  # Trigger actions
@@ -766,7 +2636,7 @@ def ensure_trigger_action_telegram(token, name, mediatypeid, userid, groupid):
             "conditions": [
                 {"conditiontype": 0, "operator": 0, "value": str(groupid)},  # Host group = Linux servers
                 {"conditiontype": 4, "operator": 5, "value": "2"},  # Severity >= Warning
-                {"conditiontype": 1, "operator": 1, "value": str(log_hostid)},  # Host != log-srv
+                {"conditiontype": 1, "operator": 1, "value": str(log_hostid)},  # Host != LOG_HOST
             ]
         },
         "operations": [{
@@ -781,16 +2651,10 @@ def ensure_trigger_action_telegram(token, name, mediatypeid, userid, groupid):
         }]
     }
 
-    if cur:
-        action["actionid"] = cur[0]["actionid"]
-        call_api("action.update", action, token)
-        return action["actionid"]
-    else:
-        res = call_api("action.create", action, token)
-        return res["actionids"][0]
+    return _apply_action(token, action)
 
 
-def ensure_cpu_disk_triggers(token, hosts=("webserver1", "webserver2", "webserver3", "webserver4")):
+def ensure_cpu_disk_triggers(token, hosts=None):
     """
     Создаёт, если их нет базовые триггеры по CPU и свободному месту на корне для заданных хостов.
 
@@ -800,39 +2664,154 @@ def ensure_cpu_disk_triggers(token, hosts=("webserver1", "webserver2", "webserve
 
     Параметры:
         token (str): Zabbix API токен.
-        hosts (Iterable[str]): Имена хостов в Zabbix.
+        hosts (Iterable[str]): Имена хостов в Zabbix (по умолчанию — WEBSERVERS).
     """
+    hosts = hosts or [h["host"] for h in WEBSERVERS]
+    found = STATE.find_hosts(token, list(hosts))
+    missing = [h for h in hosts if not found[h]]
+    if missing:
+        raise RuntimeError(f'Хост "{missing[0]}" не найден')
+    hostids = {h: found[h]["hostid"] for h in hosts}
+
+    wanted = []
     for h in hosts:
-        cpu_descr = f"{h}: High CPU utilization > 50%"
-        cpu_expr = f"avg(/{h}/system.cpu.util,1m)>50"
-        ensure_trigger(token, cpu_descr, cpu_expr, priority=4)
+        wanted.append((h, f"{h}: High CPU utilization > 50%", f"avg(/{h}/system.cpu.util,1m)>50"))
+        wanted.append((h, f"{h}: Low free space on / < 40%", f"min(/{h}/vfs.fs.size[/,pfree],1m)<40"))
+
+    ensure_triggers(token, [(hostids[h], _trigger(descr, expr, priority=4)) for h, descr, expr in wanted])
+
 
-        disk_descr = f"{h}: Low free space on / < 40%"
-        disk_expr = f"min(/{h}/vfs.fs.size[/,pfree],1m)<40"
-        ensure_trigger(token, disk_descr, disk_expr, priority=4)
+def ensure_lld(token, hostid, rules):
+    """
+    Приводит правила обнаружения (LLD) хоста к желаемому состоянию. rules — тройки
+    (правило discoveryrule.create, прототипы элементов данных, прототипы триггеров); правило
+    ищется по key_, прототипы элементов — по key_, прототипы триггеров — по description.
+    Зависимый прототип, мастер которого — тоже прототип, задаёт master_key (ключ мастера): master_itemid
+    подставляется после записи мастеров.
+    Текущее состояние читается одним пакетом, изменения — массивами create/update по видам объектов.
+    """
+    rules_q = protos_q = triggers_q = None
+    if not is_planned(hostid):
+        with ApiBatch(token) as batch:
+            rules_q = batch.add("discoveryrule.get", {"output": DISCOVERY_RULE_OUTPUT, "hostids": [hostid],
+                                                      "filter": {"key_": [r["key_"] for r, _, _ in rules]}})
+            protos_q = batch.add("itemprototype.get", _item_get_params(hostids=[hostid]))
+            triggers_q = batch.add("triggerprototype.get", {"output": TRIGGER_OUTPUT, "hostids": [hostid],
+                                                            "expandExpression": True})
+    live_rules = {r["key_"]: r for r in (rules_q.result() if rules_q else [])}
+    live_protos = {p["key_"]: p for p in (protos_q.result() if protos_q else [])}
+    live_triggers = {t["description"]: t for t in (triggers_q.result() if triggers_q else [])}
+    label = _host_label(hostid)
+
+    def sync(kind, id_field, objects, live, name_field, skip=("hostid", "ruleid")):
+        creates, updates = [], []
+        for obj in objects:
+            cur = live.get(obj[name_field])
+            if cur is None:
+                creates.append(obj)
+                continue
+            changed = diff_fields(cur, {k: v for k, v in obj.items() if k not in skip})
+            if changed:
+                updates.append((obj[name_field], {id_field: cur[id_field], **changed}, changed))
+        if updates:
+            PLAN.apply_many(token, f"{kind}.update", [u for _, u, _ in updates],
+                            [f"{kind} {n} on {label}" for n, _, _ in updates], [c for _, _, c in updates])
+        ids = {o[name_field]: live[o[name_field]][id_field] for o in objects if o[name_field] in live}
+        if creates:
+            new_ids = PLAN.apply_many(token, f"{kind}.create", creates,
+                                      [f"{kind} {o[name_field]} on {label}" for o in creates])
+            ids.update(zip((o[name_field] for o in creates), new_ids))
+        return ids
+
+    rule_ids = sync("discoveryrule", "itemid", [r for r, _, _ in rules], live_rules, "key_")
+    protos = [{**p, "ruleid": rule_ids[r["key_"]]} for r, protos, _ in rules for p in protos]
+    proto_ids = sync("itemprototype", "itemid", [p for p in protos if "master_key" not in p], live_protos, "key_")
+    dependent = [{**{k: v for k, v in p.items() if k != "master_key"}, "master_itemid": proto_ids[p["master_key"]]}
+                 for p in protos if "master_key" in p]
+    if dependent:
+        sync("itemprototype", "itemid", dependent, live_protos, "key_")
+    sync("triggerprototype", "triggerid", [t for _, _, triggers in rules for t in triggers], live_triggers,
+         "description")
+
+
+# Статические элементы monitoring-plugins, которые заменили прототипы LLD: ключи прототипов совпадают
+# с ними, и пока они есть, обнаруженные элементы не создаются
+LEGACY_PLUGIN_ITEM = re.compile(r"^nginx\.check\[(log_size|http|http_multi),|^nginx\.http\[|^check_http\[")
+
+
+def drop_legacy_plugin_items(token, hostid):
+    """Удаляет статические элементы размера логов и HTTP-проверок (в том числе curl), заведённые до перехода на LLD."""
+    if is_planned(hostid):
+        return
+    items = call_api("item.get", {"output": ["itemid", "key_", "templateid"], "hostids": [hostid],
+                                  "filter": {"flags": 0}}, token)
+    legacy = [it for it in items if LEGACY_PLUGIN_ITEM.match(it["key_"]) and str(it.get("templateid", "0")) == "0"]
+    if legacy:
+        PLAN.apply(token, "item.delete", [it["itemid"] for it in legacy],
+                   [f"item {it['key_']} on {_host_label(hostid)}" for it in legacy])
 
 
 def provision_plugin_items(token):
-    """Создаёт элементы данных для контейнера 'monitoring-plugins' (проверка доступности HTTP (1/0) и размер логов в (MB))."""
+    """
+    Создаёт элементы данных для контейнера 'monitoring-plugins': правила обнаружения (LLD) — размер логов (MB)
+    для каждого каталога /var/log/remote/<host>, доступность и время ответа для каждой HTTP-цели агента
+    (опросом http_multi и независимой проверкой через curl). Новые веб-серверы подхватываются без повторной
+    настройки, а число вызовов API не зависит от числа хостов.
+    """
     host = get_host_by_name(token, "monitoring-plugins")
     if not host:
         raise RuntimeError('Хост "monitoring-plugins" не найден')
     hid = host["hostid"]
 
-    # 1/0 — HTTP состояние
-    ensure_numeric_item(token, hid, "HTTP Check webserver1", 'check_http[webserver1]', VALUE_TYPE_UINT, "1m", "10s")
-    ensure_numeric_item(token, hid, "HTTP Check webserver2", 'check_http[webserver2]', VALUE_TYPE_UINT, "1m", "10s")
-
-    ensure_numeric_item(token, hid, "HTTP Check webserver1 by custom python plugin",
-                        'nginx.check[http,http://webserver1,]', VALUE_TYPE_UINT, "1m", "10s")
-    ensure_numeric_item(token, hid, "HTTP Check webserver2 by custom python plugin",
-                        'nginx.check[http,http://webserver2,]', VALUE_TYPE_UINT, "1m", "10s")
+    iface_id = get_agent_interface_id(token, hid)
+    drop_legacy_plugin_items(token, hid)
+
+    # один опрос всех HTTP-целей; прототипы ниже разбирают его JSON
+    master_key = "nginx.check[http_multi]"
+    master = _numeric_item(hid, "HTTP Check webservers by custom python plugin (JSON)", master_key,
+                           VALUE_TYPE_TEXT, "1m", "10s", iface_id)
+    master.update(history="0", trends="0")  # сырой JSON не храним — только значения зависимых элементов
+    ids = ensure_items(token, [master])
+    master_id = ids[(str(hid), master_key)]
+
+    log_rule = _discovery_rule(hid, "Remote log directories discovery",
+                               f"nginx.check[discovery_logs,{PLUGIN_LOG_ROOT}]", iface_id)
+    http_rule = _discovery_rule(hid, "HTTP targets discovery", "nginx.check[discovery_http]", iface_id)
+
+    # MB — размер логов каждого обнаруженного каталога
+    log_protos = [_numeric_item(hid, "{#HOST} Logs Size", "nginx.check[log_size,{#LOGDIR}]", VALUE_TYPE_FLOAT,
+                                "5m", "10s", iface_id)]
+    # 1/0 и время ответа по каждой цели — зависимые от одного опроса http_multi.
+    # Если URL нет в ответе, считаем его недоступным; время ответа без ответа сервера отбрасываем.
+    http_protos = [_dependent_item(hid, "HTTP Check {#TARGET} by custom python plugin", "nginx.check[http,{#URL},]",
+                                   VALUE_TYPE_UINT, master_id, "$['{#URL}'].up")]
+    # 1/0 — перекрёстная проверка той же цели через curl (check_http.sh принимает URL целиком, с портом)
+    http_protos.append(_numeric_item(hid, "HTTP Check {#TARGET}", "check_http[{#URL}]", VALUE_TYPE_UINT, "1m",
+                                     "10s", iface_id))
+    http_protos += [_dependent_item(hid, f"HTTP {{#TARGET}}: {label}", f"nginx.http[{{#URL}},{field}]", value_type,
+                                    master_id, f"$['{{#URL}}'].{field}", units, on_missing=None)
+                    for field, label, value_type, units in PLUGIN_HTTP_TIMINGS]
+    http_triggers = [_trigger(f"{{#TARGET}}: slow HTTP response (avg 5m > {HTTP_SLOW:g}s)",
+                              f"avg(/monitoring-plugins/nginx.http[{{#URL}},total],5m)>{HTTP_SLOW:g}", priority=2)]
+
+    # KPI трафика по access-логу каждого веб-сервера: один опрос access_stats на хост, значения — зависимые.
+    # Перцентилей нет, если за интервал не было запросов со временем, частоты — если лог читался с отставанием
+    # (больше ACCESS_READ_MAX за опрос): такие значения отбрасываем, а не подставляем 0.
+    access_rule = _discovery_rule(hid, "Nginx access logs discovery",
+                                  f"nginx.check[discovery_access,{PLUGIN_ACCESS_ROOT}]", iface_id)
+    access_key = "nginx.check[access_stats,{#ACCESSLOG}]"
+    access_master = _numeric_item(hid, "Nginx {#HOST}: access log stats (JSON)", access_key, VALUE_TYPE_TEXT,
+                                  "1m", "10s", iface_id)
+    access_master.update(history="0", trends="0")
+    access_protos = [access_master] + [
+        {**_dependent_item(hid, f"Nginx {{#HOST}}: {label}", f"nginx.access[{{#HOST}},{key}]", value_type, None,
+                           jsonpath, units, on_missing=None if "time" in key or key == "rps" else "0"),
+         "master_key": access_key}
+        for jsonpath, key, label, value_type, units in PLUGIN_ACCESS_KPIS
+    ]
 
-    # MB — размер логов
-    ensure_numeric_item(token, hid, "Webserver1 Logs Size",
-                        'nginx.check[log_size,/var/log/remote/webserver1]', VALUE_TYPE_FLOAT, "5m", "10s")
-    ensure_numeric_item(token, hid, "Webserver2 Logs Size",
-                        'nginx.check[log_size,/var/log/remote/webserver2]', VALUE_TYPE_FLOAT, "5m", "10s")
+    ensure_lld(token, hid, [(log_rule, log_protos, []), (http_rule, http_protos, http_triggers),
+                            (access_rule, access_protos, [])])
 
     print(
         "\n✅  Элементы данных для контейнера 'monitoring-plugins' для проверки доступности HTTP и размера логов успешно установлены!\n"
@@ -843,7 +2822,7 @@ def ensure_templategroup(token, name="Templates"):
     """Возвращает ID группы шаблонов с именем name, создавая её при отсутствии."""
     r = call_api("templategroup.get", {"filter": {"name": [name]}}, token)
     if r: return r[0]["groupid"]
-    return call_api("templategroup.create", {"name": name}, token)["groupids"][0]
+    return PLAN.apply(token, "templategroup.create", {"name": name}, f"templategroup {name}")["groupids"][0]
 
 
 def ensure_valuemap_ifoperstatus(token, templateid):
@@ -858,33 +2837,38 @@ def ensure_valuemap_ifoperstatus(token, templateid):
         {"value": "7", "newvalue": "lowerLayerDown"},
     ]
 
-    r = call_api("valuemap.get", {
+    r = [] if is_planned(templateid) else call_api("valuemap.get", {
+        "output": ["valuemapid", "name"],
+        "selectMappings": ["value", "newvalue"],
         "filter": {"name": ["ifOperStatus"]},
         "hostids": [templateid]
     }, token)
 
     if r:
-        call_api("valuemap.update", {
-            "valuemapid": r[0]["valuemapid"],
-            "mappings": entries
-        }, token)
+        if not _same(r[0]["mappings"], entries):
+            PLAN.apply(token, "valuemap.update", {
+                "valuemapid": r[0]["valuemapid"],
+                "mappings": entries
+            }, "valuemap ifOperStatus", ["mappings"])
         return r[0]["valuemapid"]
 
-    res = call_api("valuemap.create", {
+    res = PLAN.apply(token, "valuemap.create", {
         "name": "ifOperStatus",
         "mappings": entries,
         "hostid": templateid
-    }, token)
+    }, "valuemap ifOperStatus")
     return res["valuemapids"][0]
 
 
 def ensure_template_snmp(token, name="New SNMP"):
     """Возвращает ID SNMP-шаблона с именем name, создавая его в группе Templates при отсутствии."""
+    tid = STATE.find_templates(token, [name])[name]
+    if tid:
+        return tid
     tg_id = ensure_templategroup(token, "Templates")
-    t = call_api("template.get", {"filter": {"host": [name]}}, token)
-    if t:
-        return t[0]["templateid"]
-    res = call_api("template.create", {"host": name, "name": name, "groups": [{"groupid": tg_id}]}, token)
+    res = PLAN.apply(token, "template.create", {"host": name, "name": name, "groups": [{"groupid": tg_id}]},
+                     f"template {name}")
+    STATE.put_template(name, res["templateids"][0])
     return res["templateids"][0]
 
 
@@ -902,7 +2886,8 @@ def ensure_item_on_template(token, templateid, **kwargs):
     is_snmp = int(kwargs.get("type", ITEM_TYPE_ZABBIX_AGENT)) == ITEM_TYPE_SNMP_AGENT
 
     # Ищем существующий item по ключу на шаблоне
-    r = call_api("item.get", {"hostids": templateid, "filter": {"key_": kwargs["key_"]}}, token)
+    key_ = kwargs["key_"]
+    r = STATE.find_items(token, [(templateid, key_)])[(str(templateid), key_)]
 
     if r:
         itemid = r[0]["itemid"]
@@ -915,7 +2900,10 @@ def ensure_item_on_template(token, templateid, **kwargs):
         if not is_snmp:
             update_obj["timeout"] = timeout
         update_obj.pop("hostid", None)
-        call_api("item.update", update_obj, token)
+        changed = diff_fields(r[0], update_obj)
+        if changed:
+            PLAN.apply(token, "item.update", {"itemid": itemid, **changed}, f"template item {key_}", changed)
+            STATE.put_item(templateid, key_, _norm(changed))
         return itemid
     else:
         create_obj = {
@@ -926,7 +2914,9 @@ def ensure_item_on_template(token, templateid, **kwargs):
         }
         if not is_snmp:
             create_obj["timeout"] = timeout
-        return call_api("item.create", create_obj, token)["itemids"][0]
+        itemid = PLAN.apply(token, "item.create", create_obj, f"template item {key_}")["itemids"][0]
+        STATE.put_item(templateid, key_, {"itemid": itemid, "templateid": "0", **_norm(create_obj)})
+        return itemid
 
 
 def ensure_snmp_items_and_trigger(token, templateid):
@@ -1019,7 +3009,8 @@ def ensure_snmp_items_and_trigger(token, templateid):
         priority=4,
         manual_close=0,
         recovery_mode=1,
-        recovery_expression=expr_recovery
+        recovery_expression=expr_recovery,
+        hostid=templateid
     )
 
 
@@ -1031,7 +3022,7 @@ def ensure_snmpv3_interface(token, host_name):
     if not host: raise RuntimeError(f'Хост "{host_name}" не найден')
     hostid = host["hostid"]
 
-    ifs = call_api("hostinterface.get", {"hostids": hostid}, token)
+    ifs = STATE.interfaces(token, hostid)
     snmp_if = next((i for i in ifs if int(i.get("type", 2)) == 2), None)
 
     desired = {
@@ -1048,63 +3039,71 @@ def ensure_snmpv3_interface(token, host_name):
         }
     }
     if snmp_if:
-        call_api("hostinterface.update", {"interfaceid": snmp_if["interfaceid"], **desired}, token)
+        changed = diff_fields(snmp_if, desired)
+        if changed:
+            PLAN.apply(token, "hostinterface.update", {"interfaceid": snmp_if["interfaceid"], **changed},
+                       f"SNMP interface of {host_name}", changed)
+            snmp_if.update(_norm(changed))
     else:
-        call_api("hostinterface.create", desired, token)
+        PLAN.apply(token, "hostinterface.create", desired, f"SNMP interface of {host_name}")
+        STATE.forget_interfaces(hostid)
 
 
 def ensure_host_macro(token, hostid, macro, value):
     """Создаёт/обновляет хост-макрос."""
-    r = call_api("usermacro.get", {"hostids": [hostid], "filter": {"macro": [macro]}}, token)
+    r = STATE.find_macro(token, hostid, macro)
     if r:
-        call_api("usermacro.update", {
-            "hostmacroid": r[0]["hostmacroid"],
-            "value": value
-        }, token)
-        return r[0]["hostmacroid"]
+        if r.get("value") != value:
+            PLAN.apply(token, "usermacro.update", {
+                "hostmacroid": r["hostmacroid"],
+                "value": value
+            }, f"macro {macro} on {hostid}", ["value"])
+            r["value"] = value
+        return r["hostmacroid"]
     else:
-        res = call_api("usermacro.create", {
+        res = PLAN.apply(token, "usermacro.create", {
             "hostid": hostid,
             "macro": macro,
             "value": value
-        }, token)
+        }, f"macro {macro} on {hostid}")
+        STATE.put_macro(hostid, macro, {"hostmacroid": res["hostmacroids"][0], "value": value})
         return res["hostmacroids"][0]
 
 
 def ensure_template_macro(token, templateid, macro, value):
     """Создаёт/обновляет шаблон-макрос."""
-    r = call_api("usermacro.get", {"hostids": [templateid], "filter": {"macro": [macro]}}, token)
+    r = STATE.find_macro(token, templateid, macro)
     if r:
-        call_api("usermacro.update", {
-            "hostmacroid": r[0]["hostmacroid"],
-            "value": value
-        }, token)
-        return r[0]["hostmacroid"]
+        if r.get("value") != value:
+            PLAN.apply(token, "usermacro.update", {
+                "hostmacroid": r["hostmacroid"],
+                "value": value
+            }, f"macro {macro} on {templateid}", ["value"])
+            r["value"] = value
+        return r["hostmacroid"]
     else:
-        res = call_api("usermacro.create", {
+        res = PLAN.apply(token, "usermacro.create", {
             "hostid": templateid,
             "macro": macro,
             "value": value
-        }, token)
+        }, f"macro {macro} on {templateid}")
+        STATE.put_macro(templateid, macro, {"hostmacroid": res["hostmacroids"][0], "value": value})
         return res["hostmacroids"][0]
 
 
 def get_template_itemid_by_key(token, templateid, key_):
     """Возвращает itemid шаблона по key_ или None."""
-    r = call_api("item.get", {
-        "hostids": [templateid],
-        "filter": {"key_": [key_]},
-        "output": ["itemid", "name"]
-    }, token)
+    r = STATE.find_items(token, [(templateid, key_)])[(str(templateid), key_)]
     return r[0]["itemid"] if r else None
 
 
 def ensure_template_graph(token, templateid, name, itemids):
     """Создает/обновляет граф шаблона по двум itemid."""
-    r = call_api("graph.get", {
+    r = [] if is_planned(templateid) else call_api("graph.get", {
         "hostids": [templateid],
         "filter": {"name": [name]},
-        "output": ["graphid", "flags"]
+        "output": ["graphid", "name", "width", "height", "graphtype"],
+        "selectGraphItems": ["itemid", "color", "sortorder"]
     }, token)
 
     g = {
@@ -1120,11 +3119,13 @@ def ensure_template_graph(token, templateid, name, itemids):
 
     if r:
         gid = r[0]["graphid"]
-        call_api("graph.update", {"graphid": gid, **g}, token)
-        print(f"✅  График для шаблона успешно обновлен (id={gid}): {name}")
+        changed = diff_fields(r[0], g)
+        if changed:
+            PLAN.apply(token, "graph.update", {"graphid": gid, **changed}, f"graph {name}", changed)
+            print(f"✅  График для шаблона успешно обновлен (id={gid}): {name}")
         return gid
 
-    res = call_api("graph.create", g, token)
+    res = PLAN.apply(token, "graph.create", g, f"graph {name}")
     gid = res["graphids"][0]
     print(f"✅  График для шаблона успешно создан (id={gid}): {name}")
     return gid
@@ -1262,13 +3263,17 @@ def ensure_dashboard_eth_graphs(token, host_name, dash_name=None, time_period=36
     page = {"name": "Network", "widgets": widgets}
     obj = {"name": dash_name, "auto_start": 1, "pages": [page]}
 
-    cur = call_api("dashboard.get", {"filter": {"name": [dash_name]}}, token)
+    cur = call_api("dashboard.get", {"output": ["dashboardid", "name", "auto_start"], "selectPages": "extend",
+                                     "filter": {"name": [dash_name]}}, token)
     if cur:
-        call_api("dashboard.update", {"dashboardid": cur[0]["dashboardid"], **obj}, token)
-        print(f"✅  Дашборд «{dash_name}» успешно обновлён.")
+        changed = diff_fields(cur[0], obj)
+        if changed:
+            PLAN.apply(token, "dashboard.update", {"dashboardid": cur[0]["dashboardid"], **changed},
+                       f"dashboard {dash_name}", changed)
+            print(f"✅  Дашборд «{dash_name}» успешно обновлён.")
         return cur[0]["dashboardid"]
     else:
-        res = call_api("dashboard.create", obj, token)
+        res = PLAN.apply(token, "dashboard.create", obj, f"dashboard {dash_name}")
         dashid = res["dashboardids"][0]
         print(f"\n✅  Дашборд «{dash_name}» успешно создан (id={dashid}).")
         return dashid
@@ -1278,7 +3283,8 @@ def ensure_user_can_see_groups(token, username, hostgroup_ids, permission=3):
     """
     Выдаёт пользователю 'username' права на указанные host groups.
     """
-    u = call_api("user.get", {"filter": {"username": [username]}, "selectUsrgrps": "extend"}, token)
+    u = call_api("user.get", {"output": ["userid"], "filter": {"username": [username]},
+                              "selectUsrgrps": ["usrgrpid"]}, token)
     if not u:
         raise RuntimeError(f'Пользователь "{username}" не найден')
     usrgrp_ids = [g["usrgrpid"] for g in u[0].get("usrgrps", [])]
@@ -1286,8 +3292,8 @@ def ensure_user_can_see_groups(token, username, hostgroup_ids, permission=3):
     for ugid in usrgrp_ids:
         g = call_api("usergroup.get", {
             "usrgrpids": [ugid],
-            "selectRights": "extend",
-            "output": "extend"
+            "selectRights": ["id", "permission"],
+            "output": ["usrgrpid", "name"]
         }, token)[0]
 
         rights_by_id = {r["id"]: int(r["permission"]) for r in g.get("rights", [])}
@@ -1299,7 +3305,8 @@ def ensure_user_can_see_groups(token, username, hostgroup_ids, permission=3):
 
         if changed:
             new_rights = [{"permission": p, "id": hid} for hid, p in rights_by_id.items()]
-            call_api("usergroup.update", {"usrgrpid": g["usrgrpid"], "rights": new_rights}, token)
+            PLAN.apply(token, "usergroup.update", {"usrgrpid": g["usrgrpid"], "rights": new_rights},
+                       f"usergroup {g['name']}", ["rights"])
 
 
 def ensure_snmp_spike_triggers_eth0(token, templateid, mb_per_min=1.0):
@@ -1317,90 +3324,414 @@ def ensure_snmp_spike_triggers_eth0(token, templateid, mb_per_min=1.0):
     expr_in  = f"avg(/New SNMP/snmp.get[1.3.6.1.2.1.31.1.1.1.6.{{$IFINDEX_ETH0}}],1m)>{threshold_bps}"
     expr_out = f"avg(/New SNMP/snmp.get[1.3.6.1.2.1.31.1.1.1.10.{{$IFINDEX_ETH0}}],1m)>{threshold_bps}"
 
-    ensure_trigger(token, name_in,  expr_in,  priority=4, manual_close=1)
-    ensure_trigger(token, name_out, expr_out, priority=4, manual_close=1)
+    ensure_triggers(token, [(templateid, _trigger(name_in, expr_in, priority=4, manual_close=1)),
+                            (templateid, _trigger(name_out, expr_out, priority=4, manual_close=1))])
 
 
-def main():
-    """Основная функция запуска для полной настройки Zabbix."""
-    wait_for_api(timeout=WAIT_TIMEOUT, interval=WAIT_INTERVAL)  # Ждём, когда API Zabbix будет доступен
+def syslog_scan_items(hostid, hosts, master_itemid):
+    """
+    Параметры item.create для счётчиков syslog_scan: строки каждого уровня и всего, пример строк —
+    зависимые от одного опроса nginx.check[syslog_scan]. Хоста без новых строк в ответе нет — считаем 0.
+    """
+    items = []
+    for host in hosts:
+        items += [_dependent_item(hostid, f"Log {host}: {level} lines", f"syslog.count[{host},{level}]",
+                                  VALUE_TYPE_UINT, master_itemid, f"$.hosts['{host}'].{level}")
+                  for level in LOG_LEVELS + ("total",)]
+        sample = _dependent_item(hostid, f"Log {host}: last matching lines", f"syslog.samples[{host}]",
+                                 VALUE_TYPE_TEXT, master_itemid, f"$.samples['{host}']", on_missing=None)
+        sample.update(history="7d", trends="0")
+        items.append(sample)
+    return items
+
+
+def provision_syslog_scan(token, hosts):
+    """
+    Вместо элементов logrt на log-srv: счётчики строк логов веб-серверов hosts по уровням на
+    monitoring-plugins и триггеры с прежними описаниями (на них настроено действие Telegram).
+    Элементы logrt удаляет шаг log_mode_cleanup (drop_log_mode_leftovers). Возвращает ID триггеров.
+    """
+    host = get_host_by_name(token, LOG_HOST)
+    if not host:
+        raise RuntimeError(f'Хост "{LOG_HOST}" не найден')
+    hid = host["hostid"]
+
+    master = _numeric_item(hid, "Remote syslog scan by custom python plugin (JSON)", SYSLOG_SCAN_KEY,
+                           VALUE_TYPE_TEXT, "1m", "30s", get_agent_interface_id(token, hid))
+    master.update(history="0", trends="0")
+    master_id = ensure_items(token, [master])[(str(hid), SYSLOG_SCAN_KEY)]
+    ensure_items(token, syslog_scan_items(hid, hosts, master_id))
+
+    triggers = [(hid, _trigger(log_item_for(h)["trigger_name"], f"last(/{LOG_HOST}/syslog.count[{h},total])>0",
+                               priority=4, manual_close=1)) for h in hosts]
+    trigids = ensure_triggers(token, triggers)
+    print(f"✅  Счётчики и триггеры логов на {LOG_HOST} созданы/обновлены: {hosts[0]}..{hosts[-1]}")
+    return [trigids[(str(hid), t["description"])] for _, t in triggers]
+
+
+def drop_log_mode_leftovers(token, hosts=None):
+    """
+    Удаляет элементы данных логов другого режима (остаются после смены ZBX_LOG_MODE); триггеры на них
+    Zabbix удаляет сам. В режиме logrt — опрос syslog_scan на monitoring-plugins вместе с зависимыми
+    счётчиками, в режиме scanner — элементы logrt на log-srv. Если задан hosts, только для этих веб-серверов.
+    """
+    if LOG_MODE == "scanner":
+        logsrv = get_host_by_name(token, "log-srv")
+        if not logsrv:
+            return
+        if hosts is None:
+            keys = [it["key_"] for it in STATE.host_items(token, logsrv["hostid"])
+                    if it["key_"].startswith(LOGRT_KEY_PREFIX)]
+        else:
+            keys = [log_item_for(h)["key_"] for h in hosts]
+        drop_items(token, logsrv["hostid"], keys)
+        return
+    plugins = get_host_by_name(token, "monitoring-plugins")
+    if not plugins:
+        return
+    if hosts is None:
+        keys = [SYSLOG_SCAN_KEY]
+    else:
+        keys = [f"syslog.count[{h},{level}]" for h in hosts for level in LOG_LEVELS + ("total",)]
+        keys += [f"syslog.samples[{h}]" for h in hosts]
+    drop_items(token, plugins["hostid"], keys)
+
+
+def provision_webservers(token, rows, groupid, proxyid):
+    """
+    Настраивает порцию веб-серверов из инвентаря: хосты, элементы данных и триггеры логов
+    (на log-srv или, в режиме scanner, на monitoring-plugins), элементы данных и триггеры CPU/диска. Поиск существующих объектов идёт
+    пакетно на всю порцию, а не отдельными запросами на каждый хост.
+    Возвращает ID триггеров логов порции.
+    """
+    names = [h["host"] for h in rows]
+    rows = [{**h, "templates": h["templates"] + [TEMPLATE_SNMP]} if h["host"] == SNMP_HOST else h for h in rows]
+    hostids = ensure_hosts(token, groupid, rows, proxy_hostid=proxyid)
+    print(f"✅  Хосты созданы/обновлены: {names[0]}..{names[-1]} ({len(hostids)} шт.)")
+
+    if LOG_MODE == "scanner":
+        triggerids = provision_syslog_scan(token, names)
+    else:
+        triggerids = provision_logs_and_triggers(token, [log_item_for(n) for n in names])
+    ensure_required_items_for_hosts(token, names)
+    ensure_cpu_disk_triggers(token, names)
+
+    # элементы данных порции больше не нужны — освобождаем индекс, чтобы память не росла с числом хостов
+    for host in STATE.find_hosts(token, names).values():
+        if host is not None:
+            STATE.invalidate_items(host["hostid"])
+    return triggerids
 
-    token = wait_for_login(ZBX_USER, ZBX_PASS, timeout=WAIT_TIMEOUT, interval=WAIT_INTERVAL)
 
-    wait_for_write_ready(token, timeout=max(WAIT_TIMEOUT, 900), interval=5)
+def build_steps(token, user=ZBX_USER, hosts=None):
+    """
+    Описывает настройку Zabbix как граф шагов:
+    группа/прокси → хосты → элементы данных → триггеры → действия.
+    Веб-серверы читаются из инвентаря потоком и настраиваются порциями по INVENTORY_CHUNK;
+    если задан hosts, в порции попадают только эти веб-серверы.
+    """
+    g = StepGraph()
+    r = g.results
 
     # Интерфейс пользователя на русском
-    set_user_language(token, ZBX_USER, ZBX_LANG)
+    g.add("language", lambda: set_user_language(token, user, ZBX_LANG))
+
+    g.add("proxy", lambda: ensure_proxy(token, PROXY_NAME, mode=0))
+    g.add("group", lambda: ensure_group(token, GROUP_NAME))
+    g.add("group_rights", lambda: ensure_user_can_see_groups(token, user, [r["group"]], permission=3),
+          deps=["group"])
 
-    # Создаем хосты webserver1/2/log-srv
-    proxyid = ensure_proxy(token, PROXY_NAME, mode=0)
-    groupid = ensure_group(token, GROUP_NAME)
-    ensure_user_can_see_groups(token, ZBX_USER, [groupid], permission=3)
+    # Шаблон SNMP нужен до хоста webserver1: он входит в его набор шаблонов
+    def snmp_template():
+        tid = ensure_template_snmp(token, TEMPLATE_SNMP)
+        ensure_snmp_items_and_trigger(token, tid)
+        return tid
 
-    for h in HOSTS:
-        hid = ensure_host(token, groupid, h["host"], h["dns"], h["port"], h["templates"],
-                          proxy_hostid=proxyid if h["host"].startswith("webserver") else None)
+    g.add("snmp_template", snmp_template)
+
+    # Служебные хосты log-srv/monitoring-plugins
+    def host_step(h):
+        hid = ensure_host(token, r["group"], h["host"], h["dns"], h["port"], h["templates"])
         print(f"✅  Хост создан/обновлён: {h['host']} (id={hid})")
+        return hid
+
+    for h in INFRA_HOSTS:
+        g.add(f"host:{h['host']}", lambda h=h: host_step(h), deps=["group"], hosts=[h["host"]])
+
+    # Веб-серверы из инвентаря. Инвентарь читается потоком только при выполнении шага, порциями
+    # по INVENTORY_CHUNK хостов: в памяти одна порция, а не весь инвентарь. Какие из hosts — веб-серверы,
+    # заранее не известно, поэтому шаг относится ко всем выбранным хостам, кроме служебных.
+    def webservers():
+        selected = (h for h in iter_webservers() if hosts is None or h["host"] in hosts)
+        triggerids, snmp = [], False
+        for rows in chunked(selected, INVENTORY_CHUNK):
+            snmp = snmp or any(h["host"] == SNMP_HOST for h in rows)
+            triggerids += provision_webservers(token, rows, r["group"], r["proxy"])
+        if not snmp and hosts is None:
+            print(f"⚠️  Хоста {SNMP_HOST} нет в инвентаре — пропускаю настройку SNMPv3 на хосте.")
+        return {"log_triggerids": triggerids, "snmp": snmp}
+
+    web_hosts = None if hosts is None else set(hosts) - {h["host"] for h in INFRA_HOSTS} - {"Zabbix server"}
+    web_steps = []
+    if web_hosts is None or web_hosts:
+        web_steps.append(g.add("webservers", webservers,
+                               deps=["group", "proxy", "host:log-srv", "host:monitoring-plugins", "snmp_template"],
+                               hosts=web_hosts or ()))
+        # Элементы данных прежнего режима логов удаляются одним шагом после того, как созданы новые
+        web_steps.append(g.add("log_mode_cleanup", lambda: drop_log_mode_leftovers(token, web_hosts),
+                               deps=["host:log-srv", "host:monitoring-plugins"], after=["webservers"],
+                               hosts=web_hosts or ()))
 
     # Для Zabbix server оставляем только шаблон "Zabbix server health"
-    ensure_zabbix_server_health_only(token)
+    g.add("zabbix_server_templates", lambda: ensure_zabbix_server_health_only(token), hosts=["Zabbix server"])
 
     # SNMPv3
-    snmp_tpl_id = ensure_template_snmp(token, "New SNMP")
-    ensure_snmp_items_and_trigger(token, snmp_tpl_id)
-    ensure_snmpv3_interface(token, "webserver1")
-
-    # привязываем наш шаблон к webserver1
-    h = get_host_by_name(token, "webserver1")
-    cur = {t["templateid"] for t in h.get("parentTemplates", [])}
-    cur.add(snmp_tpl_id)
-    set_templates_exact(token, h["hostid"], list(cur))
-
-    ensure_template_macro(token, snmp_tpl_id, "{$FORCE_ETH1_PROBLEM}", "0")
-
-    ensure_host_macro(token, h["hostid"], "{$IFINDEX_ETH0}", "2")
-    ensure_host_macro(token, h["hostid"], "{$IFINDEX_ETH1}", "3")
-
-    ensure_eth_inout_items_on_template(token, snmp_tpl_id)
-    ensure_eth_graphs_on_template(token, snmp_tpl_id)
-    ensure_snmp_spike_triggers_eth0(token, snmp_tpl_id, mb_per_min=1.0)
-
-    # Дашборд по графикам eth0/eth1 (наследуются на хост webserver1)
-    ensure_dashboard_eth_graphs(token, "webserver1", dash_name="Сетевой мониторинг: webserver1", time_period=3600)
-
-    print("\n✅  SNMPv3 успешно настроен!\n")
-
-    # Создаем элементы данных и триггеры для логов на хосте log-srv
-    provision_logs_and_triggers(token)
-
-    # Создаём элементы данных для контейнера с плагинами
-    provision_plugin_items(token)
-
-    # Создаем элементы данных CPU и DISK на webserver1/2
-    ensure_required_items_for_hosts(token)
-
-    # Создаем триггеры на эти элементы данных CPU и DISK
-    ensure_cpu_disk_triggers(token)
-
-    if TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID:
-        mtid = ensure_telegram_mediatype(token)
-        admin = call_api("user.get", {"filter": {"username": [ZBX_USER]}}, token)[0]
-        ensure_user_media_telegram(token, admin["userid"], mtid, TELEGRAM_CHAT_ID)
-        ensure_trigger_action_telegram(token, "Send problems to Telegram (Linux servers ≥ Warning)", mtid,
-                                       admin["userid"], groupid)
-        ensure_trigger_action_for_log_triggers(
-            token,
-            LOG_TRIGGER_ACTION_NAME,
-            mtid,
-            admin["userid"],
-            LOG_TRIGGER_NAMES
-        )
-        print("✅  Telegram (webhook) успешно установлен!\n")
-    else:
-        print("⚠️  Пропускаю настройку Telegram: не заданы TELEGRAM_BOT_TOKEN/TELEGRAM_CHAT_ID.")
+    g.add("snmp_template_macro",
+          lambda: ensure_template_macro(token, r["snmp_template"], "{$FORCE_ETH1_PROBLEM}", "0"),
+          deps=["snmp_template"])
+    g.add("snmp_eth_items", lambda: ensure_eth_inout_items_on_template(token, r["snmp_template"]),
+          deps=["snmp_template"])
+    g.add("snmp_eth_graphs", lambda: ensure_eth_graphs_on_template(token, r["snmp_template"]),
+          deps=["snmp_eth_items"])
+    g.add("snmp_spike_triggers",
+          lambda: ensure_snmp_spike_triggers_eth0(token, r["snmp_template"], mb_per_min=1.0),
+          deps=["snmp_eth_items"])
+
+    # Настройка SNMPv3 на хосте — только если он нашёлся в инвентаре (это известно после шага webservers)
+    def snmp_host_step(fn):
+        return lambda: fn() if r["webservers"]["snmp"] else None
+
+    if web_steps:
+        g.add("snmp_interface", snmp_host_step(lambda: ensure_snmpv3_interface(token, SNMP_HOST)),
+              deps=["webservers"], hosts=[SNMP_HOST])
+
+        def snmp_host_macros():
+            hostid = get_host_by_name(token, SNMP_HOST)["hostid"]
+            ensure_host_macro(token, hostid, "{$IFINDEX_ETH0}", "2")
+            ensure_host_macro(token, hostid, "{$IFINDEX_ETH1}", "3")
+
+        g.add("snmp_host_macros", snmp_host_step(snmp_host_macros), deps=["webservers"], hosts=[SNMP_HOST])
+
+        # Дашборд по графикам eth0/eth1 (наследуются на хост webserver1)
+        def snmp_dashboard():
+            ensure_dashboard_eth_graphs(token, SNMP_HOST, dash_name=f"Сетевой мониторинг: {SNMP_HOST}",
+                                        time_period=3600)
+            print("\n✅  SNMPv3 успешно настроен!\n")
+
+        g.add("snmp_dashboard", snmp_host_step(snmp_dashboard),
+              deps=["snmp_eth_graphs", "snmp_spike_triggers", "snmp_interface", "snmp_template_macro",
+                    "snmp_host_macros"], hosts=[SNMP_HOST])
+
+    # Элементы данных для контейнера с плагинами
+    g.add("plugin_items", lambda: provision_plugin_items(token), deps=["host:monitoring-plugins"],
+          hosts=["monitoring-plugins"])
+
+    # Граф строится и для проверки аргументов в main(), поэтому предупреждения печатают шаги, а не build_steps
+    if not (TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID):
+        g.add("telegram",
+              lambda: print("⚠️  Пропускаю настройку Telegram: не заданы TELEGRAM_BOT_TOKEN/TELEGRAM_CHAT_ID."))
+        return g
+
+    g.add("telegram_mediatype", lambda: ensure_telegram_mediatype(token))
+    g.add("admin", lambda: call_api("user.get", {"output": ["userid"], "filter": {"username": [user]}},
+                                    token)[0]["userid"])
+    g.add("telegram_user_media", lambda: ensure_user_media_telegram(token, r["admin"], r["telegram_mediatype"],
+                                                                    TELEGRAM_CHAT_ID),
+          deps=["admin", "telegram_mediatype"])
+    g.add("telegram_action",
+          lambda: ensure_trigger_action_telegram(token, "Send problems to Telegram (Linux servers ≥ Warning)",
+                                                 r["telegram_mediatype"], r["admin"], r["group"]),
+          deps=["admin", "telegram_mediatype", "group", f"host:{LOG_HOST}"])
+    # Условия действия — триггеры логов, собранные шагом webservers. Если настраивался не весь инвентарь,
+    # условия по остальным веб-серверам остаются от прошлых запусков
+    g.add("telegram_log_action",
+          lambda: ensure_trigger_action_for_log_triggers(
+              token, LOG_TRIGGER_ACTION_NAME, r["telegram_mediatype"], r["admin"],
+              r.get("webservers", {}).get("log_triggerids", []),
+              keep_existing=hosts is not None or "webservers" not in r),
+          deps=["admin", "telegram_mediatype", f"host:{LOG_HOST}"], after=web_steps)
+    g.add("telegram", lambda: print("✅  Telegram (webhook) успешно установлен!\n"),
+          deps=["telegram_user_media", "telegram_action", "telegram_log_action"])
+    return g
+
+
+def _csv_arg(value):
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+
+def parse_args(argv=None):
+    """Разбирает аргументы командной строки."""
+    p = argparse.ArgumentParser(description="Настройка Zabbix для стенда monlab.")
+    p.add_argument("--plan", action="store_true",
+                   help="только показать план изменений, ничего не записывая в Zabbix")
+    p.add_argument("--concurrency", type=int, default=CONCURRENCY,
+                   help=f"сколько шагов выполнять параллельно (по умолчанию {CONCURRENCY}, ZBX_CONCURRENCY)")
+    p.add_argument("--only", type=_csv_arg, metavar="STAGES",
+                   help="выполнить только эти этапы через запятую (например snmp,telegram); "
+                        "шаги, от которых они зависят, добавляются автоматически")
+    p.add_argument("--hosts", type=_csv_arg, metavar="HOSTS",
+                   help="настраивать только эти хосты через запятую (например webserver3)")
+    p.add_argument("--list-steps", action="store_true", help="показать шаги, которые будут выполнены, и выйти")
+    p.add_argument("--reconcile-interval", type=float, default=RECONCILE_INTERVAL, metavar="SECONDS",
+                   help="после настройки не завершаться, а раз в SECONDS проверять дрейф конфигурации и "
+                        "исправлять его (ZBX_RECONCILE_INTERVAL; 0 — один проход)")
+    p.add_argument("--log-mode", default=LOG_MODE, metavar="MODE",
+                   help=f"как собирать логи веб-серверов: {' или '.join(LOG_MODES)} (ZBX_LOG_MODE)")
+    p.add_argument("--record", default=RECORD_FILE, metavar="FILE",
+                   help="записать все запросы и ответы API в файл (ZBX_RECORD)")
+    p.add_argument("--replay", default=REPLAY_FILE, metavar="FILE",
+                   help="отвечать на запросы из записи вместо Zabbix (ZBX_REPLAY)")
+    p.add_argument("--replay-latency", type=float, default=REPLAY_LATENCY, metavar="FACTOR",
+                   help="множитель записанных задержек при --replay: 0 — без пауз, 1 — как при записи")
+    return p.parse_args(argv)
+
+
+def provision(token, user, args, hosts):
+    """Один проход настройки: снимок конфигурации и выбранные шаги. Возвращает результаты шагов."""
+    # Снимок текущей конфигурации: дальше все ensure_* ищут объекты в нём, а не отдельными *.get
+    # (веб-серверы из инвентаря подгружаются порциями в шаге webservers)
+    with METRICS.stage("snapshot"):
+        STATE.reset()
+        STATE.load(token, [h["host"] for h in INFRA_HOSTS] + ["Zabbix server"],
+                   [TEMPLATE_LINUX_AGENT, TEMPLATE_SERVER_HEALTH, TEMPLATE_SNMP])
+
+    return build_steps(token, user, hosts).restrict(args.only, hosts).run(workers=args.concurrency)
+
+
+def fingerprint(token, groupid):
+    """
+    Дешёвый отпечаток управляемой конфигурации — один пакетный запрос из счётчиков (countOutput)
+    и последней записи журнала аудита. Любая правка через UI/API попадает в аудит, удаление или
+    отключение хоста, элемента данных, триггера меняет счётчики. Недоступные части (например,
+    auditlog без прав супер-администратора) дают None и в сравнении не участвуют.
+    """
+    count = {"countOutput": True}
+    with ApiBatch(token) as batch:
+        queries = {
+            "hosts": batch.add("host.get", {**count, "groupids": [groupid]}),
+            "disabled_hosts": batch.add("host.get", {**count, "groupids": [groupid], "filter": {"status": 1}}),
+            "items": batch.add("item.get", {**count, "groupids": [groupid]}),
+            "triggers": batch.add("trigger.get", {**count, "groupids": [groupid]}),
+            "templates": batch.add("template.get", {"output": ["templateid"], "selectItems": "count",
+                                                    "selectTriggers": "count", "selectGraphs": "count",
+                                                    "filter": {"host": [TEMPLATE_SNMP]}}),
+            "actions": batch.add("action.get", count),
+            "audit": batch.add("auditlog.get", {"output": ["auditid", "clock"], "sortfield": "clock",
+                                                "sortorder": "DESC", "limit": 1}),
+        }
+    fp = {}
+    for name, q in queries.items():
+        try:
+            fp[name] = q.result()
+        except RuntimeError:
+            fp[name] = None
+    return fp
+
 
-    print("✅  Готово! Zabbix успешно настроен!")
+_stop = threading.Event()
 
 
+def reconcile(args, hosts, token, user, groupid):
+    """
+    Режим сверки: раз в interval секунд снимает fingerprint() и запускает полный проход
+    (с диффом и записью только изменившегося), только если отпечаток изменился, прошлый проход
+    упал или подошла плановая полная сверка (каждые RECONCILE_FULL_EVERY проверок).
+    Останавливается по SIGTERM/SIGINT.
+    """
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: _stop.set())
+    interval = args.reconcile_interval
+    print(f"🔁  Режим сверки: проверка дрейфа каждые {interval:.0f}s.")
+    with METRICS.stage("reconcile"):
+        baseline = fingerprint(token, groupid)
+    checks = 0
+    while not _stop.wait(interval):
+        checks += 1
+        BUDGET.start(API_BUDGET)
+        try:
+            if baseline is None:
+                token, user = obtain_token(ZBX_USER, ZBX_PASS, time.monotonic() + WAIT_TIMEOUT)
+            with METRICS.stage("reconcile"):
+                current = fingerprint(token, groupid)
+            if baseline is None:
+                reason = "прошлая сверка не удалась"
+            elif current != baseline:
+                reason = "изменилось: " + ", ".join(k for k in current if current[k] != baseline.get(k))
+            elif RECONCILE_FULL_EVERY and checks % RECONCILE_FULL_EVERY == 0:
+                reason = "плановая полная сверка"
+            else:
+                continue
+            print(f"\n🔁  Сверка конфигурации ({reason})")
+            PLAN.reset()
+            groupid = provision(token, user, args, hosts).get("group", groupid)
+            PLAN.print()
+            with METRICS.stage("reconcile"):
+                baseline = fingerprint(token, groupid)
+        except Exception as e:
+            print(f"❌  Сверка не удалась: {e}")
+            baseline = None
+        finally:
+            try:
+                METRICS.write()
+            except OSError as e:
+                print(f"⚠️  Не удалось записать отчёт о вызовах API: {e}")
+    print("👋  Режим сверки остановлен.")
+
+
+def main(argv=None):
+    """Основная функция запуска для полной настройки Zabbix."""
+    args = parse_args(argv)
+    PLAN.dry_run = args.plan
+    hosts = set(args.hosts) if args.hosts else None
+    # выбор этапов и режим логов проверяем до подключения к Zabbix
+    try:
+        set_log_mode(args.log_mode)
+        g = build_steps(None, hosts=hosts).restrict(args.only, hosts)
+    except ValueError as e:
+        raise SystemExit(f"❌  {e}")
+    if args.list_steps:
+        for name, (_, deps) in g.steps.items():
+            print(f"{name}" + (f"  ← {', '.join(deps)}" if deps else ""))
+        return
+    if args.replay:
+        set_client(ReplayTransport(args.replay, args.replay_latency))
+    elif args.record:
+        set_client(RecordingTransport(get_client(), args.record))
+
+    # транспорт записи/воспроизведения закрываем после всех вызовов, включая режим сверки
+    try:
+        BUDGET.start(API_BUDGET)
+        try:
+            # Один общий срок на все ожидания готовности
+            deadline = time.monotonic() + WAIT_TIMEOUT
+            with METRICS.stage("startup"):
+                wait_for_api(deadline)  # Ждём, когда API Zabbix будет доступен
+
+                token, user = obtain_token(ZBX_USER, ZBX_PASS, deadline)
+
+                if not PLAN.dry_run:
+                    wait_for_write_ready(token, deadline)
+
+            results = provision(token, user, args, hosts)
+        finally:
+            METRICS.print_summary()
+            try:
+                print(f"📊  Отчёт о вызовах API: {', '.join(METRICS.write())}")
+            except OSError as e:
+                print(f"⚠️  Не удалось записать отчёт о вызовах API: {e}")
+
+        PLAN.print()
+        if PLAN.dry_run:
+            print("\nℹ️  Режим --plan: изменения в Zabbix не записывались.")
+            return
+        print("✅  Готово! Zabbix успешно настроен!")
+
+        if args.reconcile_interval > 0:
+            groupid = results.get("group") or ensure_group(token, GROUP_NAME)
+            reconcile(args, hosts, token, user, groupid)
+    finally:
+        if args.replay or args.record:
+            get_client().close()
+
 if __name__ == "__main__":
     main()